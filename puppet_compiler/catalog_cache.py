@@ -0,0 +1,149 @@
+"""Cache of compiled catalogs, shared across jobs"""
+import fcntl
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List, Sequence, Tuple
+
+from puppet_compiler import _log, utils
+
+
+class CatalogCache:
+    """Content addressed cache of compiled catalogs.
+
+    A catalog is stored under a key derived from everything that goes into
+    compiling it: the trees of the puppet, private and netbox-hiera checkouts,
+    the realm and the puppet.conf rendered for it, the facts of the host and
+    the puppet version. Entries are written to a temporary directory and
+    renamed in place, so that concurrent jobs never see partial entries.
+
+    Arguments:
+        directory: the directory to store the entries in
+        revisions: the tree hashes of the checkouts, by environment (prod or change)
+        max_size: evict the least recently used entries above this size, in bytes
+        ttl: ignore entries older than this, in seconds. This bounds how stale
+             exported resources collected from PuppetDB can be.
+
+    """
+
+    def __init__(self, directory: Path, revisions: Dict[str, Sequence[str]], max_size: int, ttl: int):
+        self.directory = directory
+        self.revisions = revisions
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries_dir = directory / "entries"
+        self.tmp_dir = directory / "tmp"
+
+    def key(self, env: str, realm: str, facts_file: Path, puppet_conf: Path) -> str:
+        """Return the cache key of a catalog
+
+        Arguments:
+            env: the environment the catalog is compiled for (prod or change)
+            realm: the realm of the host
+            facts_file: the facts file of the host
+            puppet_conf: the puppet.conf the catalog is compiled with
+
+        """
+        try:
+            conf_digest = hashlib.sha256(puppet_conf.read_bytes()).hexdigest()
+        except FileNotFoundError:
+            conf_digest = ""
+        digest = hashlib.sha256()
+        parts = [
+            *self.revisions[env],
+            realm,
+            conf_digest,
+            utils.facts_digest(facts_file),
+            os.environ["PUPPET_VERSION_FULL"],
+        ]
+        for part in parts:
+            digest.update(part.encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.entries_dir / key[:2] / key
+
+    def get(self, key: str, catalog: Path, errors: Path) -> bool:
+        """Copy a cached catalog in place
+
+        Arguments:
+            key: the cache key
+            catalog: the path to copy the catalog to
+            errors: the path to copy the compilation errors to
+
+        Returns:
+            bool: True on a cache hit, False otherwise
+
+        """
+        entry = self._entry(key)
+        try:
+            if time.time() - (entry / "catalog").stat().st_mtime > self.ttl:
+                return False
+            shutil.copyfile(entry / "catalog", catalog)
+            shutil.copyfile(entry / "errors", errors)
+            # Record the access for the LRU eviction
+            os.utime(entry)
+        except OSError:
+            # Either a miss, or the entry got evicted meanwhile
+            return False
+        return True
+
+    def put(self, key: str, catalog: Path, errors: Path) -> None:
+        """Store a compiled catalog
+
+        Arguments:
+            key: the cache key
+            catalog: the path of the compiled catalog
+            errors: the path of the compilation errors
+
+        """
+        entry = self._entry(key)
+        try:
+            self.tmp_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+            entry.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            tmp_entry = Path(tempfile.mkdtemp(dir=self.tmp_dir))
+            shutil.copyfile(catalog, tmp_entry / "catalog")
+            shutil.copyfile(errors, tmp_entry / "errors")
+            tmp_entry.chmod(0o755)
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # Another job stored the same catalog meanwhile
+                shutil.rmtree(tmp_entry, True)
+        except OSError as error:
+            _log.warning("Unable to store catalog %s in the cache: %s", catalog, error)
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits max_size"""
+        try:
+            self.directory.mkdir(mode=0o755, parents=True, exist_ok=True)
+            with (self.directory / "evict.lock").open("w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                entries: List[Tuple[float, int, Path]] = []
+                total = 0
+                for entry in self.entries_dir.glob("*/*"):
+                    try:
+                        size = sum(path.stat().st_size for path in entry.iterdir())
+                        entries.append((entry.stat().st_mtime, size, entry))
+                    except OSError:
+                        continue
+                    total += size
+                entries.sort()
+                evicted = 0
+                for _, size, entry in entries:
+                    if total <= self.max_size:
+                        break
+                    # Move the entry out of the way first, so that it disappears atomically
+                    tmp_entry = Path(tempfile.mkdtemp(dir=self.tmp_dir)) / entry.name
+                    os.rename(entry, tmp_entry)
+                    shutil.rmtree(tmp_entry.parent, True)
+                    total -= size
+                    evicted += 1
+        except OSError as error:
+            _log.warning("Unable to evict entries from the catalog cache %s: %s", self.directory, error)
+            return
+        _log.info("Catalog cache: evicted %d entries, %d bytes in use", evicted, total)
@@ -0,0 +1,83 @@
+"""Group the hosts that compile to similar catalogs, to only compile a few of each group"""
+import hashlib
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from puppet_compiler import _log
+from puppet_compiler.hiera_index import host_variables
+
+
+def fingerprint(role: Optional[str], classes: Iterable[str], facts: Dict[str, str]) -> str:
+    """Return the fingerprint of a host, hosts sharing it are expected to get similar catalogs
+
+    Arguments:
+        role: the role of the host
+        classes: the classes of the host
+        facts: the catalog relevant facts of the host
+
+    """
+    data = {"role": role, "classes": sorted(classes), "facts": sorted(facts.items())}
+    return hashlib.sha256(json.dumps(data).encode()).hexdigest()
+
+
+def representatives(
+    hosts: Iterable[str],
+    facts_files: Dict[str, Path],
+    fact_names: List[str],
+    classes: Dict[str, Set[str]],
+    roles: Dict[str, str],
+    count: int,
+    max_workers: int = 4,
+) -> Dict[str, List[str]]:
+    """Pick count hosts in each group of hosts sharing the same fingerprint
+
+    The hosts are grouped by role, classes and catalog relevant facts.
+    Hosts without facts file get a group of their own.
+
+    Arguments:
+        hosts: the candidate hosts
+        facts_files: the facts file of each host
+        fact_names: the catalog relevant facts, e.g. os.distro.codename
+        classes: the classes of each host, as known by PuppetDB
+        roles: the role of each host
+        count: the number of hosts to pick in each group
+        max_workers: the number of processes parsing the facts files
+
+    Returns:
+        dict: the hosts each of the picked hosts stands for, by picked host
+
+    """
+    hosts = sorted(hosts)
+    with_facts = [host for host in hosts if host in facts_files]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        all_facts = dict(
+            zip(
+                with_facts,
+                executor.map(
+                    host_variables,
+                    [facts_files[host] for host in with_facts],
+                    [fact_names] * len(with_facts),
+                    chunksize=16,
+                ),
+            )
+        )
+    groups: Dict[str, List[str]] = {}
+    for host in hosts:
+        if host not in all_facts:
+            groups[host] = [host]
+            continue
+        key = fingerprint(roles.get(host), classes.get(host, set()), all_facts[host])
+        groups.setdefault(key, []).append(host)
+
+    picked: Dict[str, List[str]] = {}
+    for members in groups.values():
+        chosen = members[:count]
+        for chosen_host in chosen:
+            picked[chosen_host] = []
+        # The hosts left out are spread across the chosen ones
+        for index, host in enumerate(members[count:]):
+            picked[chosen[index % len(chosen)]].append(host)
+    _log.info("Picked %d hosts standing for %d hosts, in %d groups", len(picked), len(hosts), len(groups))
+    return picked
@@ -0,0 +1,192 @@
+"""Pool of long-lived puppet processes, each compiling many catalogs"""
+import asyncio
+import json
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from puppet_compiler import _log
+
+DRIVER = Path(__file__).parent / "files" / "batch_compile.rb"
+
+
+class CompilerProcessError(Exception):
+    """Risen when a compiler process dies or breaks the protocol."""
+
+
+class CompilerProcess:
+    """A puppet process compiling catalogs on request
+
+    Arguments:
+        proc: the running process, talking the batch_compile.rb protocol
+
+    """
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        if proc.stdin is None or proc.stdout is None:
+            raise CompilerProcessError("The compiler process needs both stdin and stdout to be pipes")
+        self.proc = proc
+        self.stdin = proc.stdin
+        self.stdout = proc.stdout
+        self.compiled = 0
+        # When the process last became idle
+        self.idle_since = 0.0
+
+    @classmethod
+    async def start(cls, command: Sequence[str], settings: Sequence[str], env: Dict[str, str]) -> "CompilerProcess":
+        """Start a new compiler process
+
+        Arguments:
+            command: the command running the compiler driver
+            settings: the puppet settings, as command line flags
+            env: the environment variables to run the process with
+
+        """
+        proc = await asyncio.subprocess.create_subprocess_exec(
+            *command,
+            *settings,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            env=env,
+        )
+        _log.debug("Started compiler process %d", proc.pid)
+        return cls(proc)
+
+    async def compile(self, hostname: str, catalog: Path, errors: Path) -> int:
+        """Compile the catalog of a host
+
+        Arguments:
+            hostname: the host to compile the catalog for
+            catalog: the file to write the catalog to
+            errors: the file to write the compilation logs to
+
+        Returns:
+            int: the status of the compilation, as the exit code of `puppet catalog compile`
+
+        Raises:
+            CompilerProcessError: if the process died while compiling
+
+        """
+        request = {"node": hostname, "catalog": str(catalog), "errors": str(errors)}
+        try:
+            self.stdin.write(json.dumps(request).encode() + b"\n")
+            await self.stdin.drain()
+            response = await self.stdout.readline()
+        except (BrokenPipeError, ConnectionResetError) as error:
+            raise CompilerProcessError(f"Compiler process {self.proc.pid} died") from error
+        if not response:
+            raise CompilerProcessError(f"Compiler process {self.proc.pid} died")
+        self.compiled += 1
+        try:
+            return int(json.loads(response)["status"])
+        except (ValueError, KeyError) as error:
+            raise CompilerProcessError(f"Unexpected response from compiler process: {response!r}") from error
+
+    async def stop(self) -> None:
+        """Stop the process"""
+        if self.proc.returncode is not None:
+            return
+        self.stdin.close()
+        try:
+            await asyncio.wait_for(self.proc.wait(), timeout=10)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+
+
+class CompilerPool:
+    """Keep warm puppet processes around, by puppet settings.
+
+    Processes are spawned on demand, the number of busy processes is hence
+    bound by the number of concurrent compilations. Processes are reused for
+    any compilation sharing the same settings, i.e. the same environment,
+    realm and facts directory, so that the manifests are parsed only once.
+    The processes waiting for a compilation are kept for each settings, the
+    ones idle for the longest are stopped beyond max_idle of them in total.
+
+    Arguments:
+        max_compiles: the number of catalogs a process compiles before being
+            replaced, to bound its memory usage. 0 means no limit.
+        command: the command running the compiler driver
+        max_idle: the number of idle processes to keep, across all the
+            settings. 0 means no limit.
+
+    """
+
+    def __init__(self, max_compiles: int = 0, command: Optional[Sequence[str]] = None, max_idle: int = 0):
+        self.max_compiles = max_compiles
+        self.max_idle = max_idle
+        self.command = list(command) if command is not None else ["ruby", str(DRIVER)]
+        self._idle: Dict[Tuple[str, ...], List[CompilerProcess]] = {}
+        self._busy: List[CompilerProcess] = []
+
+    @staticmethod
+    def settings(cmd: Sequence[str]) -> List[str]:
+        """Extract the puppet settings from a `puppet catalog compile` command
+
+        Arguments:
+            cmd: the command, as returned by puppet.compile_cmd_env
+
+        """
+        return [flag for flag in cmd[3:] if flag.startswith("--") and not flag.startswith("--render-as")]
+
+    async def compile(self, cmd: Sequence[str], env: Dict[str, str], hostname: str, catalog: Path, errors: Path) -> int:
+        """Compile the catalog of a host with a warm process
+
+        Arguments:
+            cmd: the equivalent `puppet catalog compile` command
+            env: the environment variables of the command
+            hostname: the host to compile the catalog for
+            catalog: the file to write the catalog to
+            errors: the file to write the compilation logs to
+
+        Returns:
+            int: the status of the compilation, as the exit code of `puppet catalog compile`
+
+        """
+        settings = self.settings(cmd)
+        key = tuple(settings + [env.get("RUBYLIB", "")])
+        idle = self._idle.setdefault(key, [])
+        process = idle.pop() if idle else await CompilerProcess.start(self.command, settings, env)
+        self._busy.append(process)
+        try:
+            status = await process.compile(hostname, catalog, errors)
+        except BaseException:
+            # The process is in an unknown state (or dead), don't reuse it
+            self._busy.remove(process)
+            if process.proc.returncode is None:
+                process.proc.kill()
+            await process.proc.wait()
+            raise
+
+        self._busy.remove(process)
+        if self.max_compiles and process.compiled >= self.max_compiles:
+            await process.stop()
+        else:
+            process.idle_since = time.monotonic()
+            idle.append(process)
+            await self._evict()
+        return status
+
+    async def _evict(self) -> None:
+        """Stop the processes idle for the longest, beyond max_idle idle processes"""
+        idle = [(key, process) for key, processes in self._idle.items() for process in processes]
+        if not self.max_idle or len(idle) <= self.max_idle:
+            return
+        idle.sort(key=lambda item: item[1].idle_since)
+        evicted = idle[: len(idle) - self.max_idle]
+        for key, process in evicted:
+            self._idle[key].remove(process)
+        _log.debug("Stopping %d idle compiler processes", len(evicted))
+        await asyncio.gather(*(process.stop() for _, process in evicted))
+
+    def idle_pids(self) -> List[int]:
+        """Return the pids of the processes waiting for a compilation"""
+        return [process.proc.pid for idle in self._idle.values() for process in idle]
+
+    async def close(self) -> None:
+        """Stop all the processes"""
+        processes = self._busy + [process for idle in self._idle.values() for process in idle]
+        self._idle = {}
+        self._busy = []
+        await asyncio.gather(*(process.stop() for process in processes))
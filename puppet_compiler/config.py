@@ -25,11 +25,84 @@ class ControllerConfig:
     # of the labs/private repository
     puppet_private: Path = Path("/var/lib/catalog-differ/private")
     puppet_netbox: Path = Path("/var/lib/catalog-differ/netbox-hiera")
+    # Skip refreshing the repositories above if another job did it less
+    # than this many seconds ago (0 means always refresh)
+    refresh_ttl: int = 0
     # Directory hosting all of puppet's runtime files usually
     # under /var/lib/puppet on debian-derivatives
     puppet_var: Path = Path("/var/lib/catalog-differ/puppet")
+    # Directory holding the data kept across jobs (compile history, caches...)
+    cache_dir: Path = Path("/var/lib/catalog-differ/cache")
+    # Clone the local repositories above with --shared: the checkouts borrow
+    # the objects of the long-lived repositories rather than copying them.
+    # Those repositories must then never be garbage collected with pruning
+    # while a job is running.
+    shared_clones: bool = False
+    # Number of ready to use workspaces kept under base/workspaces by
+    # pcc-workspace-pool, jobs claim them instead of cloning the
+    # repositories (0 disables the pool).
+    workspace_pool_size: int = 0
     pool_size: int = 2
+    # Adapt the number of concurrent compilations, starting from pool_size,
+    # to the load and memory of the machine, between pool_size_min and
+    # pool_size_max (0 meaning the number of cpus).
+    adaptive_pool: bool = False
+    pool_size_min: int = 1
+    pool_size_max: int = 0
     fail_fast: bool = False
+    # Compile the production and change catalogs of a host at the same time,
+    # both compilations still count against pool_size.
+    parallel_compile: bool = False
+    # How catalogs get compiled: "process" spawns a puppet process per catalog,
+    # "pool" keeps warm puppet processes compiling many catalogs each, every
+    # process being replaced after compile_pool_max_compiles catalogs (0 means never).
+    compile_backend: str = "process"
+    compile_pool_max_compiles: int = 200
+    # The summary pages (index.html and build.json) are re-rendered during the
+    # run when either this many seconds or this many host completions have
+    # passed since the last rendering.
+    summary_interval: float = 10.0
+    summary_batch: int = 100
+    # Number of threads refreshing the expiration of the facts files before
+    # the compilation starts
+    facts_refresh_workers: int = 8
+    # Number of processes diffing the catalogs and rendering the output of
+    # the hosts once compiled, so that the event loop keeps starting new
+    # compilations meanwhile (0 does it on the event loop).
+    diff_workers: int = 0
+    # Keep the compiled catalogs in cache_dir, and reuse them across jobs
+    # when the code, the facts and the puppet version are the same. Entries
+    # older than catalog_cache_ttl seconds are ignored, as the exported
+    # resources they collected from PuppetDB may be stale, and the least
+    # recently used ones are evicted above catalog_cache_size_mb.
+    catalog_cache: bool = False
+    catalog_cache_size_mb: int = 2048
+    catalog_cache_ttl: int = 86400
+
+    # Reuse the hosts selected through PuppetDB by jobs that ran less than
+    # this many seconds ago (0 disables the cache)
+    puppetdb_cache_ttl: int = 0
+    # Select the hosts having a class or defined type from the offline index
+    # exported by puppetdb-export-index to cache_dir, as long as it is younger
+    # than this many seconds (0 always queries PuppetDB)
+    puppetdb_index_max_age: int = 0
+    # In auto mode, also select the hosts of the roles reaching the changed
+    # manifests, templates, files and functions through the include graph of
+    # puppet_src, cached in cache_dir
+    auto_include_graph: bool = False
+    # In auto mode, select the hosts reading the changed hieradata files,
+    # resolving the hierarchy of their realm with their facts. The index is
+    # cached in cache_dir and updated by hiera_index_workers processes.
+    auto_hiera_index: bool = False
+    hiera_index_workers: int = 4
+
+    # Only compile cluster_representatives hosts of each group of hosts
+    # sharing the same role, PuppetDB classes and cluster_facts (a comma
+    # separated list of facts, dots reaching into structured facts). The
+    # facts are read by cluster_workers processes. 0 compiles every host.
+    cluster_representatives: int = 0
+    cluster_facts: str = "os.distro.codename,networking.domain,is_virtual,dmi.product.name,processors.count"
+    cluster_workers: int = 4
 
     # Disables PuppetDB when set to False
     storeconfigs: bool = True
@@ -12,20 +12,30 @@ How data are organized:
 """
 
 import asyncio
+import multiprocessing
 import os
 import re
 import signal
 import socket
 import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
 from pathlib import Path
-from typing import Callable, Iterable, List, Optional, Set, Union
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
+import requests
 import yaml
 
-from puppet_compiler import _log, directories, nodegen, prepare, worker
+from puppet_compiler import _log, clusters, directories, nodegen, prepare, provenance, puppetdb, utils, worker
+from puppet_compiler.catalog_cache import CatalogCache
+from puppet_compiler.compiler_pool import CompilerPool
 from puppet_compiler.config import ControllerConfig
+from puppet_compiler.history import CompileHistory
+from puppet_compiler.limiter import AdaptiveLimiter
 from puppet_compiler.presentation import html, json
 from puppet_compiler.presentation.html import Index
+from puppet_compiler.provenance import ProvenanceIndex
 from puppet_compiler.state import ChangeState, StatesCollection
 
 
@@ -40,14 +50,52 @@ class ControllerNoHostsError(Exception):
 RunTaskResult = Union[Optional[worker.RunHostResult], Exception]
 
 
-def with_semaphore(semaphore: asyncio.Semaphore, func: Callable):
+def with_limiter(limiter: AdaptiveLimiter, func: Callable):
     async def _inner(*args, **kwargs):
-        async with semaphore:
+        async with limiter:
             return await func(*args, **kwargs)
 
     return _inner
 
 
+class SummaryRenderer:
+    """Rate limit the rendering of the summary pages during a run.
+
+    The summary is rendered once `batch` hosts have completed or `interval`
+    seconds have passed since the last rendering, whichever comes first.
+    Completions that are not rendered right away get rendered by a timer at
+    most `interval` seconds later.
+    """
+
+    def __init__(self, render: Callable[[], object], interval: float, batch: int) -> None:
+        self.render = render
+        self.interval = interval
+        self.batch = batch
+        self._pending = 0
+        self._last_render = time.monotonic()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def completed(self) -> None:
+        """Record a host completion, rendering the summary if it is due."""
+        self._pending += 1
+        elapsed = time.monotonic() - self._last_render
+        if self._pending >= self.batch or elapsed >= self.interval:
+            self.flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval - elapsed, self.flush)
+
+    def flush(self) -> None:
+        """Render the summary now if there are completions not rendered yet."""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        self._pending = 0
+        self._last_render = time.monotonic()
+        self.render()
+
+
 # pylint: disable=too-many-instance-attributes
 class Controller:
     """Class responsible for controlling the flow of the compilation run"""
@@ -77,9 +125,19 @@ class Controller:
             raise ControllerError from error
 
         self.count = 0
+        self.states = StatesCollection()
         self.change_id = change_id
+        self.job_id = job_id
         self.change_private_id = change_private_id
         self.hosts_raw = host_list
+        # The hosts each compiled host stands for, when clustering the hosts
+        self.represented: Dict[str, List[str]] = {}
+        puppetdb.client = puppetdb.PuppetDBClient(
+            cache_dir=self.config.cache_dir / "puppetdb",
+            cache_ttl=self.config.puppetdb_cache_ttl,
+            index_path=puppetdb.index_path(self.config),
+            index_max_age=self.config.puppetdb_index_max_age,
+        )
         self.pick_hosts(host_list)
         directories.FHS.setup(change_id, job_id, self.config.base)
         self.managecode = prepare.ManageCode(self.config, job_id, change_id, force, change_private_id)
@@ -124,26 +182,31 @@ class Controller:
 
         """
         hosts = set()
+        # The hosts selected from the change or from PuppetDB, rather than listed
+        # by the user, they can be reduced to representatives of similar hosts
+        derived: Set[str] = set()
         if not host_list:
             _log.info("No host list provided, generating the nodes list")
-            hosts = nodegen.get_nodes(self.config)
+            derived = nodegen.get_nodes(self.config)
         else:
+            # The PuppetDB queries are collected and run concurrently at the end
+            puppetdb_titles = []
             for host_list_part in re.split(r"\s*,\s*", host_list):
                 if host_list_part.startswith("re:"):
                     host_regex = host_list_part[3:]
                     hosts.update(nodegen.get_nodes_regex(self.config, host_regex))
                 elif host_list_part.startswith("O:"):
                     role = host_list_part[2:]
-                    hosts.update(nodegen.get_nodes_puppetdb_class("Role::{}".format(role)))
+                    puppetdb_titles.append(nodegen.class_title("Role::{}".format(role)))
                 elif host_list_part.startswith("P:"):
                     profile = host_list_part[2:]
-                    hosts.update(nodegen.get_nodes_puppetdb_class("Profile::{}".format(profile)))
+                    puppetdb_titles.append(nodegen.class_title("Profile::{}".format(profile)))
                 elif host_list_part.startswith("C:"):
                     puppet_class = host_list_part[2:]
-                    hosts.update(nodegen.get_nodes_puppetdb_class(puppet_class))
+                    puppetdb_titles.append(nodegen.class_title(puppet_class))
                 elif host_list_part.startswith("R:"):
                     puppet_class = host_list_part[2:]
-                    hosts.update(nodegen.get_nodes_puppetdb(nodegen.capitalise_title(puppet_class)))
+                    puppetdb_titles.append(nodegen.capitalise_title(puppet_class))
                 elif host_list_part.startswith("cumin:"):
                     query = host_list_part[6:]
                     hosts.update(nodegen.get_nodes_cumin(query))
@@ -151,20 +214,64 @@ class Controller:
                     # Use our self as a simple wmcs host
                     hosts.add(socket.getfqdn())
                     # User one of the sretest hosts for production
-                    hosts.update(nodegen.get_nodes_puppetdb_class("Profile::Sretest"))
+                    puppetdb_titles.append(nodegen.class_title("Profile::Sretest"))
+                elif host_list_part == "provenance":
+                    derived.update(nodegen.get_nodes_provenance(self.config, self.change_id))
                 elif host_list_part == "auto":
                     gerrit_node_finder = nodegen.GerritNodeFinder(self.change_id, "gerrit.wikimedia.org", self.config)
-                    hosts.update(gerrit_node_finder.run_hosts)
+                    derived.update(gerrit_node_finder.run_hosts)
                 else:
                     hosts.add(host_list_part)
+            if puppetdb_titles:
+                derived.update(nodegen.get_nodes_puppetdb_many(puppetdb_titles))
         # remove empty strings added by trailing commas
         hosts.discard("")
+        derived -= hosts
 
-        if not hosts:
+        if not hosts and not derived:
             raise ControllerNoHostsError
+        if self.config.cluster_representatives > 0 and derived:
+            derived = self.pick_representatives(derived)
+        hosts |= derived
         self.cloud_hosts = {h for h in hosts if h.endswith(self.cloud_domains)}
         self.prod_hosts = hosts - self.cloud_hosts
 
+    def pick_representatives(self, hosts: Set[str]) -> Set[str]:
+        """Reduce the hosts to a few representatives of each group of similar hosts
+
+        Arguments:
+            hosts: the hosts selected from the change or from PuppetDB
+
+        Returns:
+            set: the hosts to compile
+
+        """
+        facts_index = utils.facts_index(self.config.puppet_var / "yaml")
+        facts_files = {}
+        for host in hosts:
+            facts_file = facts_index.facts_file(host)
+            if facts_file is not None:
+                facts_files[host] = facts_file
+        roles: Dict[str, str] = {}
+        classes: Dict[str, Set[str]] = {}
+        if self.config.storeconfigs:
+            try:
+                roles = puppetdb.client.roles()
+                classes = puppetdb.client.classes(hosts)
+            except requests.RequestException as error:
+                _log.warning("Unable to get the roles and classes from PuppetDB, compiling every host: %s", error)
+                return hosts
+        self.represented = clusters.representatives(
+            hosts,
+            facts_files,
+            [name.strip() for name in self.config.cluster_facts.split(",") if name.strip()],
+            classes,
+            roles,
+            self.config.cluster_representatives,
+            self.config.cluster_workers,
+        )
+        return set(self.represented)
+
     async def run(self) -> bool:
         """Perform the compilation run.
 
@@ -174,25 +281,79 @@ class Controller:
         _log.info("Refreshing the common repos from upstream if needed")
         # If using local filesystem repositories, we need to refresh them
         # before of a run.
-        _log.debug("refreshing %s", self.config.puppet_src)
-        self.managecode.refresh(self.config.puppet_src)
-        _log.debug("refreshing %s", self.config.puppet_private)
-        self.managecode.refresh(self.config.puppet_private)
-        _log.debug("refreshing %s", self.config.puppet_netbox)
-        self.managecode.refresh(self.config.puppet_netbox)
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *(
+                loop.run_in_executor(None, self.managecode.refresh, gitdir)
+                for gitdir in [self.config.puppet_src, self.config.puppet_private, self.config.puppet_netbox]
+            )
+        )
 
         _log.info("Creating directories under %s", self.config.base)
         self.managecode.prepare()
 
-        results = await self.run_hosts(self.prod_hosts, "production")
-        results.extend(await self.run_hosts(self.cloud_hosts, "wmcs-eqiad1"))
+        await self.refresh_facts(self.prod_hosts.union(self.cloud_hosts))
 
-        index = self.generate_summary(
-            states_col=self.get_states(hosts=self.prod_hosts.union(self.cloud_hosts), results=results)
+        self.states = StatesCollection()
+        for hostname in self.prod_hosts.union(self.cloud_hosts):
+            self.states.update(self.result_to_state(hostname=hostname))
+        history = CompileHistory(self.config.cache_dir / "compile_history.sqlite")
+        results = await self.run_hosts(
+            {"production": self.prod_hosts, "wmcs-eqiad1": self.cloud_hosts},
+            history.estimates(self.prod_hosts.union(self.cloud_hosts)),
+        )
+        history.record(
+            {
+                result.hostname: result.duration
+                for result in results
+                if isinstance(result, worker.RunHostResult) and result.duration is not None
+            }
         )
+        ProvenanceIndex(provenance.index_path(self.config)).record(
+            {
+                result.hostname: result.sources
+                for result in results
+                if isinstance(result, worker.RunHostResult) and result.sources is not None
+            }
+        )
+
+        index = self.generate_summary(states_col=self.states)
         _log.info("Run finished; see your results at %s", index)
         return self.has_failures(results)
 
+    async def refresh_facts(self, hosts: Iterable[str]) -> None:
+        """Refresh the expiration of the facts of the hosts before compiling them
+
+        The files are refreshed in a pool of threads, files that are still
+        valid for longer than any compilation could take are left alone.
+
+        Arguments:
+            hosts: the hosts to refresh the facts of
+
+        """
+        loop = asyncio.get_running_loop()
+        min_validity = timedelta(hours=12)
+        # Resolve all the files before refreshing any, as refreshing modifies the facts directories
+        facts_files = []
+        for hostname in hosts:
+            try:
+                facts_files.append(utils.facts_file(self.config.puppet_var, hostname))
+            except utils.FactsFileNotFound:
+                continue
+        with ThreadPoolExecutor(max_workers=self.config.facts_refresh_workers) as executor:
+            futures = [
+                loop.run_in_executor(executor, utils.refresh_yaml_date, facts_file, min_validity)
+                for facts_file in facts_files
+            ]
+            results = await asyncio.gather(*futures, return_exceptions=True)
+        refreshed = 0
+        for result in results:
+            if isinstance(result, Exception):
+                _log.warning("Unable to refresh facts: %s", result)
+            elif result:
+                refreshed += 1
+        _log.info("Refreshed the facts of %d hosts (%d still valid)", refreshed, len(results) - refreshed)
+
     def index_url(self, index: Index) -> str:
         """Return the index url"""
         if self.config.http_url.startswith("/"):
@@ -200,28 +361,117 @@ class Controller:
 
         return f"{self.config.http_url}/{self.change_id}/{html.job_id}/{index.url}"
 
-    async def run_hosts(self, hosts: Set[str], realm: str) -> List[RunTaskResult]:
+    async def run_hosts(
+        self, realm_hosts: Dict[str, Set[str]], estimates: Optional[Dict[str, float]] = None
+    ) -> List[RunTaskResult]:
         """Run  the compilation on a set of hosts
 
+        The hosts of all the realms are compiled at the same time, sharing
+        the same pool of workers. Hosts are started longest first, according
+        to their estimated compilation duration, so that the slowest hosts
+        don't end up running alone at the end of the run.
+
         Arguments:
-            hosts: The hosts to run the compilation on
-            realm: The realm (wmcs-eqiad1 or production) to work on
+            realm_hosts: The hosts to run the compilation on, by realm (wmcs-eqiad1 or production)
+            estimates: The estimated compilation duration of the hosts, in seconds
 
         """
-        if not hosts:
-            return []
-
-        self.managecode.update_config(realm)
-        _log.info("Starting run (%s)", realm)
-        semaphore = asyncio.Semaphore(self.config.pool_size)
+        limiter = self.get_limiter()
+        compiler_pool = None
+        if self.config.compile_backend == "pool":
+            # Keep at most as many idle processes as the compilations that can run at the same time
+            compiler_pool = CompilerPool(max_compiles=self.config.compile_pool_max_compiles, max_idle=limiter.max_limit)
+        catalog_cache = self.get_catalog_cache()
+        diff_executor = None
+        # The processes of the diff stage report their pid once started
+        diff_pids_queue = None
+        diff_pids: Set[int] = set()
+        if self.config.diff_workers > 0:
+            # Forking this process, which runs threads, could leave locks held in the children
+            mp_context = multiprocessing.get_context("forkserver")
+            diff_pids_queue = mp_context.SimpleQueue()
+            diff_executor = ProcessPoolExecutor(
+                max_workers=self.config.diff_workers,
+                mp_context=mp_context,
+                initializer=worker.setup_diff_process,
+                initargs=(self.config.base, self.change_id, self.job_id, _log.getEffectiveLevel(), diff_pids_queue),
+            )
+        # When compiling both environments of a host in parallel, the number
+        # of puppet processes is bound by the compile slots rather than by the
+        # number of hosts being worked on.
+        compile_slots = None
+        host_slots = limiter
+        if self.config.parallel_compile:
+            compile_slots = limiter
+            host_slots = AdaptiveLimiter(limiter.max_limit, limiter.max_limit, limiter.max_limit)
+        queue: List[Tuple[str, str]] = []
+        for realm, hosts in realm_hosts.items():
+            if not hosts:
+                continue
+            self.managecode.update_config(realm)
+            _log.info("Starting run (%s)", realm)
+            queue.extend((realm, host) for host in hosts)
+        if estimates is not None:
+            queue.sort(key=lambda item: estimates.get(item[1], 0.0), reverse=True)
+
+        # The limiters wake up their waiters in FIFO order, the tasks get
+        # to compile in the order they are created.
         tasks: List[asyncio.Task] = []
-        for host in hosts:
-            host_worker = worker.HostWorker(self.config.puppet_var, host)
-            tasks.append(asyncio.create_task(with_semaphore(semaphore, host_worker.run_host)()))
+        for realm, host in queue:
+            host_worker = worker.HostWorker(
+                self.config.puppet_var,
+                host,
+                realm=realm,
+                compile_slots=compile_slots,
+                compiler_pool=compiler_pool,
+                catalog_cache=catalog_cache,
+                diff_executor=diff_executor,
+            )
+            tasks.append(asyncio.create_task(with_limiter(host_slots, host_worker.run_host)()))
 
-        results = await self.wait_for_tasks(hosts=hosts, tasks=tasks, fail_fast=self.config.fail_fast)
-        self.generate_summary(states_col=self.get_states(hosts=hosts, results=results))
-        return results
+        monitor = None
+        if self.config.adaptive_pool:
+
+            def idle_pids() -> List[int]:
+                # Only the memory of the running compilations is relevant
+                pids = compiler_pool.idle_pids() if compiler_pool is not None else []
+                while diff_pids_queue is not None and not diff_pids_queue.empty():
+                    diff_pids.add(diff_pids_queue.get())
+                return pids + sorted(diff_pids)
+
+            monitor = asyncio.create_task(limiter.monitor(exclude=idle_pids))
+        try:
+            return await self.wait_for_tasks(tasks=tasks, fail_fast=self.config.fail_fast)
+        finally:
+            if monitor is not None:
+                monitor.cancel()
+            if compiler_pool is not None:
+                await compiler_pool.close()
+            if catalog_cache is not None:
+                catalog_cache.evict()
+            if diff_executor is not None:
+                diff_executor.shutdown()
+
+    def get_catalog_cache(self) -> Optional[CatalogCache]:
+        """Return the catalog cache, None if disabled"""
+        if not self.config.catalog_cache:
+            return None
+        return CatalogCache(
+            self.config.cache_dir / "catalogs",
+            {
+                "prod": self.managecode.tree_hashes(self.managecode.prod_dir),
+                "change": self.managecode.tree_hashes(self.managecode.change_dir),
+            },
+            max_size=self.config.catalog_cache_size_mb << 20,
+            ttl=self.config.catalog_cache_ttl,
+        )
+
+    def get_limiter(self) -> AdaptiveLimiter:
+        """Return the limiter bounding the number of concurrent compilations"""
+        if not self.config.adaptive_pool:
+            return AdaptiveLimiter(self.config.pool_size, self.config.pool_size, self.config.pool_size)
+        max_limit = self.config.pool_size_max or os.cpu_count() or self.config.pool_size
+        return AdaptiveLimiter(self.config.pool_size, self.config.pool_size_min, max_limit)
 
     @staticmethod
     def task_failed(result: RunTaskResult) -> bool:
@@ -231,66 +481,71 @@ class Controller:
     def has_failures(cls, results: Iterable[RunTaskResult]) -> bool:
         return any(cls.task_failed(res) for res in results)
 
-    async def wait_for_tasks(
-        self, hosts: Iterable[str], tasks: List[asyncio.Task], fail_fast: bool = False
-    ) -> List[RunTaskResult]:
-        results: List[RunTaskResult] = [None] * len(tasks)
+    async def wait_for_tasks(self, tasks: List[asyncio.Task], fail_fast: bool = False) -> List[RunTaskResult]:
+        """Collect the results of the tasks as soon as each of them completes.
 
-        last_results_len = len([res for res in results if res is not None])
-        some_pending = True
-        while some_pending:
-            for index, task in enumerate(tasks):
-                # give a chance to switch to another async task
-                await asyncio.sleep(0.1)
-                if results[index] is not None:
-                    continue
+        Completion is notified through the tasks done callbacks, so every
+        finished task is handled in constant time and without polling. The
+        state of each completed host is recorded in self.states and the
+        summary pages are refreshed at a limited rate.
 
-                if task.done():
-                    try:
-                        results[index] = task.result()
+        Arguments:
+            tasks: the tasks to wait for, one per host
+            fail_fast: if True, cancel all the pending tasks on the first failure
 
-                    except Exception as error:
-                        results[index] = error
+        Returns:
+            The list of results, in the same order as the tasks. Tasks that did
+            not complete (cancelled by fail_fast) have a None result.
 
-            some_pending = any(res is None for res in results)
-            if fail_fast and self.has_failures(results):
+        """
+        results: List[RunTaskResult] = [None] * len(tasks)
+        summary = SummaryRenderer(
+            render=lambda: self.generate_summary(states_col=self.states, partial=True),
+            interval=self.config.summary_interval,
+            batch=self.config.summary_batch,
+        )
+        indexes = {task: index for index, task in enumerate(tasks)}
+        completed: "asyncio.Queue[asyncio.Task]" = asyncio.Queue()
+        for task in tasks:
+            task.add_done_callback(completed.put_nowait)
+
+        for _ in range(len(tasks)):
+            task = await completed.get()
+            index = indexes[task]
+            if task.cancelled():
+                continue
+            try:
+                result = task.result()
+            except Exception as error:
+                results[index] = error
+                # TODO: we should catch theses earlier and create a proper RunHostResult
+                _log.critical("Unexpected error running run_host: %s", error)
+            else:
+                results[index] = result
+                if result is not None:
+                    self.states.update(self.result_to_state(hostname=result.hostname, result=result))
+
+            if fail_fast and self.task_failed(results[index]):
                 _log.error(
                     "A task failed, will cancel all the pending ones (--fail-fast was passed): %s",
-                    next(res for res in results if self.task_failed(res)),
+                    results[index],
                 )
-                for task in tasks:
-                    if not task.done():
-                        _log.debug("Cancelling task %s", str(task))
-                        task.cancel()
+                for pending_task in tasks:
+                    if not pending_task.done():
+                        _log.debug("Cancelling task %s", str(pending_task))
+                        pending_task.cancel()
 
+                summary.flush()
                 return results
 
-            cur_results_len = len([res for res in results if res is not None])
-            if cur_results_len != last_results_len:
-                last_results_len = cur_results_len
-                self.generate_summary(states_col=self.get_states(hosts=hosts, results=results), partial=True)
+            summary.completed()
 
+        summary.flush()
         return results
 
-    def get_states(self, hosts: Iterable[str], results: List[RunTaskResult]) -> StatesCollection:
-        states_col = StatesCollection()
-        completed = set()
-        for result in results:
-            if result is None:
-                continue
-            # TODO: we should catch theses earlier and create a proper RunHostResult
-            if isinstance(result, Exception):
-                _log.critical("Unexpected error running run_host: %s", result)
-                continue
-            states_col.add(self.result_to_state(hostname=result.hostname, result=result))
-            completed.add(result.hostname)
-        for hostname in set(hosts) - completed:
-            states_col.add(self.result_to_state(hostname=hostname))
-        return states_col
-
     def generate_summary(self, states_col: StatesCollection, partial: bool = False) -> str:
-        index = Index(outdir=self.outdir, hosts_raw=self.hosts_raw)
-        build_json = json.Build(outdir=self.outdir, hosts_raw=self.hosts_raw)
+        index = Index(outdir=self.outdir, hosts_raw=self.hosts_raw, represented=self.represented)
+        build_json = json.Build(outdir=self.outdir, hosts_raw=self.hosts_raw, represented=self.represented)
 
         index.render(states_col, partial=partial)
         build_json.render(states_col)
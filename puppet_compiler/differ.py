@@ -90,6 +90,8 @@ class PuppetResource:
         self.resource_type = data["type"]
         self.title = data["title"]
         self.exported = data["exported"]
+        # The manifest declaring the resource, when known
+        self.file: Optional[str] = data.get("file")
         self._init_params(data.get("parameters", {}))
 
     def _init_params(self, kwargs: Dict):
@@ -195,6 +197,11 @@ class PuppetCatalog:
     def all_resources(self) -> Set:
         return set(self.resources.keys())
 
+    @property
+    def source_files(self) -> Set[str]:
+        """The manifests declaring the resources of the catalog"""
+        return {res.file for res in self.resources.values() if res.file is not None}
+
     @property
     def core_resources(self) -> Set:
         return {k for k, v in self.resources.items() if v.core_type}
@@ -23,6 +23,17 @@ class FHS:
         cls.diff_dir = cls.base_dir / "diffs"
         cls.output_dir = base_dir / "output" / str(change_id) / str(job_id)
 
+    @staticmethod
+    def confdir(basedir: Path, realm: str) -> Path:
+        """Return the puppet confdir of a realm
+
+        Arguments:
+            basedir: The compile directory, either prod_dir or change_dir
+            realm: The realm the configuration is generated for
+
+        """
+        return basedir / "conf" / realm
+
 
 class HostFiles:
     """Class to manage host files"""
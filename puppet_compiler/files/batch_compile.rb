@@ -0,0 +1,57 @@
+#!/usr/bin/env ruby
+# frozen_string_literal: true
+
+# Compile the catalogs of many nodes in a single, long-lived, puppet process.
+#
+# This is used by puppet_compiler.compiler_pool to avoid paying the ruby and
+# puppet boot time, and the parsing of the manifests, for every catalog.
+#
+# The puppet settings are passed on the command line, the same way they are
+# passed to `puppet catalog compile`. Then a request per line is read from
+# stdin, as a JSON object:
+#
+#   {"node": "host.example.org", "catalog": "/path/to/catalog", "errors": "/path/to/errors"}
+#
+# The rich_data_json catalog is written to the "catalog" file, whatever puppet
+# logs while compiling to the "errors" file, and a JSON object is written back
+# on stdout once done:
+#
+#   {"node": "host.example.org", "status": 0}
+#
+# where status is the exit code `puppet catalog compile` would have had: 0 if
+# the catalog compiled, 1 otherwise.
+require 'json'
+require 'puppet'
+
+protocol = $stdout.dup
+protocol.sync = true
+# Whatever puppet prints on stdout would break the protocol
+$stdout.reopen(File::NULL, 'w')
+
+Puppet.settings.preferred_run_mode = Puppet.version.to_i >= 7 ? :server : :master
+Puppet.initialize_settings(ARGV)
+# Keep the parsed environment around between the compilations
+Puppet[:environment_timeout] = 'unlimited'
+Puppet::Util::Log.newdestination(:console)
+Puppet.push_context(Puppet.base_context(Puppet.settings), 'Batch catalog compilation')
+Puppet::Resource::Catalog.indirection.terminus_class = :compiler
+formatter = Puppet::Network::FormatHandler.format(:rich_data_json)
+
+$stdin.each_line do |line|
+  request = JSON.parse(line)
+  status = 0
+  $stderr.reopen(request['errors'], 'w')
+  begin
+    node = Puppet::Node.indirection.find(request['node'])
+    facts = Puppet::Node::Facts.indirection.find(request['node'])
+    node.merge(facts.values) if facts
+    catalog = Puppet::Resource::Catalog.indirection.find(request['node'], use_node: node)
+    File.write(request['catalog'], formatter.render(catalog))
+  rescue StandardError, ScriptError => e
+    Puppet.log_exception(e)
+    File.write(request['catalog'], '')
+    status = 1
+  end
+  $stderr.flush
+  protocol.puts(JSON.generate('node' => request['node'], 'status' => status))
+end
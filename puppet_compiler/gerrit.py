@@ -0,0 +1,65 @@
+"""Client for the Gerrit REST API"""
+import json
+from typing import Any, Dict
+
+import requests
+
+from puppet_compiler import _log
+
+
+class GerritClient:
+    """Gerrit REST API client, sharing one connection pool across the job.
+
+    Responses are cached by URL for the lifetime of the client, the URLs
+    either pin a revision or are expected to be stable during a job.
+
+    Arguments:
+        base_url: the url of the Gerrit instance
+
+    """
+
+    def __init__(self, base_url: str = "https://gerrit.wikimedia.org/r") -> None:
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.headers.update({"Accept": "application/json"})
+        self._cache: Dict[str, Any] = {}
+
+    def get(self, url: str) -> Any:
+        """Return the decoded json response of an API endpoint
+
+        Arguments:
+            url: the endpoint, either absolute or relative to base_url
+
+        """
+        if not url.startswith(("http://", "https://")):
+            url = f"{self.base_url}/{url.lstrip('/')}"
+        if url not in self._cache:
+            _log.debug("fetch gerrit blob: %s", url)
+            response = self.session.get(url)
+            response.raise_for_status()
+            # To prevent against Cross Site Script Inclusion (XSSI) attacks, the JSON response
+            # body starts with a magic prefix line: `)]}'` that must be stripped before feeding the
+            # rest of the response body to a JSON
+            # https://gerrit-review.googlesource.com/Documentation/rest-api.html#output
+            text = response.text
+            if text.startswith(")]}'"):
+                text = text.split("\n", 1)[1]
+            self._cache[url] = json.loads(text)
+        return self._cache[url]
+
+    def change(self, change_id: int) -> Dict:
+        """Return the details of a change, including its current revision
+
+        Arguments:
+            change_id: the change number
+
+        """
+        return self.get(f"changes/{change_id}?o=CURRENT_REVISION")
+
+    def clear(self) -> None:
+        """Forget the cached responses"""
+        self._cache.clear()
+
+
+# The client shared by the whole process
+client = GerritClient()
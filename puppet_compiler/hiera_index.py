@@ -0,0 +1,287 @@
+"""Index of the hiera data files each host reads, used to select the hosts a hieradata change affects"""
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+import yaml
+
+from puppet_compiler import _log, utils
+from puppet_compiler.config import ControllerConfig
+
+INTERPOLATION_RE = re.compile(r"%\{([^}]*)\}")
+# The keys setting the backend of a hierarchy level
+BACKEND_KEYS = ("data_hash", "lookup_key", "data_dig")
+
+
+def variable_name(expression: str) -> str:
+    """Return the name of the variable of an interpolation, facts.site and ::site both being site"""
+    name = expression.strip().lstrip(":")
+    if name.startswith("facts."):
+        name = name.split(".", 1)[1]
+    return name
+
+
+def hierarchy_paths(hiera_config: Dict) -> List[str]:
+    """Return the path templates of a hiera 5 hierarchy that live in the operations/puppet repository
+
+    The datadirs are mapped to the repository the same way ManageCode._copy_hiera
+    does, the levels of the private and netbox-hiera repositories are skipped.
+    The paths of the levels using a lookup_key backend, e.g. wmflib::expand_path,
+    are directories the backend reads the files of, they match any file below.
+
+    Arguments:
+        hiera_config: the parsed hiera.yaml of a realm
+
+    Returns:
+        list: the templates, relative to the root of the repository, e.g. hieradata/hosts/%{trusted.certname}.yaml
+
+    """
+    defaults = hiera_config.get("defaults") or {}
+    templates: List[str] = []
+    for level in hiera_config.get("hierarchy") or []:
+        datadir = str(level.get("datadir", defaults.get("datadir", "")))
+        if not datadir.startswith("/etc/puppet/") or datadir.startswith(("/etc/puppet/private", "/etc/puppet/netbox")):
+            continue
+        repo_dir = datadir.split("/etc/puppet/", 1)[1].strip("/")
+        paths = [level[key] for key in ("path", "glob") if key in level]
+        for key in ("paths", "globs"):
+            paths.extend(level.get(key) or [])
+        backends = [key for key in BACKEND_KEYS if key in level] or [key for key in BACKEND_KEYS if key in defaults]
+        if "lookup_key" in backends:
+            templates.extend(f"{repo_dir}/{str(path).rstrip('/')}/*" for path in paths)
+        else:
+            templates.extend(f"{repo_dir}/{path}" for path in paths)
+    return templates
+
+
+def _fact(values: Dict, name: str) -> Optional[str]:
+    """Return a fact, following the dots into structured facts, None if missing or not a scalar"""
+    value: object = values
+    for part in name.split("."):
+        if not isinstance(value, dict) or part not in value:
+            return None
+        value = value[part]
+    if isinstance(value, (dict, list)) or value is None:
+        return None
+    return str(value).lower() if isinstance(value, bool) else str(value)
+
+
+def host_variables(facts_file: Path, names: Iterable[str]) -> Dict[str, str]:
+    """Return the values of the variables of a host found in its facts
+
+    Arguments:
+        facts_file: the facts file of the host
+        names: the variables to look up, as returned by variable_name
+
+    """
+    yaml.add_multi_constructor("!ruby/object:", utils.construct_ruby_object, Loader=utils.YamlLoader)
+    data = yaml.load(facts_file.read_text(), Loader=utils.YamlLoader) or {}
+    values = data.get("values") or {}
+    variables = {}
+    for name in names:
+        if name == "trusted.certname":
+            value = data.get("name") or facts_file.name[: -len(".yaml")]
+        else:
+            value = _fact(values, name)
+        if value is not None:
+            variables[name] = value
+    return variables
+
+
+def resolve(template: str, variables: Dict[str, str]) -> str:
+    """Return the glob pattern of the files a path template can read for a host
+
+    Variables missing from the facts, e.g. the ones set by the manifests, can
+    take any value and become wildcards.
+
+    Arguments:
+        template: the path template
+        variables: the values of the variables of the host
+
+    """
+
+    def substitute(match) -> str:
+        value = variables.get(variable_name(match.group(1)))
+        return "*" if value is None else glob.escape(value)
+
+    return INTERPOLATION_RE.sub(substitute, template)
+
+
+class HieraIndex:
+    """Which hiera data files of operations/puppet each host of a realm reads.
+
+    The paths of the hierarchy of the realm are resolved with the facts of
+    every host, and the extra variables passed to update, e.g. the _role set
+    by the role() function. The facts files are parsed in parallel, and only
+    the hosts whose facts or extra variables changed since the previous
+    update are resolved again, the rest comes from the cache file.
+
+    Arguments:
+        hierarchy: the path templates of the hierarchy, as returned by hierarchy_paths
+        path: the cache file
+
+    """
+
+    def __init__(self, hierarchy: List[str], path: Path) -> None:
+        self.hierarchy = hierarchy
+        self.path = path
+        self.hierarchy_key = hashlib.sha256(json.dumps(hierarchy).encode()).hexdigest()
+        self.hosts: Dict[str, Dict] = {}
+        try:
+            data = json.loads(path.read_text())
+            if data["hierarchy"] == self.hierarchy_key:
+                self.hosts = data["hosts"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    @classmethod
+    def for_realm(cls, puppet_src: Path, realm: str, cache_dir: Path) -> "HieraIndex":
+        """Return the index of the hierarchy of a realm
+
+        Arguments:
+            puppet_src: the operations/puppet checkout
+            realm: the realm, e.g. production
+            cache_dir: the directory to keep the cache file in
+
+        """
+        hiera_file = puppet_src / "modules" / "puppetmaster" / "files" / "hiera" / f"{realm}.yaml"
+        hierarchy = hierarchy_paths(yaml.safe_load(hiera_file.read_text()) or {})
+        return cls(hierarchy, cache_dir / f"hiera_index_{realm}.json")
+
+    def update(
+        self, facts_files: Dict[str, Path], extra: Optional[Dict[str, Dict[str, str]]] = None, max_workers: int = 4
+    ) -> None:
+        """Resolve the hierarchy for the hosts, and save the index
+
+        Arguments:
+            facts_files: the facts file of each host, the hosts missing from it are dropped
+            extra: extra variables, by host
+            max_workers: the number of processes parsing the facts files
+
+        """
+        extra = extra or {}
+        names = sorted(
+            {variable_name(expr) for template in self.hierarchy for expr in INTERPOLATION_RE.findall(template)}
+        )
+        stale = {}
+        signatures = {}
+        for host, facts_file in facts_files.items():
+            entry = self.hosts.get(host, {})
+            try:
+                stat = facts_file.stat()
+                signature = [stat.st_mtime_ns, stat.st_size]
+                # Only hash the facts files modified since the previous update. Refreshing them
+                # changes their mtime, but not their digest, so the hosts are kept then.
+                if entry.get("stat") == signature:
+                    digest = entry["key"][0]
+                else:
+                    digest = utils.facts_digest(facts_file)
+            except OSError:
+                continue
+            key = [digest, extra.get(host, {})]
+            if entry.get("key") != key:
+                stale[host] = key
+            signatures[host] = signature
+        self.hosts = {
+            host: dict(entry, stat=signatures[host])
+            for host, entry in self.hosts.items()
+            if host in signatures and host not in stale
+        }
+        if stale:
+            _log.info("Resolving the hiera hierarchy of %d hosts", len(stale))
+            hosts = sorted(stale)
+            with ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = executor.map(
+                    host_variables, [facts_files[host] for host in hosts], [names] * len(hosts), chunksize=16
+                )
+                for host, variables in zip(hosts, results):
+                    variables.update(extra.get(host, {}))
+                    self.hosts[host] = {
+                        "key": stale[host],
+                        "stat": signatures[host],
+                        "paths": [resolve(template, variables) for template in self.hierarchy],
+                    }
+        self.save()
+
+    def save(self) -> None:
+        """Write the index to the cache file, atomically"""
+        try:
+            self.path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=".")
+            with os.fdopen(tmp_fd, "w") as tmp_file:
+                json.dump({"hierarchy": self.hierarchy_key, "hosts": self.hosts}, tmp_file, separators=(",", ":"))
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, self.path)
+        except OSError as error:
+            _log.warning("Unable to save the hiera index to %s: %s", self.path, error)
+
+    def hosts_reading(self, changed: Iterable[str]) -> Set[str]:
+        """Return the hosts reading any of the files
+
+        Arguments:
+            changed: the files, relative to the root of the repository
+
+        """
+        changed = set(changed)
+        hosts = set()
+        for host, entry in self.hosts.items():
+            for pattern in entry["paths"]:
+                if any(fnmatch.fnmatchcase(path, pattern) for path in changed):
+                    hosts.add(host)
+                    break
+        return hosts
+
+    def representatives(self, hosts: Iterable[str]) -> Set[str]:
+        """Reduce hosts to one per hostname prefix and set of hiera files read
+
+        The files specific to a host, i.e. the ones whose name contains the
+        hostname, are not considered, the same way deduplicated_nodes
+        considers the hostname without its digits.
+
+        Arguments:
+            hosts: the hosts to reduce
+
+        """
+        representatives: Dict[str, str] = {}
+        for host in sorted(hosts):
+            paths = [path for path in self.hosts[host]["paths"] if host.split(".")[0] not in path]
+            key = "{}:{}".format(re.split(r"\d", host, 1)[0], "|".join(paths))
+            representatives.setdefault(key, host)
+        return set(representatives.values())
+
+
+def select_hosts(config: ControllerConfig, changed: Iterable[str], roles: Optional[Dict[str, str]] = None) -> Set[str]:
+    """Return a minimal set of hosts reading the hieradata files changed
+
+    Arguments:
+        config: the controller config
+        changed: the hieradata files changed, relative to the root of the repository
+        roles: the role of each host, e.g. mediawiki::appserver, exposed to the hierarchy as _role
+
+    """
+    changed = set(changed)
+    facts_index = utils.facts_index(config.puppet_var / "yaml")
+    realm_hosts: Dict[str, Dict[str, Path]] = {"production": {}, "wmcs-eqiad1": {}}
+    for host in facts_index.nodes():
+        facts_file = facts_index.facts_file(host)
+        if facts_file is None:
+            continue
+        # The same split as Controller.cloud_domains
+        realm = "wmcs-eqiad1" if host.endswith((".wmflabs", ".wikimedia.cloud")) else "production"
+        realm_hosts[realm][host] = facts_file
+    extra = {host: {"_role": role.replace("::", "/")} for host, role in (roles or {}).items()}
+    hosts: Set[str] = set()
+    for realm, facts_files in realm_hosts.items():
+        if not facts_files:
+            continue
+        index = HieraIndex.for_realm(config.puppet_src, realm, config.cache_dir)
+        index.update(facts_files, extra, config.hiera_index_workers)
+        hosts.update(index.representatives(index.hosts_reading(changed)))
+    return hosts
@@ -0,0 +1,82 @@
+"""Keep track of how long compiling each host took in previous runs"""
+import sqlite3
+import statistics
+import time
+from pathlib import Path
+from typing import Dict, Iterable
+
+from puppet_compiler import _log
+
+
+class CompileHistory:
+    """Per host compilation durations, stored in a sqlite database.
+
+    The database is shared by all the jobs running on the same machine, the
+    duration stored for a host is a moving average of the last runs.
+
+    Arguments:
+        path: the path of the sqlite database
+        default: the estimate, in seconds, for hosts with no history when
+                 there is no history at all
+
+    """
+
+    # Weight of the latest duration in the moving average
+    smoothing = 0.5
+
+    def __init__(self, path: Path, default: float = 60.0):
+        self.path = path
+        self.default = default
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS durations (hostname TEXT PRIMARY KEY, duration REAL, updated REAL)")
+        return conn
+
+    def estimates(self, hosts: Iterable[str]) -> Dict[str, float]:
+        """Return the estimated compilation duration of the hosts
+
+        Hosts without history get the median duration of all the known hosts.
+
+        Arguments:
+            hosts: the hosts to estimate the duration for
+
+        Returns:
+            dict: the estimated duration in seconds, by hostname
+
+        """
+        try:
+            conn = self._connect()
+            with conn:
+                known = dict(conn.execute("SELECT hostname, duration FROM durations").fetchall())
+            conn.close()
+        except (sqlite3.Error, OSError) as error:
+            _log.warning("Unable to read the compile history from %s: %s", self.path, error)
+            known = {}
+
+        default = statistics.median(known.values()) if known else self.default
+        return {host: known.get(host, default) for host in hosts}
+
+    def record(self, durations: Dict[str, float]) -> None:
+        """Record the compilation durations of a run
+
+        Arguments:
+            durations: the duration in seconds, by hostname
+
+        """
+        if not durations:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            with conn:
+                for hostname, duration in durations.items():
+                    conn.execute(
+                        "INSERT INTO durations VALUES (?, ?, ?) ON CONFLICT(hostname) DO UPDATE SET "
+                        "duration = ? * excluded.duration + (1 - ?) * duration, updated = excluded.updated",
+                        (hostname, duration, now, self.smoothing, self.smoothing),
+                    )
+            conn.close()
+        except (sqlite3.Error, OSError) as error:
+            _log.warning("Unable to record the compile history to %s: %s", self.path, error)
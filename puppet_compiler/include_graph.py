@@ -0,0 +1,219 @@
+"""Reverse dependency index of the puppet modules, used to select the hosts a change affects"""
+import json
+import os
+import re
+import subprocess
+import tempfile
+from collections import deque
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set
+
+from puppet_compiler import _log
+from puppet_compiler.config import ControllerConfig
+
+# The references a manifest makes, the names are matched lower case
+NAME = r"(?:::)?[a-z]\w*(?:::[a-z]\w*)*"
+INCLUDE_RE = re.compile(rf"\b(?:include|require|contain)\s+((?:['\"]?{NAME}['\"]?\s*,\s*)*['\"]?{NAME}['\"]?)")
+CLASS_RE = re.compile(rf"\bclass\s*\{{\s*['\"]({NAME})['\"]\s*:")
+RESOURCE_RE = re.compile(r"(?<![\w:$])((?:::)?[a-z]\w*(?:::[a-z]\w*)+)\s*\{")
+FUNCTION_RE = re.compile(rf"(?<![\w:$.])({NAME})\s*\(")
+TEMPLATE_RE = re.compile(r"\b(?:template|epp)\s*\(\s*['\"]([^'\"$]+)['\"]")
+FILE_RE = re.compile(r"\bfile\s*\(\s*['\"]([^'\"$]+)['\"]")
+SOURCE_RE = re.compile(r"puppet:///modules/([^'\"\s$]+)")
+COMMENT_RE = re.compile(r"^\s*#.*$", re.MULTILINE)
+
+
+def node_for_path(path: str) -> Optional[str]:
+    """Return the node of the graph a file of the operations/puppet repository defines
+
+    Arguments:
+        path: the path of the file, relative to the root of the repository
+
+    Returns:
+        str: the class or defined type name, or function:<name>, template:<module>/<path>,
+             file:<module>/<path>. None for the files outside of the graph.
+
+    """
+    parts = path.split("/")
+    if len(parts) < 4 or parts[0] != "modules":
+        return None
+    module, kind, rest = parts[1], parts[2], parts[3:]
+    if kind == "manifests" and path.endswith(".pp"):
+        rest[-1] = rest[-1][: -len(".pp")]
+        return module if rest == ["init"] else "::".join([module, *rest])
+    if kind == "functions" and path.endswith(".pp"):
+        rest[-1] = rest[-1][: -len(".pp")]
+        return "function:" + "::".join([module, *rest])
+    if kind == "templates":
+        return f"template:{module}/{'/'.join(rest)}"
+    if kind == "files":
+        return f"file:{module}/{'/'.join(rest)}"
+    if kind == "lib" and path.endswith(".rb") and rest[:2] == ["puppet", "functions"]:
+        return "function:" + "::".join(rest[2:])[: -len(".rb")]
+    if kind == "lib" and path.endswith(".rb") and rest[:3] == ["puppet", "parser", "functions"]:
+        return "function:" + rest[-1][: -len(".rb")]
+    return None
+
+
+def references(manifest: str) -> List[str]:
+    """Return the nodes of the graph a manifest refers to
+
+    Arguments:
+        manifest: the content of the manifest
+
+    """
+    manifest = COMMENT_RE.sub("", manifest)
+    names: Set[str] = set()
+    for match in INCLUDE_RE.finditer(manifest):
+        names.update(name.strip(" '\"") for name in match.group(1).split(","))
+    names.update(CLASS_RE.findall(manifest))
+    names.update(RESOURCE_RE.findall(manifest))
+    refs = {name.lstrip(":").lower() for name in names}
+    refs.update("function:" + name.lstrip(":") for name in FUNCTION_RE.findall(manifest))
+    refs.update("template:" + name for name in TEMPLATE_RE.findall(manifest))
+    refs.update("file:" + name for name in FILE_RE.findall(manifest))
+    refs.update("file:" + name for name in SOURCE_RE.findall(manifest))
+    return sorted(refs)
+
+
+class IncludeGraph:
+    """Which roles and profiles reach each class, defined type, template, file and function.
+
+    The graph is built from the manifests of an operations/puppet checkout,
+    by looking at the classes they include, the defined types they declare
+    and the functions, templates and files they use.
+
+    The references of each manifest are stored in cache_file by git blob
+    hash, so that only the manifests changed since the previous build get
+    parsed again. The graph is reused as is as long as the tree hash of the
+    modules doesn't change.
+
+    Arguments:
+        tree: the git tree hash of the modules directory
+        manifests: the references of each manifest, by path
+        blobs: the git blob hash of each manifest, by path
+
+    """
+
+    def __init__(self, tree: str, manifests: Dict[str, List[str]], blobs: Dict[str, str]) -> None:
+        self.tree = tree
+        self.manifests = manifests
+        self.blobs = blobs
+        self.referrers: Dict[str, Set[str]] = {}
+        for path, refs in manifests.items():
+            node = node_for_path(path)
+            if node is None:
+                continue
+            for ref in refs:
+                self.referrers.setdefault(ref, set()).add(node)
+
+    def reached_by(self, node: str) -> Set[str]:
+        """Return the roles and profiles that reach a node, including the node itself
+
+        Arguments:
+            node: the node, as returned by node_for_path
+
+        """
+        seen = {node}
+        queue = deque([node])
+        while queue:
+            for referrer in self.referrers.get(queue.popleft(), ()):
+                if referrer not in seen:
+                    seen.add(referrer)
+                    queue.append(referrer)
+        return {name for name in seen if name.startswith(("role::", "profile::"))}
+
+    def roles(self, paths: Iterable[str]) -> Dict[str, Set[str]]:
+        """Return the roles reaching each of the files
+
+        Arguments:
+            paths: the files, relative to the root of the repository
+
+        Returns:
+            dict: the roles, by path. Files outside of the graph are omitted.
+
+        """
+        result = {}
+        for path in paths:
+            node = node_for_path(path)
+            if node is not None:
+                result[path] = {name for name in self.reached_by(node) if name.startswith("role::")}
+        return result
+
+    def save(self, path: Path) -> None:
+        """Write the graph to the cache file, atomically
+
+        Arguments:
+            path: the cache file
+
+        """
+        data = {
+            "tree": self.tree,
+            "blobs": self.blobs,
+            "references": {self.blobs[manifest]: refs for manifest, refs in self.manifests.items()},
+        }
+        path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".")
+        with os.fdopen(tmp_fd, "w") as tmp_file:
+            json.dump(data, tmp_file, separators=(",", ":"))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def build(cls, repo: Path, cache_file: Path) -> "IncludeGraph":
+        """Build the graph of the checked out revision of a repository, reusing the cache
+
+        Arguments:
+            repo: the operations/puppet checkout
+            cache_file: the file the graph is cached in
+
+        """
+        tree = subprocess.check_output(["git", "rev-parse", "HEAD:modules"], cwd=repo, text=True).strip()
+        try:
+            cached = json.loads(cache_file.read_text())
+        except (OSError, ValueError):
+            cached = {"tree": None, "blobs": {}, "references": {}}
+        cached_refs: Dict[str, List[str]] = cached["references"]
+        if cached["tree"] == tree:
+            return cls(tree, {path: cached_refs[blob] for path, blob in cached["blobs"].items()}, cached["blobs"])
+
+        blobs = {}
+        listing = subprocess.check_output(["git", "ls-tree", "-r", "HEAD", "modules"], cwd=repo, text=True)
+        for line in listing.splitlines():
+            meta, path = line.split("\t", 1)
+            _, obj_type, blob = meta.split()
+            if obj_type == "blob" and path.endswith(".pp") and node_for_path(path) is not None:
+                blobs[path] = blob
+        missing = sorted({blob for blob in blobs.values() if blob not in cached_refs})
+        _log.info("Parsing %d of the %d manifests for the include graph", len(missing), len(blobs))
+        parsed = dict(zip(missing, (references(content) for content in cls._read_blobs(repo, missing))))
+        manifests = {path: parsed[blob] if blob in parsed else cached_refs[blob] for path, blob in blobs.items()}
+        graph = cls(tree, manifests, blobs)
+        try:
+            graph.save(cache_file)
+        except OSError as error:
+            _log.warning("Unable to cache the include graph to %s: %s", cache_file, error)
+        return graph
+
+    @staticmethod
+    def _read_blobs(repo: Path, blobs: List[str]) -> List[str]:
+        """Read the content of git blobs, all at once"""
+        if not blobs:
+            return []
+        output = subprocess.run(
+            ["git", "cat-file", "--batch"], cwd=repo, input="\n".join(blobs).encode(), capture_output=True, check=True
+        ).stdout
+        contents = []
+        pos = 0
+        for _ in blobs:
+            start = output.index(b"\n", pos) + 1
+            end = start + int(output[pos:start].split()[2])
+            contents.append(output[start:end].decode(errors="replace"))
+            # Skip the newline following the content
+            pos = end + 1
+        return contents
+
+
+def cache_path(config: ControllerConfig) -> Path:
+    """Return the path of the cache file used by the jobs"""
+    return config.cache_dir / "include_graph.json"
@@ -0,0 +1,190 @@
+"""Limit the number of concurrent compilations"""
+import asyncio
+import os
+from collections import deque
+from pathlib import Path
+from typing import Callable, Deque, Iterable, Optional, Set
+
+from puppet_compiler import _log
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def load_per_cpu() -> float:
+    """Return the 1 minute load average, divided by the number of cpus"""
+    return os.getloadavg()[0] / (os.cpu_count() or 1)
+
+
+def memory_available(meminfo: Path = Path("/proc/meminfo")) -> Optional[int]:
+    """Return the memory available for new processes, in bytes, None if unknown"""
+    try:
+        for line in meminfo.read_text().splitlines():
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def children_rss(pid: int, proc: Path = Path("/proc"), exclude: Iterable[int] = ()) -> int:
+    """Return the resident memory of all the descendants of a process, in bytes
+
+    Arguments:
+        pid: the process whose descendants to account for
+        proc: the proc filesystem mountpoint
+        exclude: the descendants to leave out, along with their own descendants
+
+    """
+    rss = 0
+    seen: Set[int] = set(exclude)
+    pending = [pid]
+    while pending:
+        parent = pending.pop()
+        try:
+            tasks = list((proc / str(parent) / "task").iterdir())
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                children = [int(child) for child in (task / "children").read_text().split()]
+            except (OSError, ValueError):
+                continue
+            for child in children:
+                if child in seen:
+                    continue
+                seen.add(child)
+                pending.append(child)
+                try:
+                    rss += int((proc / str(child) / "statm").read_text().split()[1]) * PAGE_SIZE
+                except (OSError, ValueError, IndexError):
+                    pass
+    return rss
+
+
+class AdaptiveLimiter:
+    """Asynchronous context manager bounding the number of concurrent compilations.
+
+    It works like an asyncio.Semaphore whose value can be changed while in
+    use, waking up the waiters in FIFO order. When monitoring, the limit is
+    periodically raised or lowered between min_limit and max_limit according
+    to the load average, the available memory and the memory used by the
+    running puppet processes.
+
+    Arguments:
+        limit: the initial number of concurrent compilations
+        min_limit: the lowest limit when adapting
+        max_limit: the highest limit when adapting
+        high_load: lower the limit when the load per cpu is above this
+        low_load: raise the limit only when the load per cpu is below this
+
+    """
+
+    def __init__(
+        self, limit: int, min_limit: int, max_limit: int, high_load: float = 1.0, low_load: float = 0.7
+    ) -> None:
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.high_load = high_load
+        self.low_load = low_load
+        self._limit = min(max(limit, self.min_limit), self.max_limit)
+        self.active = 0
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._rss_per_compile: Optional[float] = None
+
+    @property
+    def limit(self) -> int:
+        """The current number of allowed concurrent compilations"""
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int) -> None:
+        self._limit = min(max(value, self.min_limit), self.max_limit)
+        self._wake_up()
+
+    def _wake_up(self) -> None:
+        while self._waiters and self.active < self._limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    async def __aenter__(self) -> None:
+        if self.active < self._limit and not self._waiters:
+            self.active += 1
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We got the slot right when being cancelled, give it back
+                self.active -= 1
+                self._wake_up()
+            raise
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.active -= 1
+        self._wake_up()
+
+    def adjust(self, load: float, mem_available: Optional[int], rss: int) -> int:
+        """Adapt the limit to the resources usage
+
+        Arguments:
+            load: the load average per cpu
+            mem_available: the available memory in bytes, None if unknown
+            rss: the memory used by the running compilations, in bytes
+
+        Returns:
+            int: the new limit
+
+        """
+        if self.active and rss:
+            self._rss_per_compile = rss / self.active
+        needed = self._rss_per_compile or 0
+        saturated = bool(self._waiters) or self.active >= self._limit
+
+        if mem_available is not None and mem_available < needed:
+            reason = f"available memory ({mem_available >> 20}MiB) would not fit another compilation"
+            new_limit = self._limit - 1
+        elif load > self.high_load:
+            reason = f"load per cpu ({load:.2f}) above {self.high_load}"
+            new_limit = self._limit - 1
+        elif saturated and load < self.low_load and (mem_available is None or mem_available > 2 * needed):
+            reason = f"load per cpu ({load:.2f}) below {self.low_load} and enough memory available"
+            new_limit = self._limit + 1
+        else:
+            return self._limit
+
+        old_limit = self._limit
+        self.limit = new_limit
+        if self._limit != old_limit:
+            _log.info(
+                "Changing the number of concurrent compilations from %d to %d: %s (%d running, %dMiB used)",
+                old_limit,
+                self._limit,
+                reason,
+                self.active,
+                rss >> 20,
+            )
+        return self._limit
+
+    async def monitor(self, interval: float = 10.0, exclude: Optional[Callable[[], Iterable[int]]] = None) -> None:
+        """Adapt the limit every interval seconds, until cancelled
+
+        Arguments:
+            interval: the number of seconds between two adjustments
+            exclude: return the child processes not running a compilation, e.g. the
+                idle warm compilers, whose memory is not accounted for
+
+        """
+        _log.info(
+            "Adapting the number of concurrent compilations between %d and %d, starting at %d",
+            self.min_limit,
+            self.max_limit,
+            self._limit,
+        )
+        while True:
+            await asyncio.sleep(interval)
+            excluded = exclude() if exclude is not None else ()
+            self.adjust(load_per_cpu(), memory_available(), children_rss(os.getpid(), exclude=excluded))
@@ -1,19 +1,18 @@
 """Class for generating nod lists of nodes"""
+import hashlib
 import json
+import os
 import re
+import subprocess
+import tempfile
 from pathlib import Path
-from typing import Iterable, Optional, Pattern, Set, Tuple
+from typing import Dict, Iterable, List, Optional, Pattern, Set, Tuple
 
-import urllib3  # type: ignore
 from cumin.query import Query  # type: ignore
-from requests import get
 
-from puppet_compiler import _log
+from puppet_compiler import _log, gerrit, hiera_index, include_graph, provenance, puppetdb, utils
 from puppet_compiler.config import ControllerConfig
 
-# TODO: have the CA as a config option
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
-
 
 def get_type_and_title(path: Path) -> Tuple[str, Optional[str]]:
     """Open a file and determin of its type.
@@ -54,7 +53,7 @@ def get_nodes(config: ControllerConfig) -> Set:
     _log.info("Walking dir %s", facts_dir)
     site_pp = config.puppet_src / "manifests" / "site.pp"
     # Read site.pp
-    node_finder = NodeFinder(site_pp)
+    node_finder = NodeFinder(site_pp, config.cache_dir / "sitepp")
     return node_finder.match_physical_nodes(nodelist(facts_dir))
 
 
@@ -93,8 +92,19 @@ def capitalise_title(title: str):
 
 def get_nodes_puppetdb_class(title: str, deduplicate: bool = True) -> Set:
     """Get nodes for a specific class."""
-    title = "Class/" + capitalise_title(title)
-    return get_nodes_puppetdb(title, deduplicate)
+    return get_nodes_puppetdb(class_title(title), deduplicate)
+
+
+def class_title(title: str) -> str:
+    """Return the PuppetDB resource title of a class
+
+    Arguments:
+        title: the class name
+
+    Returns:
+        str: the resource title, e.g. Class/Role::Grafana
+    """
+    return "Class/" + capitalise_title(title)
 
 
 def get_nodes_puppetdb(title: str, deduplicate: bool = True) -> Set:
@@ -108,19 +118,35 @@ def get_nodes_puppetdb(title: str, deduplicate: bool = True) -> Set:
         set: a set of hosts to work on
 
     """
-    params = {"query": '["extract",["certname","tags"]]'}
-    # TODO: don't hardcode puppetdb
-    uri = "https://localhost/pdb/query/v4/resources/{}".format(title)
-    nodes_json = get(uri, params=params, verify=False).json()
-    if not nodes_json:
-        _log.warning("no nodes found for class: %s", title)
-        return set()
-    if deduplicate:
-        return deduplicated_nodes(nodes_json)
-    return nodes_json
-
-
-def deduplicated_nodes(nodes: Set):
+    return get_nodes_puppetdb_many([title], deduplicate)
+
+
+def get_nodes_puppetdb_many(titles: Iterable[str], deduplicate: bool = True) -> Set:
+    """Return a set of nodes which have any of the resources applied
+
+    The PuppetDB queries run concurrently.
+
+    Arguments:
+        titles: The resource titles to search for
+        deduplicate: run the de-dupo function on the results of each title
+
+    Returns
+        set: a set of hosts to work on
+
+    """
+    nodes = set()
+    for title, nodes_json in puppetdb.client.resources_many(titles).items():
+        if not nodes_json:
+            _log.warning("no nodes found for class: %s", title)
+            continue
+        if deduplicate:
+            nodes.update(deduplicated_nodes(nodes_json))
+        else:
+            nodes.update(node["certname"] for node in nodes_json)
+    return nodes
+
+
+def deduplicated_nodes(nodes: Iterable[Dict]) -> Set:
     """De-Duplicate a set of nodes.
 
     We try to reduce the set of nodes down so that we dont test nodes
@@ -137,6 +163,24 @@ def deduplicated_nodes(nodes: Set):
     return set(_deduplicated_nodes.values())
 
 
+def get_nodes_provenance(config: ControllerConfig, change_number: int) -> Set:
+    """Get the nodes whose last compiled catalogs depend on the files a change touches
+
+    Arguments:
+        config: the controller config
+        change_number: the gerrit change
+
+    Returns
+        set: a set of hosts to work on
+
+    """
+    changed_files = GerritNodeFinder(change_number, "gerrit.wikimedia.org", config).changed_files
+    nodes = provenance.ProvenanceIndex(provenance.index_path(config)).hosts_for(changed_files)
+    if not nodes:
+        _log.warning("no nodes found depending on: %s", ", ".join(changed_files))
+    return nodes
+
+
 def get_nodes_cumin(query_str: str) -> Set:
     """Get a list of nodes using a raw cumin query.
 
@@ -161,9 +205,7 @@ def nodelist(facts_dir: Path) -> Iterable[str]:
     Yields:
         The node name, i.e. the file path with basename with the extension removed
     """
-    for node in facts_dir.glob("**/*.yaml"):
-        _log.debug("testing node:  %s", node.stem)
-        yield node.stem
+    yield from utils.facts_index(facts_dir).nodes()
 
 
 def get_gerrit_blob(url):
@@ -175,14 +217,7 @@ def get_gerrit_blob(url):
     Returns
         dict: A dictionary representing the json blob returned by gerrit
     """
-
-    _log.debug("fetch gerrit blob: %s", url)
-    req = get(url, json={})
-    # To prevent against Cross Site Script Inclusion (XSSI) attacks, the JSON response
-    # body starts with a magic prefix line: `)]}'` that must be stripped before feeding the
-    # rest of the response body to a JSON
-    # https://gerrit-review.googlesource.com/Documentation/rest-api.html#output
-    return json.loads(req.text.split("\n", 1)[1])
+    return gerrit.client.get(url)
 
 
 class GerritNodeFinder:
@@ -228,49 +263,190 @@ class GerritNodeFinder:
         """returns true if the site.pp file has been updated"""
         return bool("manifests/site.pp" in self.changed_files)
 
+    @property
+    def include_graph(self) -> Optional[include_graph.IncludeGraph]:
+        """Return the include graph of the puppet repository, None if disabled or unavailable"""
+        if not self._config.auto_include_graph:
+            return None
+        try:
+            return include_graph.IncludeGraph.build(self._config.puppet_src, include_graph.cache_path(self._config))
+        except (OSError, subprocess.CalledProcessError) as error:
+            _log.warning("Unable to build the include graph of %s: %s", self._config.puppet_src, error)
+            return None
+
     @property
     def run_hosts(self):
         """Return a unique list of hosts this change should run on"""
         if self._run_hosts is None:
-            run_hosts = []
+            titles = []
+            graph = self.include_graph
+            roles = graph.roles(self.changed_files) if graph is not None else {}
+            for changed, changed_roles in sorted(roles.items()):
+                _log.debug("Collecting hosts for: %s - %s", changed, ", ".join(sorted(changed_roles)))
+                titles.extend(class_title(role) for role in sorted(changed_roles))
             for puppet_file in self.changed_manifest_files:
+                if roles.get(puppet_file):
+                    # Already covered by the roles reaching it
+                    continue
                 puppet_type, title = get_type_and_title(self._config.puppet_src / puppet_file)
                 if title is None:
                     continue
                 _log.debug("Collecting hosts for: %s - %s", puppet_type, title)
                 if puppet_type == "class":
-                    run_hosts.extend(get_nodes_puppetdb_class(title, False))
+                    titles.append(class_title(title))
                     continue
                 if puppet_type == "define":
-                    run_hosts.extend(get_nodes_puppetdb(capitalise_title(title), False))
-            self._run_hosts = deduplicated_nodes(run_hosts)
+                    titles.append(capitalise_title(title))
+            self._run_hosts = deduplicated_nodes(puppetdb.client.resources_batch(titles)) if titles else set()
+            if self._config.auto_hiera_index and self.changed_hieradata:
+                roles = puppetdb.client.roles() if self._config.storeconfigs else {}
+                self._run_hosts.update(hiera_index.select_hosts(self._config, self.changed_hieradata, roles))
         return self._run_hosts
 
 
+LITERAL_RE = re.compile(r"(?:[\w\-]|\\\.)")
+
+
+def literal_prefix(pattern: str) -> str:
+    """Return the literal text every match of an anchored regex starts with
+
+    Arguments:
+        pattern: the regex
+
+    Returns:
+        str: the prefix, e.g. mw1 for ^mw1\\d{3}\\.eqiad\\.wmnet$. Empty when the
+             regex isn't anchored or starts with a special character.
+    """
+    if not pattern.startswith("^") or _top_level_alternation(pattern):
+        return ""
+    prefix = []
+    pos = 1
+    while True:
+        match = LITERAL_RE.match(pattern, pos)
+        if match is None:
+            break
+        pos = match.end()
+        if pattern.startswith(("?", "*", "+", "{"), pos):
+            # The last character is optional or repeated
+            break
+        prefix.append(match.group(0)[-1])
+    return "".join(prefix)
+
+
+def _top_level_alternation(pattern: str) -> bool:
+    """Whether a regex has alternatives outside of any group, e.g. ^a|b"""
+    depth = 0
+    in_class = False
+    escaped = False
+    for char in pattern:
+        if escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif in_class:
+            in_class = char != "]"
+        elif char == "[":
+            in_class = True
+        elif char == "(":
+            depth += 1
+        elif char == ")":
+            depth -= 1
+        elif char == "|" and depth == 0:
+            return True
+    return False
+
+
+class PrefixMatcher:
+    """Match names against many regexes at once.
+
+    The regexes are bucketed by their literal prefix, a name is only tried
+    against the regexes of the buckets it starts with, so that the cost of
+    matching a name doesn't grow with the number of regexes.
+
+    Arguments:
+        regexes: the regexes to match against
+    """
+
+    def __init__(self, regexes: Iterable[Pattern]) -> None:
+        self.prefixes: Dict[Pattern, str] = {regex: literal_prefix(regex.pattern) for regex in regexes}
+        self.buckets: Dict[str, List[Pattern]] = {}
+        for regex, prefix in self.prefixes.items():
+            self.buckets.setdefault(prefix, []).append(regex)
+        self.lengths = sorted({len(prefix) for prefix in self.buckets})
+
+    def search(self, name: str) -> Optional[Pattern]:
+        """Return a regex matching the name, None if there are none"""
+        for length in self.lengths:
+            for regex in self.buckets.get(name[:length], ()):
+                if regex.search(name):
+                    return regex
+        return None
+
+    def discard(self, regex: Pattern) -> None:
+        """Stop matching against a regex"""
+        self.buckets[self.prefixes.pop(regex)].remove(regex)
+
+
 # pylint: disable=too-few-public-methods
 class NodeFinder:
-    """Get a list of nodes based on site.pp"""
+    """Get a list of nodes based on site.pp
+
+    Arguments:
+        sitepp: the site.pp file
+        cache_dir: if passed, keep the regexes and the nodes of each site.pp
+            parsed in this directory, keyed by the hash of its content
+
+    """
 
     regexp_node = re.compile(r"^node\s+/([^/]+)/")
     exact_node = re.compile(r"node\s*\'([^\']+)\'")
 
-    def __init__(self, sitepp: Path) -> None:
-        self.regexes: Set[Pattern] = set()
-        self.nodes: Set[str] = set()
-        for line in sitepp.read_text().splitlines():
-            match = self.regexp_node.search(line)
+    def __init__(self, sitepp: Path, cache_dir: Optional[Path] = None) -> None:
+        regexes, nodes = self._parse(sitepp, cache_dir)
+        self.regexes: Set[Pattern] = {re.compile(regex) for regex in regexes}
+        self.nodes: Set[str] = set(nodes)
+
+    @classmethod
+    def _parse(cls, sitepp: Path, cache_dir: Optional[Path]) -> Tuple[List[str], List[str]]:
+        """Return the regexes and the nodes of site.pp, parsing it only if it isn't in the cache"""
+        content = sitepp.read_bytes()
+        cache_file = None
+        if cache_dir is not None:
+            cache_file = cache_dir / f"{hashlib.sha256(content).hexdigest()}.json"
+            try:
+                cached = json.loads(cache_file.read_text())
+                return cached["regexes"], cached["nodes"]
+            except (OSError, ValueError, KeyError):
+                pass
+        regexes: List[str] = []
+        nodes: List[str] = []
+        for line in content.decode().splitlines():
+            match = cls.regexp_node.search(line)
             if match:
                 _log.debug("Found regex in line %s", line.rstrip())
-                self.regexes.add(re.compile(match.group(1)))
+                regexes.append(match.group(1))
                 continue
-            match = self.exact_node.search(line)
+            match = cls.exact_node.search(line)
             if match:
                 _log.debug("Found node in line %s", line.rstrip())
-                self.nodes.add(match.group(1))
+                nodes.append(match.group(1))
+        if cache_file is not None:
+            try:
+                cache_file.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+                tmp_fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, prefix=".")
+                with os.fdopen(tmp_fd, "w") as tmp_file:
+                    json.dump({"regexes": regexes, "nodes": nodes}, tmp_file)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, cache_file)
+            except OSError as error:
+                _log.warning("Unable to cache the parsed site.pp to %s: %s", cache_file, error)
+        return regexes, nodes
 
     def match_physical_nodes(self, node_list: Iterable[str]) -> Set[str]:
         """Match a set of nodes against the list found locally
 
+        Each regex of site.pp selects the first node it matches.
+
         Arguments:
             node_list (list): a list of nodes to search for
 
@@ -278,22 +454,18 @@ class NodeFinder:
             list: a list of matching nodes
         """
         nodes: Set[str] = set()
+        matcher = PrefixMatcher(self.regexes)
         for node in node_list:
-            discarded = None
             if node in self.nodes:
                 _log.debug("Found node %s", node)
                 nodes.add(node)
                 self.nodes.discard(node)
                 continue
-            for regex in self.regexes:
-                match = regex.search(node)
-                if match:
-                    _log.debug("Found match for node %s: %s", node, regex.pattern)
-                    nodes.add(node)
-                    discarded = regex
-                    continue
-
-            if discarded is not None:
-                self.regexes.discard(discarded)
+            regex = matcher.search(node)
+            if regex is not None:
+                _log.debug("Found match for node %s: %s", node, regex.pattern)
+                nodes.add(node)
+                matcher.discard(regex)
+                self.regexes.discard(regex)
 
         return nodes
@@ -1,15 +1,20 @@
 #!/usr/bin/python3
 """Tool used to populate the puppetdb with some node data"""
 
+import json
 import logging
+import os
 import shutil
 import tempfile
+import time
 from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Dict, List, Optional
 
 import yaml
 
-from puppet_compiler import config, directories, nodegen, prepare, puppet, utils
+from puppet_compiler import _log, config, directories, nodegen, prepare, puppet, puppetdb, utils
 
 
 def get_args() -> Namespace:
@@ -28,35 +33,167 @@ def get_args() -> Namespace:
     )
     parser.add_argument("--debug", action="store_true", default=False, help="Print debug output")
     parser.add_argument("--host", help="if present only populate the DB for this host")
+    parser.add_argument(
+        "--export-index",
+        type=Path,
+        help="if present, export the offline index used for selecting hosts to this file once done",
+    )
+    parser.add_argument("--workers", type=int, default=4, help="The number of nodes to compile at the same time")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        default=False,
+        help="skip the nodes whose facts and code didn't change since they were last populated",
+    )
+    parser.add_argument(
+        "--state-file",
+        type=Path,
+        help="The state file of the incremental mode, defaults to populate_state.json in the base dir",
+    )
     return parser.parse_args()
 
 
-def populate_node(node: str, cfg: config.ControllerConfig, debug: bool) -> None:
+def populate_node(node: str, cfg: config.ControllerConfig, debug: bool, realm: Optional[str] = None) -> bool:
     """Populate puppetdb for this specific node
 
+    The output is printed at once, so that the output of the nodes compiled
+    at the same time doesn't interleave.
+
     Arguments:
         node: The node to work on
         config: a dictionary representing the config
         debug: if to enable debug output
+        realm: the realm whose confdir to compile the node with
 
-    """
-    print("=" * 80)
-    print("Compiling catalog for {}".format(node))
+    Returns:
+        bool: True if the catalog was stored in puppetdb
 
+    """
+    lines = ["=" * 80, "Compiling catalog for {}".format(node)]
     try:
         utils.refresh_yaml_date(utils.facts_file(cfg.puppet_var, node))
     except utils.FactsFileNotFound as error:
-        print("ERROR: {}".format(error))
-        return
-    succ, out, err = puppet.compile_storeconfigs(node, cfg.puppet_var)
+        lines.append("ERROR: {}".format(error))
+        print("\n".join(lines))
+        return False
+    succ, out, err = puppet.compile_storeconfigs(node, cfg.puppet_var, realm=realm)
     if succ:
-        print("OK")
+        lines.append("OK")
     else:
-        for line in err:
-            print(line)
+        lines.extend(line.decode(errors="replace").rstrip("\n") for line in err)
         if debug:
-            for line in out:
-                print(line)
+            lines.extend(line.decode(errors="replace").rstrip("\n") for line in out)
+    print("\n".join(lines))
+    return succ
+
+
+def load_state(state_file: Path) -> Dict[str, Dict[str, str]]:
+    """Load the state of the incremental mode, empty if missing or unreadable
+
+    Arguments:
+        state_file: the state file
+
+    Returns:
+        dict: the facts digest and code revision of the last successful populate, by node
+
+    """
+    try:
+        return json.loads(state_file.read_text())
+    except (OSError, ValueError) as error:
+        _log.info("Starting with an empty state, unable to load %s: %s", state_file, error)
+        return {}
+
+
+def save_state(state_file: Path, state: Dict[str, Dict[str, str]]) -> None:
+    """Write the state of the incremental mode, atomically
+
+    Arguments:
+        state_file: the state file
+        state: the state, as returned by load_state
+
+    """
+    try:
+        state_file.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=state_file.parent, prefix=".")
+        with os.fdopen(tmp_fd, "w") as tmp_file:
+            json.dump(state, tmp_file, sort_keys=True, separators=(",", ":"))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, state_file)
+    except OSError as error:
+        _log.warning("Unable to save the state to %s: %s", state_file, error)
+
+
+def populate_nodes(
+    nodes: Dict[str, str],
+    cfg: config.ControllerConfig,
+    debug: bool,
+    workers: int,
+    state: Optional[Dict[str, Dict[str, str]]] = None,
+    revision: str = "",
+    state_file: Optional[Path] = None,
+) -> Dict[str, int]:
+    """Populate puppetdb for the nodes, compiling workers of them at the same time
+
+    In incremental mode, i.e. when state is passed, the nodes whose facts and
+    code revision are the same as the last time they were populated
+    successfully are skipped. The state is updated as the nodes are populated,
+    and saved to state_file every now and then.
+
+    Arguments:
+        nodes: the nodes to work on, with the realm of each of them
+        cfg: the controller config
+        debug: if to enable debug output
+        workers: the number of nodes to compile at the same time
+        state: the state of the incremental mode, as returned by load_state
+        revision: the revision of the code the nodes are compiled with
+        state_file: the file to save the state to
+
+    Returns:
+        dict: the number of nodes populated, failed and skipped
+
+    """
+    summary = {"ok": 0, "failed": 0, "skipped": 0}
+    entries: Dict[str, Dict[str, str]] = {}
+    to_populate: List[str] = []
+    for node in sorted(nodes):
+        if state is not None:
+            try:
+                entries[node] = {
+                    "facts": utils.facts_digest(utils.facts_file(cfg.puppet_var, node)),
+                    "revision": revision,
+                }
+            except utils.FactsFileNotFound:
+                pass
+            else:
+                if state.get(node) == entries[node]:
+                    summary["skipped"] += 1
+                    continue
+        to_populate.append(node)
+
+    total = len(to_populate)
+    step = max(1, min(100, total // 20))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(populate_node, node, cfg, debug, nodes[node]): node for node in to_populate}
+        for done, future in enumerate(as_completed(futures), start=1):
+            node = futures[future]
+            try:
+                success = future.result()
+            except Exception:  # pylint: disable=broad-except
+                _log.exception("Unexpected error while populating %s", node)
+                success = False
+            if success:
+                summary["ok"] += 1
+                if state is not None and node in entries:
+                    state[node] = entries[node]
+            else:
+                summary["failed"] += 1
+                if state is not None:
+                    state.pop(node, None)
+            if done % step == 0 or done == total:
+                _log.info("Populated %d/%d nodes, %d failed", done, total, summary["failed"])
+                if state is not None and state_file is not None:
+                    save_state(state_file, state)
+    return summary
 
 
 def setup_environment(tmpdir, cfg: config.ControllerConfig, jobid: int = 1) -> prepare.ManageCode:
@@ -79,6 +216,8 @@ def setup_environment(tmpdir, cfg: config.ControllerConfig, jobid: int = 1) -> p
     managecode._prepare_dir(managecode.prod_dir)  # pylint: disable=protected-access
     routes = {"master": {"facts": {"terminus": "yaml", "cache": "yaml"}}}
     (managecode.prod_dir / "src" / "routes.yaml").write_text(yaml.dump(routes))
+    for realm in ["production", "wmcs-eqiad1"]:
+        managecode.update_confdir(managecode.prod_dir, realm)
     return managecode
 
 
@@ -102,22 +241,29 @@ def main():
         puppet_private=args.basedir / "private",
         puppet_netbox=args.basedir / "netbox-hiera",
     )
+    start = time.monotonic()
     tmpdir = tempfile.mkdtemp(prefix="fill-puppetdb")
     managecode = setup_environment(tmpdir, cfg)
-    # Do the whole compilation in a dedicated directory.
-    nodes = set([args.host]) if args.host else nodegen.get_nodes(cfg)
-    cloud_nodes = set(n for n in nodes if n.endswith(("wikimedia.cloud", "wmflabs")))
-    prod_nodes = nodes - cloud_nodes
-    with prepare.pushd(managecode.prod_dir / "src"):
-        print(f"{30 * '#'} working on {len(prod_nodes)} prod nodes {30 * '#'}")
-        managecode._copy_hiera(managecode.prod_dir, "production")  # pylint: disable=protected-access
-        for node in prod_nodes:
-            populate_node(node, cfg, args.debug)
-        print(f"{30 * '#'} working on {len(cloud_nodes)} cloud nodes {30 * '#'}")
-        managecode._copy_hiera(managecode.prod_dir, "wmcs-eqiad1")  # pylint: disable=protected-access
-        for node in cloud_nodes:
-            populate_node(node, cfg, args.debug)
+    state_file = args.state_file or args.basedir / "populate_state.json"
+    state = load_state(state_file) if args.incremental else None
+    revision = ":".join(managecode.tree_hashes(managecode.prod_dir))
+    hosts = set([args.host]) if args.host else nodegen.get_nodes(cfg)
+    # Each realm has its own confdir, so the nodes of both realms are compiled together
+    nodes = {node: "wmcs-eqiad1" if node.endswith(("wikimedia.cloud", "wmflabs")) else "production" for node in hosts}
+    for realm in ["production", "wmcs-eqiad1"]:
+        count = sum(1 for node_realm in nodes.values() if node_realm == realm)
+        print(f"{30 * '#'} working on {count} {realm} nodes {30 * '#'}")
+    summary = populate_nodes(nodes, cfg, args.debug, args.workers, state, revision, state_file)
     shutil.rmtree(tmpdir)
+    if state is not None:
+        save_state(state_file, state)
+    print(
+        "Populated {ok} nodes, {failed} failed, {skipped} skipped as unchanged, in {duration:.0f} seconds".format(
+            duration=time.monotonic() - start, **summary
+        )
+    )
+    if args.export_index:
+        puppetdb.client.export_index(args.export_index)
 
 
 if __name__ == "__main__":
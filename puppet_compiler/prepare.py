@@ -1,15 +1,15 @@
 """Pepare the enironment"""
-import json
+import fcntl
 import os
 import shutil
 import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from pathlib import Path
-from typing import Optional
+from typing import Dict, List, Optional, Tuple
 
-import requests
-
-from puppet_compiler import _log
+from puppet_compiler import _log, gerrit, workspace_pool
 from puppet_compiler.config import ControllerConfig
 from puppet_compiler.directories import FHS
 
@@ -50,6 +50,10 @@ class ManageCode:
         self.change_private_id = change_private_id
         self.force = force
         self.storeconfigs = config.storeconfigs
+        self.shared_clones = config.shared_clones
+        self.refresh_ttl = config.refresh_ttl
+        self._change_refs: Dict[int, Tuple[str, str]] = {}
+        self.workspace_pool = workspace_pool.WorkspacePool.from_config(config) if config.workspace_pool_size else None
 
         self.change_dir = FHS.change_dir
         self.prod_dir = FHS.prod_dir
@@ -61,6 +65,9 @@ class ManageCode:
         _log.info("Cleaning up temporary directory %s", FHS.base_dir)
 
         """Remove the whole change tree."""
+        if self.workspace_pool is not None:
+            self.workspace_pool.recycle(self.prod_dir)
+            self.workspace_pool.recycle(self.change_dir)
         shutil.rmtree(self.base_dir, True)
 
     def prepare(self) -> None:
@@ -75,48 +82,101 @@ class ManageCode:
             shutil.rmtree(self.output_dir, True)
         self.base_dir.mkdir(mode=0o755)
         for dirname in [self.prod_dir, self.change_dir]:
+            self._prepare_workspace(dirname)
             (dirname / "catalogs").mkdir(mode=0o755, parents=True)
         self.diff_dir.mkdir(mode=0o755, parents=True)
         self.output_dir.mkdir(mode=0o755, parents=True)
 
-        # Production
-        self._prepare_dir(self.prod_dir)
-        self._prepare_dir(self.change_dir)
-        change_src = self.change_dir / "src"
-        with pushd(change_src):
-            self._fetch_change(self.change_id)
-        if self.change_private_id is not None:
-            with pushd(self.prod_dir / "private"):
-                self._fetch_change(self.change_private_id)
-            with pushd(self.change_dir / "private"):
-                self._fetch_change(self.change_private_id)
+        if self.workspace_pool is not None:
+            # The change workspace can't be reused by other jobs
+            self.workspace_pool.taint(self.change_dir)
+            if self.change_private_id is not None:
+                self.workspace_pool.taint(self.prod_dir)
+        # The public and private changes are independent, fetch them at the same time
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            futures = [executor.submit(self._fetch_change, self.change_id, self.change_dir / "src")]
+            if self.change_private_id is not None:
+                futures.append(executor.submit(self._fetch_private_change, self.change_private_id))
+            for future in futures:
+                future.result()
 
     def update_config(self, realm: str) -> None:
-        """update hiera and puppet config files
+        """Generate the hiera and puppet config files of a realm
+
+        Each realm gets its own confdir, an overlay of the src directory with
+        its own hiera.yaml and puppet.conf, so that the realms can be compiled
+        at the same time.
 
         Arguments:
-            realm: the realm to change to
+            realm: the realm to generate the configuration for
 
         """
-        prod_src = self.prod_dir / "src"
-        with pushd(prod_src):
-            self._copy_hiera(self.prod_dir, realm)
-            self._create_puppetconf(realm, self.storeconfigs)
+        for dirname in [self.prod_dir, self.change_dir]:
+            self.update_confdir(dirname, realm)
+
+    def update_confdir(self, dirname: Path, realm: str) -> None:
+        """Generate the confdir of a realm in a compile directory
 
-        change_src = self.change_dir / "src"
-        with pushd(change_src):
-            self._copy_hiera(self.change_dir, realm)
-            self._create_puppetconf(realm, self.storeconfigs)
+        Arguments:
+            dirname: the compile directory, either prod_dir or change_dir
+            realm: the realm to generate the configuration for
+
+        """
+        src = dirname / "src"
+        confdir = FHS.confdir(dirname, realm)
+        confdir.mkdir(mode=0o755, parents=True, exist_ok=True)
+        for entry in src.iterdir():
+            if entry.name in ["hiera.yaml", "puppet.conf"]:
+                continue
+            overlay = confdir / entry.name
+            if not overlay.is_symlink():
+                overlay.symlink_to(entry)
+        with pushd(src):
+            self._copy_hiera(dirname, realm, confdir)
+            self._create_puppetconf(realm, self.storeconfigs, confdir)
 
     def refresh(self, gitdir: Path) -> None:
         """Refresh a git repository.
 
+        The repositories are shared by all the jobs running on the machine, a
+        lock serializes the refreshes and the pull is skipped if the last one
+        happened less than refresh_ttl seconds ago. This doesn't change the
+        working directory, so that the repositories can be refreshed from
+        different threads.
+
         Arguments:
             gitdir: the directory to refresh
 
         """
-        with pushd(gitdir):
-            self.git.pull("-q", "--rebase")
+        gitdir = Path(gitdir)
+        stamp = gitdir / ".git" / "pcc-last-refresh"
+        with (gitdir / ".git" / "pcc-refresh.lock").open("w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                age = time.time() - stamp.stat().st_mtime
+            except FileNotFoundError:
+                age = None
+            if age is not None and age < self.refresh_ttl:
+                _log.debug("%s refreshed %d seconds ago, skipping", gitdir, age)
+                return
+            Git(gitdir).pull("-q", "--rebase")
+            stamp.touch()
+
+    @staticmethod
+    def tree_hashes(dirname: Path) -> List[str]:
+        """Return the hashes of the trees checked out in a compile directory
+
+        Arguments:
+            dirname: the compile directory, either prod_dir or change_dir
+
+        Returns:
+            list: the tree hashes of the src, private and netbox-hiera checkouts
+
+        """
+        return [
+            subprocess.check_output(["git", "rev-parse", "HEAD^{tree}"], cwd=dirname / repo, text=True).strip()
+            for repo in ["src", "private", "netbox-hiera"]
+        ]
 
     # Private methods
     def _prepare_dir(self, dirname: Path) -> None:
@@ -128,17 +188,13 @@ class ManageCode:
         """
         _log.debug("Cloning directories...")
         src = dirname / "src"
-        self.git.clone("-q", str(self.puppet_src), str(src))
+        self._clone(self.puppet_src, src)
         priv = dirname / "private"
-        self.git.clone("-q", str(self.puppet_private), str(priv))
+        self._clone(self.puppet_private, priv)
         netbox = dirname / "netbox-hiera"
-        self.git.clone("-q", str(self.puppet_netbox), str(netbox))
+        self._clone(self.puppet_netbox, netbox)
 
-        _log.debug("Adding symlinks")
-        for module in self.private_modules:
-            source = priv / "modules" / module
-            dst = src / "modules" / module
-            dst.symlink_to(source)
+        self._link_private_modules(dirname)
 
         shutil.copytree(self.puppet_var / "ssl", src / "ssl")
         # Puppetdb-related configs
@@ -151,13 +207,60 @@ class ManageCode:
             _log.debug("Copying the routes file")
             shutil.copy(routes_conf, src / "routes.yaml")
 
+    def _prepare_workspace(self, dirname: Path) -> None:
+        """Claim a workspace from the pool, or prepare a new one
+
+        Arguments
+            dirname: the directory to prepare
+
+        """
+        if self.workspace_pool is not None and self.workspace_pool.claim(dirname):
+            # The workspace has been moved, fix the absolute symlinks
+            self._link_private_modules(dirname)
+            return
+        dirname.mkdir(mode=0o755, parents=True, exist_ok=True)
+        self._prepare_dir(dirname)
+
+    def _link_private_modules(self, dirname: Path) -> None:
+        """Link the private modules in the src directory
+
+        Arguments
+            dirname: the directory holding the src and private checkouts
+
+        """
+        _log.debug("Adding symlinks")
+        for module in self.private_modules:
+            source = dirname / "private" / "modules" / module
+            dst = dirname / "src" / "modules" / module
+            if dst.is_symlink():
+                dst.unlink()
+            dst.symlink_to(source)
+
+    def _clone(self, source: Path, dest: Path) -> None:
+        """Clone a repository
+
+        When shared clones are enabled and the source is a local repository,
+        the clone borrows the objects of the source instead of copying them,
+        making it almost instant.
+
+        Arguments:
+            source: the repository to clone
+            dest: the directory to clone to
+
+        """
+        if self.shared_clones and Path(source).is_dir():
+            self.git.clone("-q", "--shared", str(source), str(dest))
+        else:
+            self.git.clone("-q", str(source), str(dest))
+
     @staticmethod
-    def _copy_hiera(dirname: Path, realm: str) -> None:
+    def _copy_hiera(dirname: Path, realm: str, confdir: Path = Path(".")) -> None:
         """Copy the realm specific hiera file to dirname.
 
         Arguments:
             dirname: the directory to copy to
             realm: The realm to use
+            confdir: The directory to write hiera.yaml into
 
         """
         hiera_file = Path(f"modules/puppetmaster/files/hiera/{realm}.yaml")
@@ -165,7 +268,7 @@ class ManageCode:
         priv = dirname / "private"
         netbox = dirname / "netbox-hiera"
         pub = dirname / "src"
-        with hiera_file.open() as f_in, Path("hiera.yaml").open("w") as f_out:
+        with hiera_file.open() as f_in, (confdir / "hiera.yaml").open("w") as f_out:
             for line in f_in:
                 data = (
                     line.replace("/etc/puppet/private", str(priv))
@@ -175,12 +278,13 @@ class ManageCode:
                 f_out.write(data)
 
     @staticmethod
-    def _create_puppetconf(realm: str, storeconfigs: bool = True) -> None:
+    def _create_puppetconf(realm: str, storeconfigs: bool = True, confdir: Path = Path(".")) -> None:
         """Copy the realm specific puppet conf file to dirname.
 
         Arguments:
             realm: The realm to use
             storeconfigs: Use puppetdb
+            confdir: The directory to write puppet.conf into
 
         """
         if realm == "wmcs-eqiad1":
@@ -204,44 +308,76 @@ storeconfigs_backend = puppetdb
         # calls to grab files, instead we use the file_server terminus
         # which resolves files locally
         config = config + "default_file_terminus = file_server\n"
-        Path("puppet.conf").write_text(config)
+        (confdir / "puppet.conf").write_text(config)
         _log.debug("Wrote puppet.conf with puppet-enc settings")
 
-    def _fetch_change(self, change_id: int) -> None:
-        """get changes from the change directly"""
-        headers = {"Accept": "application/json", "Content-Type": "application/json; charset=UTF-8"}
-        change = requests.get(
-            "https://gerrit.wikimedia.org/r/changes/%d?o=CURRENT_REVISION" % change_id, headers=headers
-        )
-        change.raise_for_status()
-
-        # Workaround the broken gerrit response...
-        json_data = change.text.split("\n")[-2:][0]
-        res = json.loads(json_data)
-        revision = list(res["revisions"].values())[0]["_number"]
-        project = res["project"]
-        ref = "refs/changes/%02d/%d/%d" % (change_id % 100, change_id, revision)
-        _log.debug("Downloading patch for project %s, change %d, revision %d", project, change_id, revision)
+    def _change_ref(self, change_id: int) -> Tuple[str, str]:
+        """Return the project and the ref of the current revision of a change
+
+        The Gerrit API is queried only once per change.
+
+        Arguments:
+            change_id: the change number
+
+        """
+        if change_id not in self._change_refs:
+            res = gerrit.client.change(change_id)
+            revision = list(res["revisions"].values())[0]["_number"]
+            ref = "refs/changes/%02d/%d/%d" % (change_id % 100, change_id, revision)
+            _log.debug("Downloading patch for project %s, change %d, revision %d", res["project"], change_id, revision)
+            self._change_refs[change_id] = (res["project"], ref)
+        return self._change_refs[change_id]
+
+    def _fetch_change(self, change_id: int, gitdir: Optional[Path] = None) -> None:
+        """get changes from the change directly
+
+        Arguments:
+            change_id: the change number
+            gitdir: the repository to apply the change to, the current directory if None
+
+        """
+        project, ref = self._change_ref(change_id)
+        git = self.git if gitdir is None else Git(gitdir)
 
         # Assumption:
         # Gerrit suported repo names and branches:
         # operations/puppet - origin/production
         if project == "operations/puppet":
-            self._checkout_gerrit_revision(project, ref)
-            self._pull_rebase_origin("production")
+            self._checkout_gerrit_revision(project, ref, git)
+            self._pull_rebase_origin("production", git)
         elif project == "labs/private":
-            self._checkout_gerrit_revision(project, ref)
-            self._pull_rebase_origin("master")
+            self._checkout_gerrit_revision(project, ref, git)
+            self._pull_rebase_origin("master", git)
         else:
             raise RuntimeError("Unsupported Gerrit project: " + project)
 
-    def _checkout_gerrit_revision(self, project: str, revision: str) -> None:
-        self.git.fetch("-q", f"https://gerrit.wikimedia.org/r/{project}", revision)
-        self.git.checkout("-B", revision, "FETCH_HEAD")
-        self.git.log("--oneline", "-n1")
+    def _fetch_private_change(self, change_id: int) -> None:
+        """Apply a labs/private change to both the change and production trees
+
+        The change is downloaded from Gerrit and rebased once, the production
+        tree gets the result from the change tree.
 
-    def _pull_rebase_origin(self, origin_branch: str) -> None:
-        self.git.pull("--rebase", "origin", origin_branch)
+        Arguments:
+            change_id: the change number
+
+        """
+        change_private = self.change_dir / "private"
+        self._fetch_change(change_id, change_private)
+        _, ref = self._change_ref(change_id)
+        git = Git(self.prod_dir / "private")
+        git.fetch("-q", str(change_private), "HEAD")
+        git.checkout("-B", ref, "FETCH_HEAD")
+        git.log("--oneline", "-n1")
+
+    @staticmethod
+    def _checkout_gerrit_revision(project: str, revision: str, git: "Git") -> None:
+        git.fetch("-q", f"https://gerrit.wikimedia.org/r/{project}", revision)
+        git.checkout("-B", revision, "FETCH_HEAD")
+        git.log("--oneline", "-n1")
+
+    @staticmethod
+    def _pull_rebase_origin(origin_branch: str, git: "Git") -> None:
+        git.pull("--rebase", "origin", origin_branch)
 
 
 # pylint: disable=too-few-public-methods
@@ -252,8 +388,14 @@ class Git:
     in instantiating it ever.
 
     Partly salvaged from utils/new_wmf_service
+
+    Arguments:
+        cwd: the repository to run the commands in, the current directory if None
     """
 
+    def __init__(self, cwd: Optional[Path] = None):
+        self.cwd = cwd
+
     def __getattr__(self, action):
         action = action.replace("_", "-")
 
@@ -263,12 +405,13 @@ class Git:
 
         return git_exec
 
-    @staticmethod
-    def _execute_command(command: str, *args):
+    def _execute_command(self, command: str, *args):
         cmd = ["git", command]
         cmd.extend(args)
         try:
-            return subprocess.check_call(cmd)
+            if self.cwd is None:
+                return subprocess.check_call(cmd)
+            return subprocess.check_call(cmd, cwd=self.cwd)
         except subprocess.CalledProcessError as error:
             _log.critical("`%s` failed: %s", " ".join(cmd), error)
             raise SystemExit(2) from error
@@ -1,7 +1,7 @@
 """Html templating module"""
 import os
 from pathlib import Path
-from typing import Any, Dict, Optional, Set
+from typing import Any, Dict, List, Optional, Set
 
 from jinja2 import Environment, PackageLoader
 
@@ -75,13 +75,14 @@ class Index:
         "fail": "have failed to compile completely",
     }
 
-    def __init__(self, outdir: Path, hosts_raw: str) -> None:
+    def __init__(self, outdir: Path, hosts_raw: str, represented: Optional[Dict[str, List[str]]] = None) -> None:
         if self.page_name == "index.html":
             self.url = ""
         else:
             self.url = self.page_name
         self.outfile = outdir / self.page_name
         self.hosts_raw = hosts_raw
+        self.represented = represented or {}
 
     def render(self, states_col: StatesCollection, partial: bool = False) -> None:
         """
@@ -105,6 +106,7 @@ class Index:
             chid=change_id,
             page_name=self.page_name,
             hosts_raw=self.hosts_raw,
+            represented={host: others for host, others in self.represented.items() if others},
             puppet_version=os.environ["PUPPET_VERSION_FULL"],
         )
         with open(self.outfile, "w") as outfile:
@@ -85,9 +85,10 @@ class Host:
 class Build:
     """Summary of the build as json"""
 
-    def __init__(self, outdir: Path, hosts_raw: str) -> None:
+    def __init__(self, outdir: Path, hosts_raw: str, represented: Optional[Dict[str, List[str]]] = None) -> None:
         self.outfile = outdir / "build.json"
         self.hosts_raw = hosts_raw
+        self.represented = represented or {}
 
     def render(self, states_col: StatesCollection) -> None:
         """
@@ -114,7 +115,9 @@ class Build:
                 "change_id": Optional[int],
                 "hosts": List[str],
                 "states": Dict[str, BuildState],
+                "represented": Dict[str, List[str]],
             },
+            total=False,
         )
 
         build: BuildDict = {}  # type: ignore
@@ -131,6 +134,10 @@ class Build:
                 "hosts": sorted(list(hosts_set)),
             }
 
+        if self.represented:
+            # The hosts compiled on behalf of others, see Controller.pick_representatives
+            build["represented"] = {host: sorted(others) for host, others in sorted(self.represented.items())}
+
         build_json = json.dumps(build, sort_keys=False)
         with open(self.outfile, "w") as outfile:
             outfile.write(build_json)
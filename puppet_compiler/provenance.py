@@ -0,0 +1,106 @@
+"""Keep track of the source files the catalog of each host is compiled from"""
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Set
+
+from puppet_compiler import _log
+from puppet_compiler.config import ControllerConfig
+
+
+def relative_source(path: str, roots: Iterable[Path]) -> Optional[str]:
+    """Return the path of a source file relative to the puppet checkout it was compiled from
+
+    Arguments:
+        path: the file of a catalog resource
+        roots: the directories the checkout can be reached at, i.e. the src
+               directory and the puppet confdirs overlaying it
+
+    Returns:
+        str: the path, e.g. modules/profile/manifests/grafana.pp, None if outside of the roots
+
+    """
+    for root in roots:
+        try:
+            return str(Path(path).relative_to(root))
+        except ValueError:
+            continue
+    return None
+
+
+class ProvenanceIndex:
+    """Per host source files, stored in a sqlite database.
+
+    The database is shared by all the jobs running on the same machine. The
+    source files of a host are the ones declaring the resources of its last
+    compiled production catalog, and are replaced every time the host is
+    compiled again.
+
+    Arguments:
+        path: the path of the sqlite database
+
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def _connect(self) -> sqlite3.Connection:
+        self.path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), timeout=30)
+        conn.execute("CREATE TABLE IF NOT EXISTS hosts (hostname TEXT PRIMARY KEY, updated REAL)")
+        conn.execute("CREATE TABLE IF NOT EXISTS sources (file TEXT, hostname TEXT, PRIMARY KEY (file, hostname))")
+        conn.execute("CREATE INDEX IF NOT EXISTS sources_hostname ON sources (hostname)")
+        return conn
+
+    def record(self, sources: Dict[str, Iterable[str]]) -> None:
+        """Record the source files of the hosts compiled by a run
+
+        Arguments:
+            sources: the source files, relative to the puppet checkout, by hostname.
+                The hosts without any are left alone.
+
+        """
+        if not sources:
+            return
+        now = time.time()
+        try:
+            conn = self._connect()
+            with conn:
+                for hostname, files in sources.items():
+                    # Don't lose the files of a host for a catalog they couldn't be found in
+                    if not files:
+                        continue
+                    conn.execute("DELETE FROM sources WHERE hostname = ?", (hostname,))
+                    conn.executemany("INSERT INTO sources VALUES (?, ?)", ((file, hostname) for file in set(files)))
+                    conn.execute("INSERT OR REPLACE INTO hosts VALUES (?, ?)", (hostname, now))
+            conn.close()
+        except (sqlite3.Error, OSError) as error:
+            _log.warning("Unable to record the source files to %s: %s", self.path, error)
+
+    def hosts_for(self, files: Iterable[str]) -> Set[str]:
+        """Return the hosts whose catalogs depend on any of the files
+
+        Arguments:
+            files: the source files, relative to the puppet checkout
+
+        """
+        files = set(files)
+        if not files:
+            return set()
+        hosts: Set[str] = set()
+        try:
+            conn = self._connect()
+            with conn:
+                conn.execute("CREATE TEMP TABLE changed (file TEXT PRIMARY KEY)")
+                conn.executemany("INSERT INTO changed VALUES (?)", ((file,) for file in files))
+                rows = conn.execute("SELECT DISTINCT hostname FROM sources JOIN changed USING (file)")
+                hosts.update(row[0] for row in rows)
+            conn.close()
+        except (sqlite3.Error, OSError) as error:
+            _log.warning("Unable to read the source files from %s: %s", self.path, error)
+        return hosts
+
+
+def index_path(config: ControllerConfig) -> Path:
+    """Return the path of the index shared by the jobs"""
+    return config.cache_dir / "provenance.sqlite"
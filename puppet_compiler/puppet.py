@@ -8,8 +8,12 @@ from tempfile import SpooledTemporaryFile
 from typing import Dict, List, Optional, Tuple
 
 from puppet_compiler import _log, utils
+from puppet_compiler.compiler_pool import CompilerPool
 from puppet_compiler.directories import FHS, HostFiles
 
+# The exit codes of `puppet catalog compile` when the catalog compiled, 2 meaning there were changes
+SUCCESS_CODES = [0, 2]
+
 
 class CompilationFailedError(Exception):
     """Risen when compiling a catalog fails."""
@@ -19,8 +23,25 @@ class CompilationFailedError(Exception):
         self.return_code = return_code
 
 
+def confdir(label: str, realm: Optional[str] = None) -> Path:
+    """Return the puppet confdir a catalog is compiled with
+
+    Arguments:
+        label: indicate the environment to use (production or change)
+        realm: the realm whose confdir to use, the src directory if not passed
+
+    """
+    basedir = FHS.prod_dir if label == "prod" else FHS.change_dir
+    return basedir / "src" if realm is None else FHS.confdir(basedir, realm)
+
+
 def compile_cmd_env(
-    hostname: str, label: str, vardir: Path, manifests_dir: Optional[Path] = None, *extra_flags
+    hostname: str,
+    label: str,
+    vardir: Path,
+    manifests_dir: Optional[Path] = None,
+    *extra_flags,
+    realm: Optional[str] = None,
 ) -> Tuple[List[str], Dict[str, str]]:
     """Compaile puppet with a specific environment
 
@@ -30,6 +51,8 @@ def compile_cmd_env(
         vardir: the puppet vardir
         manifests_dir: the location of rhte puppet manifests directory
         extra_flags: any addtinal puppet flags
+        realm: use the confdir generated for this realm, the src directory is
+               used as confdir if not passed
 
     Returns:
         (cmd, env): A tuple representing the command to run and the environment
@@ -68,7 +91,7 @@ def compile_cmd_env(
         "--render-as=rich_data_json",
         f"--vardir={vardir}",
         f"--modulepath={privdir / 'modules'}:{srcdir / 'modules'}:{srcdir / 'vendor_modules'}:{srcdir / 'core_modules'}",
-        f"--confdir={srcdir}",
+        f"--confdir={confdir(label, realm)}",
         "--color=false",
         f"--yamldir={yamldir}",
         f"--factpath={factpath}",
@@ -80,7 +103,15 @@ def compile_cmd_env(
     return (cmd, env)
 
 
-async def compile(hostname: str, label: str, vardir: Path, manifests_dir: Optional[Path] = None, *extra_flags) -> None:
+async def compile(
+    hostname: str,
+    label: str,
+    vardir: Path,
+    manifests_dir: Optional[Path] = None,
+    *extra_flags,
+    realm: Optional[str] = None,
+    compiler_pool: Optional[CompilerPool] = None,
+) -> None:
     """Compile the catalog
 
     Arguments:
@@ -89,10 +120,22 @@ async def compile(hostname: str, label: str, vardir: Path, manifests_dir: Option
         vardir: the puppet vardir
         manifests_dir: the location of rhte puppet manifests directory
         extra_flags: any addtinal puppet flags
+        realm: the realm whose confdir to use
+        compiler_pool: if passed, compile with one of its warm processes
+                       instead of spawning a new puppet process. Ignored when
+                       extra_flags are passed.
 
     """
-    cmd, env = compile_cmd_env(hostname, label, vardir, manifests_dir, *extra_flags)
+    cmd, env = compile_cmd_env(hostname, label, vardir, manifests_dir, *extra_flags, realm=realm)
     hostfiles = HostFiles(hostname)
+    if compiler_pool is not None and not extra_flags:
+        returncode = await compiler_pool.compile(
+            cmd, env, hostname, hostfiles.file_for(label, "catalog"), hostfiles.file_for(label, "errors")
+        )
+        if returncode not in SUCCESS_CODES:
+            raise CompilationFailedError(return_code=returncode, command=cmd)
+        return
+
     out = SpooledTemporaryFile()
     with hostfiles.file_for(label, "errors").open("w") as err:
         proc = await asyncio.subprocess.create_subprocess_shell(" ".join(cmd), stdout=out, stderr=err, env=env)
@@ -109,12 +152,12 @@ async def compile(hostname: str, label: str, vardir: Path, manifests_dir: Option
             if not re.match(b"(Info|[Nn]otice|[Ww]arning)", line):
                 f_in.write(line)
 
-    if proc.returncode is not None and proc.returncode not in [0, 2]:
+    if proc.returncode is not None and proc.returncode not in SUCCESS_CODES:
         raise CompilationFailedError(return_code=proc.returncode, command=cmd)
 
 
 def compile_storeconfigs(
-    hostname: str, vardir: Path, manifests_dir: Optional[Path] = None
+    hostname: str, vardir: Path, manifests_dir: Optional[Path] = None, realm: Optional[str] = None
 ) -> Tuple[bool, SpooledTemporaryFile, SpooledTemporaryFile]:
     """Specialized function to store data into puppetdb when compiling.
 
@@ -122,6 +165,7 @@ def compile_storeconfigs(
         hostname: The hostname to compile for
         vardir: the puppet vardir
         manifests_dir: the location of rhte puppet manifests directory
+        realm: the realm whose confdir to use
 
     Retunrs:
         (success, out, err): tuple representing the boolean status of the command
@@ -134,6 +178,7 @@ def compile_storeconfigs(
         manifests_dir,
         "--storeconfigs",
         "--storeconfigs_backend=puppetdb",
+        realm=realm,
     )
     stdout = SpooledTemporaryFile()
     stderr = SpooledTemporaryFile()
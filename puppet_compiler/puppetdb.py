@@ -0,0 +1,388 @@
+"""Client for the PuppetDB query API"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import requests
+import urllib3  # type: ignore
+from requests.adapters import HTTPAdapter
+
+from puppet_compiler import _log
+from puppet_compiler.config import ControllerConfig
+
+# TODO: have the CA as a config option
+urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+
+class ResourceIndex:
+    """Offline index of the nodes having each class and defined type.
+
+    The index is exported from PuppetDB by export_index, it maps the
+    resource titles queried by the host selection (Class/Role::Grafana for
+    classes, Systemd::Service for defined types) to the certname and tags of
+    the nodes.
+
+    Arguments:
+        generated: the time the index was exported at
+        resources: the certname and tags of the nodes, by resource title
+
+    """
+
+    def __init__(self, generated: float, resources: Dict[str, List[Dict]]) -> None:
+        self.generated = generated
+        self.resources = resources
+
+    @staticmethod
+    def covers(title: str) -> bool:
+        """Whether the index can answer the query of a title, i.e. it is a class or a defined type
+
+        The titles of the defined type resources, e.g. Systemd::Service/grafana,
+        are not indexed.
+
+        """
+        if title.startswith("Class/"):
+            return True
+        return "::" in title and "/" not in title
+
+    def lookup(self, title: str) -> List[Dict]:
+        """Return the certname and tags of the nodes having a resource
+
+        Arguments:
+            title: the resource, e.g. Class/Role::Grafana
+
+        """
+        return self.resources.get(title, [])
+
+    @classmethod
+    def from_resources(cls, resources: Iterable[Dict]) -> "ResourceIndex":
+        """Build the index from the resources returned by PuppetDB
+
+        Arguments:
+            resources: dictionaries with the certname, type, title and tags of the resources
+
+        """
+        index: Dict[str, Dict[str, Dict]] = {}
+        for resource in resources:
+            title = f"Class/{resource['title']}" if resource["type"] == "Class" else resource["type"]
+            index.setdefault(title, {}).setdefault(
+                resource["certname"], {"certname": resource["certname"], "tags": resource["tags"]}
+            )
+        return cls(time.time(), {title: list(nodes.values()) for title, nodes in index.items()})
+
+    def save(self, path: Path) -> None:
+        """Write the index, atomically
+
+        The tags lists are stored once and referenced by position, as
+        most nodes share them.
+
+        Arguments:
+            path: the file to write the index to
+
+        """
+        tags_ids: Dict[Tuple[str, ...], int] = {}
+        resources = {}
+        for title, nodes in self.resources.items():
+            resources[title] = [
+                [node["certname"], tags_ids.setdefault(tuple(node["tags"]), len(tags_ids))] for node in nodes
+            ]
+        data = {"generated": self.generated, "tags": [list(tags) for tags in tags_ids], "resources": resources}
+        path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+        tmp_fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=".")
+        with os.fdopen(tmp_fd, "w") as tmp_file:
+            json.dump(data, tmp_file, separators=(",", ":"))
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: Path) -> "ResourceIndex":
+        """Read an index written by save
+
+        Arguments:
+            path: the file to read the index from
+
+        """
+        data = json.loads(path.read_text())
+        tags = data["tags"]
+        resources = {
+            title: [{"certname": certname, "tags": tags[tags_id]} for certname, tags_id in nodes]
+            for title, nodes in data["resources"].items()
+        }
+        return cls(data["generated"], resources)
+
+
+class PuppetDBClient:
+    """PuppetDB query API client, sharing one connection pool across queries.
+
+    The results of the resources queries can be cached on disk for a short
+    time, so that jobs selecting the same hosts close to each other don't
+    query PuppetDB again.
+
+    When an offline index younger than index_max_age is available, the
+    queries about classes and defined types are answered from it.
+
+    Arguments:
+        url: the url of the query API
+        cache_dir: the directory to cache the results in
+        cache_ttl: how long to use the cached results for, in seconds (0 disables the cache)
+        max_workers: the maximum number of queries to run at the same time
+        index_path: the offline index written by export_index
+        index_max_age: the age, in seconds, above which the index is not used (0 disables the index)
+
+    """
+
+    # pylint: disable=too-many-arguments
+    def __init__(
+        self,
+        url: str = "https://localhost/pdb/query/v4",
+        cache_dir: Optional[Path] = None,
+        cache_ttl: int = 0,
+        max_workers: int = 8,
+        index_path: Optional[Path] = None,
+        index_max_age: int = 0,
+    ) -> None:
+        self.url = url.rstrip("/")
+        self.cache_dir = cache_dir
+        self.cache_ttl = cache_ttl
+        self.max_workers = max_workers
+        self.index_path = index_path
+        self.index_max_age = index_max_age
+        self._index: Optional[ResourceIndex] = None
+        self._index_loaded = False
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_maxsize=max_workers)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _cache_file(self, title: str) -> Optional[Path]:
+        if self.cache_dir is None or self.cache_ttl <= 0:
+            return None
+        return self.cache_dir / f"{hashlib.sha256(title.encode()).hexdigest()}.json"
+
+    def _read_cache(self, title: str) -> Optional[List[Dict]]:
+        cache_file = self._cache_file(title)
+        if cache_file is None:
+            return None
+        try:
+            if time.time() - cache_file.stat().st_mtime > self.cache_ttl:
+                return None
+            return json.loads(cache_file.read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _write_cache(self, title: str, result: List[Dict]) -> None:
+        cache_file = self._cache_file(title)
+        if cache_file is None:
+            return
+        try:
+            cache_file.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+            tmp_fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, prefix=".")
+            with os.fdopen(tmp_fd, "w") as tmp_file:
+                json.dump(result, tmp_file)
+            os.replace(tmp_path, cache_file)
+        except OSError as error:
+            _log.warning("Unable to cache the PuppetDB result for %s: %s", title, error)
+
+    def resources(self, title: str) -> List[Dict]:
+        """Return the certname and tags of the nodes having a resource
+
+        Arguments:
+            title: the resource, e.g. Class/Role::Grafana
+
+        Returns:
+            list: a list of dictionaries with the certname and the tags of the nodes
+
+        """
+        index = self.index()
+        if index is not None and index.covers(title):
+            return index.lookup(title)
+        result = self._read_cache(title)
+        if result is not None:
+            _log.debug("Using the cached PuppetDB result for %s", title)
+            return result
+        params = {"query": '["extract",["certname","tags"]]'}
+        response = self.session.get(f"{self.url}/resources/{title}", params=params)
+        response.raise_for_status()
+        result = response.json()
+        self._write_cache(title, result)
+        return result
+
+    def resources_batch(self, titles: Iterable[str]) -> List[Dict]:
+        """Return the certname and tags of the nodes having any of the resources, in one query
+
+        Arguments:
+            titles: the resources, e.g. Class/Role::Grafana, Systemd::Service or Systemd::Service/grafana
+
+        Returns:
+            list: a list of dictionaries with the certname and the tags of the nodes,
+                  with one entry per resource
+
+        """
+        nodes: List[Dict] = []
+        clauses: List[List] = []
+        index = self.index()
+        for title in dict.fromkeys(titles):
+            if index is not None and index.covers(title):
+                nodes.extend(index.lookup(title))
+            elif "/" in title:
+                resource_type, resource_title = title.split("/", 1)
+                clauses.append(["and", ["=", "type", resource_type], ["=", "title", resource_title]])
+            else:
+                clauses.append(["=", "type", title])
+        if clauses:
+            query = ["extract", ["certname", "tags"], ["or", *clauses]]
+            response = self.session.get(f"{self.url}/resources", params={"query": json.dumps(query)})
+            response.raise_for_status()
+            nodes.extend(response.json())
+        return nodes
+
+    def roles(self) -> Dict[str, str]:
+        """Return the role of every node
+
+        Returns:
+            dict: the role class of each node, e.g. mediawiki::appserver, by certname
+
+        """
+        roles: Dict[str, str] = {}
+        index = self.index()
+        if index is not None:
+            for title, nodes in index.resources.items():
+                if title.startswith("Class/Role::"):
+                    roles.update((node["certname"], title.split("::", 1)[1].lower()) for node in nodes)
+            return roles
+        query = ["extract", ["certname", "title"], ["and", ["=", "type", "Class"], ["~", "title", "^Role::"]]]
+        response = self.session.get(f"{self.url}/resources", params={"query": json.dumps(query)})
+        response.raise_for_status()
+        for resource in response.json():
+            roles[resource["certname"]] = resource["title"].split("::", 1)[1].lower()
+        return roles
+
+    def classes(self, certnames: Iterable[str]) -> Dict[str, Set[str]]:
+        """Return the classes of the nodes
+
+        Arguments:
+            certnames: the nodes
+
+        Returns:
+            dict: the titles of the classes of each node, e.g. Profile::Base, by certname
+
+        """
+        certnames = sorted(set(certnames))
+        classes: Dict[str, Set[str]] = {certname: set() for certname in certnames}
+        if not certnames:
+            return classes
+        index = self.index()
+        if index is not None:
+            for title, nodes in index.resources.items():
+                if not title.startswith("Class/"):
+                    continue
+                for node in nodes:
+                    if node["certname"] in classes:
+                        classes[node["certname"]].add(title.split("/", 1)[1])
+            return classes
+        query = [
+            "extract",
+            ["certname", "title"],
+            ["and", ["=", "type", "Class"], ["in", "certname", ["array", certnames]]],
+        ]
+        # The list of certnames can be too long for a query string
+        response = self.session.post(f"{self.url}/resources", json={"query": query})
+        response.raise_for_status()
+        for resource in response.json():
+            classes[resource["certname"]].add(resource["title"])
+        return classes
+
+    def index(self) -> Optional[ResourceIndex]:
+        """Return the offline index, None if disabled, missing or stale"""
+        if not self._index_loaded:
+            self._index_loaded = True
+            if self.index_path is None or self.index_max_age <= 0:
+                return None
+            try:
+                self._index = ResourceIndex.load(self.index_path)
+            except (OSError, ValueError, KeyError) as error:
+                _log.warning("Unable to load the PuppetDB index %s: %s", self.index_path, error)
+                return None
+            age = time.time() - self._index.generated
+            if age > self.index_max_age:
+                _log.info("The PuppetDB index %s is %d seconds old, querying PuppetDB", self.index_path, age)
+                self._index = None
+        return self._index
+
+    def export_index(self, path: Path) -> ResourceIndex:
+        """Export the nodes of every class and defined type to an offline index
+
+        Arguments:
+            path: the file to write the index to
+
+        """
+        # Defined types are the namespaced resource types
+        query = ["extract", ["certname", "type", "title", "tags"], ["or", ["=", "type", "Class"], ["~", "type", "::"]]]
+        response = self.session.get(f"{self.url}/resources", params={"query": json.dumps(query)})
+        response.raise_for_status()
+        index = ResourceIndex.from_resources(response.json())
+        index.save(path)
+        _log.info("Exported the nodes of %d resources to %s", len(index.resources), path)
+        return index
+
+    def resources_many(self, titles: Iterable[str]) -> Dict[str, List[Dict]]:
+        """Run the resources queries of several titles at the same time
+
+        Arguments:
+            titles: the resources to query
+
+        Returns:
+            dict: the result of each query, by title
+
+        """
+        unique_titles = list(dict.fromkeys(titles))
+        if len(unique_titles) <= 1:
+            return {title: self.resources(title) for title in unique_titles}
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(unique_titles))) as executor:
+            return dict(zip(unique_titles, executor.map(self.resources, unique_titles)))
+
+
+# The client shared by the whole process, see Controller
+client = PuppetDBClient()
+
+
+def index_path(config: ControllerConfig) -> Path:
+    """Return the path of the offline index used by the jobs"""
+    return config.cache_dir / "puppetdb_index.json"
+
+
+def get_args() -> Namespace:
+    """Get Arguments"""
+    parser = ArgumentParser(description="Export the offline index of PuppetDB used for selecting hosts")
+    parser.add_argument(
+        "--config",
+        default="/etc/puppet-compiler.conf",
+        type=Path,
+        help="The config file of the puppet compiler",
+    )
+    parser.add_argument("--output", type=Path, help="The file to write the index to, the one used by the jobs if unset")
+    parser.add_argument("--debug", action="store_true", default=False, help="Print debug output")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Main Entry"""
+    args = get_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.DEBUG if args.debug else logging.INFO,
+        datefmt="[ %Y-%m-%dT%H:%M:%S ]",
+    )
+    config = ControllerConfig.from_file(args.config, {})
+    PuppetDBClient().export_index(args.output or index_path(config))
+
+
+if __name__ == "__main__":
+    main()
@@ -59,6 +59,7 @@ class StatesCollection:
 
     def __init__(self) -> None:
         self.states: Dict[str, Set[str]] = {}
+        self._host_states: Dict[str, str] = {}
 
     def add(self, state: ChangeState) -> None:
         """Add a state object to the collection.
@@ -71,6 +72,23 @@ class StatesCollection:
             self.states[state.name] = set([state.host])
         else:
             self.states[state.name].add(state.host)
+        self._host_states[state.host] = state.name
+
+    def update(self, state: ChangeState) -> None:
+        """Set the state of a host, moving it out of the state it was previously in.
+
+        Arguments:
+          state - a ChangeState (or derived) object for a run on a specific host.
+
+        """
+        previous = self._host_states.get(state.host)
+        if previous == state.name:
+            return
+        if previous is not None:
+            self.states[previous].discard(state.host)
+            if not self.states[previous]:
+                del self.states[previous]
+        self.add(state)
 
     # FIXME state_name type is ChangeState.name but MyPy does not recognize
     # the type returned by a property getter (fget)
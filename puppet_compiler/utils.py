@@ -1,12 +1,23 @@
 """Collections of helpers"""
-import shutil
+import hashlib
+import os
+import re
+import tempfile
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Dict, Optional, Set, Tuple
 
 import yaml
 
 from puppet_compiler import _log
 
+# Use the libyaml bindings when available, they are much faster
+YamlLoader = getattr(yaml, "CLoader", yaml.Loader)
+YamlDumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+FACTS_EXPIRATION_RE = re.compile(r"^expiration: *(.*)$", re.MULTILINE)
+FACTS_TIMESTAMP_RE = re.compile(r"^timestamp: *(.*)$", re.MULTILINE)
+FACTS_DATE_RE = re.compile(r"(?P<date>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})[.\d]*(?: *(?P<offset>[+-]\d{2}:\d{2}))?")
+
 
 def construct_ruby_object(loader, _suffix, node):
     """YAML construct to map object to dict."""
@@ -17,6 +28,129 @@ class FactsFileNotFound(Exception):
     """Exception for missing facts files"""
 
 
+class FactsIndex:
+    """Index of the facts files found under a directory.
+
+    The tree is walked once, and again only when facts files or directories
+    have been added or removed since. Looking up a host is then a dictionary
+    lookup. Files replaced in place modify their directory, which then gets
+    listed again to check that its entries are the same, unless they were
+    replaced by refresh_yaml_date, which lets the index know.
+
+    Arguments:
+        yaml_dir: the directory to index, usually the yaml directory of puppet_var
+
+    """
+
+    def __init__(self, yaml_dir: Path) -> None:
+        self.yaml_dir = yaml_dir
+        self._dir_mtimes: Dict[str, int] = {}
+        self._dir_entries: Dict[str, Set[str]] = {}
+        self._facts: Dict[str, Path] = {}
+        self._nodes: Set[str] = set()
+
+    @staticmethod
+    def _entries(dirname: str) -> Set[str]:
+        """Return the names of the entries of a directory, the hidden temporary files left out"""
+        return {name for name in os.listdir(dirname) if not name.startswith(".")}
+
+    def _is_stale(self) -> bool:
+        if not self._dir_mtimes:
+            return True
+        for dirname, mtime in self._dir_mtimes.items():
+            try:
+                new_mtime = os.stat(dirname).st_mtime_ns
+                if new_mtime == mtime:
+                    continue
+                if self._entries(dirname) != self._dir_entries.get(dirname):
+                    return True
+            except OSError:
+                return True
+            # Only files were replaced
+            self._dir_mtimes[dirname] = new_mtime
+        return False
+
+    def _scan(self) -> None:
+        dir_mtimes: Dict[str, int] = {}
+        dir_entries: Dict[str, Set[str]] = {}
+        newest: Dict[str, Tuple[float, str]] = {}
+        nodes: Set[str] = set()
+        pending = [str(self.yaml_dir)]
+        while pending:
+            dirname = pending.pop()
+            try:
+                dir_mtimes[dirname] = os.stat(dirname).st_mtime_ns
+                entries = list(os.scandir(dirname))
+                dir_entries[dirname] = {entry.name for entry in entries if not entry.name.startswith(".")}
+            except OSError:
+                continue
+            is_facts_dir = os.path.basename(dirname) == "facts"
+            for entry in entries:
+                if entry.is_dir():
+                    pending.append(entry.path)
+                    continue
+                if not entry.name.endswith(".yaml"):
+                    continue
+                hostname = entry.name[: -len(".yaml")]
+                nodes.add(hostname)
+                if not is_facts_dir:
+                    continue
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                if hostname not in newest or mtime > newest[hostname][0]:
+                    newest[hostname] = (mtime, entry.path)
+        self._dir_mtimes = dir_mtimes
+        self._dir_entries = dir_entries
+        self._facts = {hostname: Path(path) for hostname, (_, path) in newest.items()}
+        self._nodes = nodes
+
+    def file_replaced(self, dirname: str, before: int, after: int) -> None:
+        """Record that a file of a directory was replaced in place
+
+        Arguments:
+            dirname: the directory of the file
+            before: the modification time of the directory before the file was replaced
+            after: the modification time of the directory once the file was replaced
+
+        """
+        # If the directory changed before, let _is_stale check its entries
+        if self._dir_mtimes.get(dirname) == before:
+            self._dir_mtimes[dirname] = after
+
+    def refresh(self) -> None:
+        """Walk the tree again if it changed since the last walk"""
+        if self._is_stale():
+            _log.debug("Indexing the facts files under %s", self.yaml_dir)
+            self._scan()
+
+    def facts_file(self, hostname: str) -> Optional[Path]:
+        """Return the newest facts file of a host, None if there is none"""
+        self.refresh()
+        return self._facts.get(hostname)
+
+    def nodes(self) -> Set[str]:
+        """Return the names of all the yaml files of the tree, without extension"""
+        self.refresh()
+        return set(self._nodes)
+
+
+_facts_indexes: Dict[Path, FactsIndex] = {}
+
+
+def facts_index(yaml_dir: Path) -> FactsIndex:
+    """Return the facts index of a directory, shared by all the callers
+
+    Arguments:
+        yaml_dir: The directory to index
+
+    """
+    if yaml_dir not in _facts_indexes:
+        _facts_indexes[yaml_dir] = FactsIndex(yaml_dir)
+    return _facts_indexes[yaml_dir]
+
+
 def facts_file(vardir: Path, hostname: str) -> Path:
     """Finds facts file for the given hostname.
 
@@ -27,36 +161,90 @@ def facts_file(vardir: Path, hostname: str) -> Path:
         hostname: The hostname to search for
 
     """
-    try:
-        # try to get the most recent fact file based on the file mtime
-        return sorted(
-            (vardir / "yaml").glob(f"**/facts/{hostname}.yaml"),
-            key=lambda x: x.stat().st_mtime,
-            reverse=True,
-        )[0]
-    except IndexError as error:
-        raise FactsFileNotFound(f"Unable to find fact file for: {hostname} under directory {vardir}") from error
-
-
-def refresh_yaml_date(facts_path: Path) -> None:
+    path = facts_index(vardir / "yaml").facts_file(hostname)
+    if path is None:
+        raise FactsFileNotFound(f"Unable to find fact file for: {hostname} under directory {vardir}")
+    return path
+
+
+def facts_digest(facts_path: Path) -> str:
+    """Return a digest of the facts of a host.
+
+    The expiration and timestamp keys are rewritten on every run, so they are
+    left out of the digest.
+
+    Arguments:
+        facts_path: The path to the facts file
+    """
+    digest = hashlib.sha256()
+    with facts_path.open("rb") as facts:
+        for line in facts:
+            if not line.startswith((b"expiration:", b"timestamp:")):
+                digest.update(line)
+    return digest.hexdigest()
+
+
+def _parse_facts_date(value: str) -> Optional[datetime]:
+    """Parse a date of a facts file, e.g. '2023-01-01 00:00:00.000000000 +00:00', as naive UTC"""
+    match = FACTS_DATE_RE.search(value)
+    if match is None:
+        return None
+    date = datetime.strptime(match.group("date").replace("T", " "), "%Y-%m-%d %H:%M:%S")
+    if match.group("offset"):
+        sign = -1 if match.group("offset")[0] == "-" else 1
+        hours, minutes = match.group("offset")[1:].split(":")
+        date -= sign * timedelta(hours=int(hours), minutes=int(minutes))
+    return date
+
+
+def refresh_yaml_date(facts_path: Path, min_validity: Optional[timedelta] = None) -> bool:
     """Refresh the timestamp and the expiration of the yaml facts cache.
 
     This avoids incurring https://tickets.puppetlabs.com/browse/PUP-5441
     when using puppetdb.
 
+    Only the expiration and timestamp lines are rewritten, the file is
+    parsed as yaml only when they can't be found.
+
     Arguments:
         facts_path: The path to the facts file to refresh
+        min_validity: if passed, leave the file alone if it doesn't expire
+            before this much time from now
+
+    Returns:
+        bool: True if the file was refreshed, False if it was still valid
     """
-    yaml.add_multi_constructor("!ruby/object:", construct_ruby_object)
     date_format = "%Y-%m-%d %H:%M:%S.%s +00:00"
-    _log.debug("Patching %s", facts_path)
     datetime_facts = datetime.utcnow()
     datetime_exp = datetime_facts + timedelta(days=1)
-    data = yaml.load(facts_path.read_text(), Loader=yaml.Loader)
-    data["expiration"] = datetime_exp.strftime(date_format)
-    data["timestamp"] = datetime_facts.strftime(date_format)
-    tmp_facts_path = facts_path.parent / (facts_path.name + ".tmp")
-    new_content = "--- !ruby/object:Puppet::Node::Facts\n" + yaml.safe_dump(data)
-    tmp_facts_path.write_text(new_content)
-    # TODO: in python 3.7 theses move expects a str
-    shutil.move(str(tmp_facts_path), str(facts_path))
+    content = facts_path.read_text()
+    expiration = FACTS_EXPIRATION_RE.search(content)
+    if min_validity is not None and expiration is not None:
+        expires = _parse_facts_date(expiration.group(1))
+        if expires is not None and expires > datetime_facts + min_validity:
+            _log.debug("Facts of %s still valid until %s", facts_path, expires)
+            return False
+
+    _log.debug("Patching %s", facts_path)
+    if expiration is not None and FACTS_TIMESTAMP_RE.search(content) is not None:
+        new_content = FACTS_EXPIRATION_RE.sub(f"expiration: '{datetime_exp.strftime(date_format)}'", content, 1)
+        new_content = FACTS_TIMESTAMP_RE.sub(f"timestamp: '{datetime_facts.strftime(date_format)}'", new_content, 1)
+    else:
+        yaml.add_multi_constructor("!ruby/object:", construct_ruby_object, Loader=YamlLoader)
+        data = yaml.load(content, Loader=YamlLoader)
+        data["expiration"] = datetime_exp.strftime(date_format)
+        data["timestamp"] = datetime_facts.strftime(date_format)
+        new_content = "--- !ruby/object:Puppet::Node::Facts\n" + yaml.dump(data, Dumper=YamlDumper)
+    # Write to a temporary file first, the file might be in use by other jobs
+    dirname = str(facts_path.parent)
+    before = os.stat(dirname).st_mtime_ns
+    tmp_fd, tmp_facts_path = tempfile.mkstemp(dir=facts_path.parent, prefix=f".{facts_path.name}.")
+    with os.fdopen(tmp_fd, "w") as tmp_facts:
+        tmp_facts.write(new_content)
+    os.chmod(tmp_facts_path, 0o644)
+    os.replace(tmp_facts_path, facts_path)
+    after = os.stat(dirname).st_mtime_ns
+    # No file was added or removed, the indexes don't need to check the directory again
+    for index in list(_facts_indexes.values()):
+        index.file_replaced(dirname, before, after)
+    return True
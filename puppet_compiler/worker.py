@@ -1,18 +1,30 @@
 """Class for compiling a host"""
+import asyncio
 import gzip
+import logging
+import os
 import shutil
+import time
 import traceback
+from concurrent.futures import Executor
 from dataclasses import dataclass
+from multiprocessing.queues import SimpleQueue
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import AsyncContextManager, Dict, List, Optional, Set, Tuple, Union
 
-from puppet_compiler import _log, puppet, utils
+from puppet_compiler import _log, provenance, puppet, utils
+from puppet_compiler.catalog_cache import CatalogCache
+from puppet_compiler.compiler_pool import CompilerPool
 from puppet_compiler.differ import PuppetCatalog
-from puppet_compiler.directories import HostFiles
+from puppet_compiler.directories import FHS, HostFiles
+from puppet_compiler.presentation import html, json
 from puppet_compiler.presentation.html import Host
 from puppet_compiler.presentation.json import Host as JsonHost
 from puppet_compiler.state import ChangeState
 
+# has_diff, has_core_diff and the source files of a host, as returned by the diff stage
+DiffResult = Tuple[Optional[bool], Optional[bool], Optional[Set[str]]]
+
 
 @dataclass(frozen=True)
 class RunHostResult:
@@ -21,26 +33,59 @@ class RunHostResult:
     change_error: bool
     has_diff: Optional[bool]
     has_core_diff: Optional[bool]
+    # Seconds spent running puppet, None if nothing was compiled
+    duration: Optional[float] = None
+    # The source files of the production catalog, relative to the puppet
+    # checkout, None if it wasn't diffed
+    sources: Optional[Set[str]] = None
 
 
 class HostWorker:
     """Class for compiling a host"""
 
-    def __init__(self, vardir: Path, hostname: str):
+    def __init__(
+        self,
+        vardir: Path,
+        hostname: str,
+        realm: Optional[str] = None,
+        compile_slots: Optional[AsyncContextManager] = None,
+        compiler_pool: Optional[CompilerPool] = None,
+        catalog_cache: Optional[CatalogCache] = None,
+        diff_executor: Optional[Executor] = None,
+    ):
         """Class for compiling a host.
 
         Arguments:
             vardir: The puppet var directory
             hostname: the host to work on
+            realm: the realm of the host, used to pick the puppet confdir
+            compile_slots: if passed, the production and change catalogs are
+                compiled concurrently, each compilation holding one slot.
+            compiler_pool: if passed, compile the catalogs with the warm
+                processes of the pool.
+            catalog_cache: if passed, reuse the catalogs compiled by previous
+                jobs, and store the ones compiled successfully.
+            diff_executor: if passed, diff the catalogs and render the output
+                in this pool of processes, set up by setup_diff_process,
+                instead of on the event loop.
 
         """
         self.puppet_var = Path(vardir) if isinstance(vardir, str) else vardir
+        self._compile_slots = compile_slots
+        self._compiler_pool = compiler_pool
+        self._catalog_cache = catalog_cache
+        self._diff_executor = diff_executor
         self._files = HostFiles(hostname)
         self._envs = ["prod", "change"]
         self.hostname = hostname
+        self.realm = realm
         self.diffs: Optional[Dict] = None
         self.full_diffs: Optional[Dict] = None
         self.core_diffs: Optional[Dict] = None
+        self.compile_time = 0.0
+        self.sources: Optional[Set[str]] = None
+        # The environments whose catalog came from the catalog cache
+        self._cached_envs: Set[str] = set()
 
     def facts_file(self) -> Path:
         """Finds facts file for the current hostname"""
@@ -60,12 +105,6 @@ class HostWorker:
             return RunHostResult(
                 hostname=self.hostname, base_error=True, change_error=True, has_diff=None, has_core_diff=None
             )
-        # Refresh the facts file first
-        try:
-            utils.refresh_yaml_date(self.facts_file())
-        except utils.FactsFileNotFound:
-            pass
-
         has_diff = None
         has_core_diff = None
         base_error = True
@@ -76,6 +115,50 @@ class HostWorker:
         except Exception as err:
             _log.exception("Error preparing compiling for %s: %s", self.hostname, err)
 
+        if self._diff_executor is None:
+            has_diff, has_core_diff, self.sources = self.diff_and_render(base_error, change_error)
+        else:
+            loop = asyncio.get_running_loop()
+            try:
+                has_diff, has_core_diff, self.sources = await loop.run_in_executor(
+                    self._diff_executor,
+                    diff_and_render,
+                    self.puppet_var,
+                    self.hostname,
+                    self.realm,
+                    base_error,
+                    change_error,
+                )
+            # pylint: disable=broad-except
+            except Exception as err:
+                _log.exception("Error diffing %s in the diff processes: %s", self.hostname, err)
+        if self._envs[0] in self._cached_envs:
+            # The files of a cached catalog are in the directory of the job that compiled it
+            self.sources = None
+        return RunHostResult(
+            hostname=self.hostname,
+            base_error=base_error,
+            change_error=change_error,
+            has_diff=has_diff,
+            has_core_diff=has_core_diff,
+            duration=self.compile_time or None,
+            sources=self.sources,
+        )
+
+    def diff_and_render(self, base_error: bool, change_error: bool) -> DiffResult:
+        """Diff the catalogs once compiled, and render the output of the host
+
+        Arguments:
+            base_error: if compiling the production catalog failed
+            change_error: if compiling the change catalog failed
+
+        Returns:
+            (bool, bool, set): has_diff and has_core_diff, as returned by
+                _make_diff, and the source files of the production catalog
+
+        """
+        has_diff = None
+        has_core_diff = None
         if not base_error and not change_error:
             has_diff, has_core_diff = self._make_diff()
         try:
@@ -92,13 +175,7 @@ class HostWorker:
         # pylint: disable=broad-except
         except Exception as err:
             _log.exception("Error preparing output for %s: %s", self.hostname, err)
-        return RunHostResult(
-            hostname=self.hostname,
-            base_error=base_error,
-            change_error=change_error,
-            has_diff=has_diff,
-            has_core_diff=has_core_diff,
-        )
+        return has_diff, has_core_diff, self.sources
 
     def _check_if_compiled(self, env: str) -> Optional[bool]:
         """Check if we have allready compiled the host for a specific environment.
@@ -141,9 +218,24 @@ class HostWorker:
         if check is not None:
             return check
 
+        catalog = self._files.file_for(env, "catalog")
+        errors = self._files.file_for(env, "errors")
+        cache_key = None
+        if self._catalog_cache is not None and not args:
+            cache_key = self._catalog_cache.key(
+                env, self.realm or "production", self.facts_file(), puppet.confdir(env, self.realm) / "puppet.conf"
+            )
+            if self._catalog_cache.get(cache_key, catalog, errors):
+                _log.info("Using the cached catalog of host %s (%s)", self.hostname, env)
+                self._cached_envs.add(env)
+                return True
+
         _log.info("Compiling host %s (%s)", self.hostname, env)
+        start = time.monotonic()
         try:
-            await puppet.compile(self.hostname, env, self.puppet_var, None, *args)
+            await puppet.compile(
+                self.hostname, env, self.puppet_var, None, *args, realm=self.realm, compiler_pool=self._compiler_pool
+            )
         except puppet.CompilationFailedError as error:
             _log.error(
                 "Compilation failed for hostname %s " " in environment %s.",
@@ -153,7 +245,11 @@ class HostWorker:
             _log.info("Compilation exited with code %d", error.return_code)
             _log.debug("Failed command: %s", error.command)
             return False
+        finally:
+            self.compile_time += time.monotonic() - start
 
+        if self._catalog_cache is not None and cache_key is not None:
+            self._catalog_cache.put(cache_key, catalog, errors)
         return True
 
     async def _compile_all(self) -> Tuple[bool, bool]:
@@ -164,12 +260,37 @@ class HostWorker:
         """
         base_error, change_error = False, False
         args: List[str] = []
+        if self._compile_slots is not None:
+            results = await asyncio.gather(
+                *(self._compile_in_slot(self._compile_slots, env, args) for env in self._envs),
+                return_exceptions=True,
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+            return not results[0], not results[1]
+
         if not await self._compile(self._envs[0], args):
             base_error = True
         if not await self._compile(self._envs[1], args):
             change_error = True
         return base_error, change_error
 
+    async def _compile_in_slot(self, slots: AsyncContextManager, env: str, args: List) -> bool:
+        """Compile the host once a compile slot is available.
+
+        Arguments:
+            slots: The limiter holding the compile slots
+            env: The environment to compile for
+            args: a list of addtional compile arguments
+
+        Returns
+            bool: Indicate if we successfully compiled the catalog
+
+        """
+        async with slots:
+            return await self._compile(env, args)
+
     def _make_diff(self) -> Tuple[Optional[bool], Optional[bool]]:
         """Creat the actual diff files
 
@@ -185,6 +306,13 @@ class HostWorker:
         try:
             original = PuppetCatalog(self._files.file_for(self._envs[0], "catalog"))
             new = PuppetCatalog(self._files.file_for(self._envs[1], "catalog"))
+            roots = [FHS.confdir(FHS.prod_dir, self.realm or "production"), FHS.prod_dir / "src"]
+            sources = {
+                source
+                for source in (provenance.relative_source(path, roots) for path in original.source_files)
+                if source is not None
+            }
+            self.sources = sources or None
             self.full_diffs = original.diff_full_diff(new)
             self.core_diffs = original.diff_if_present(new, core_resources=True)
             self.diffs = original.diff_if_present(new, core_resources=False)
@@ -233,3 +361,54 @@ class HostWorker:
         """
         json_host = JsonHost(self.hostname, self._files, retcode)
         json_host.render(self.diffs, self.core_diffs, self.full_diffs)
+
+
+def setup_diff_process(
+    base: Union[str, Path],
+    change_id: int,
+    job_id: int,
+    log_level: int = logging.INFO,
+    pids: Optional[SimpleQueue] = None,
+) -> None:
+    """Set up the directories, the presentation variables and the logging of a process of the diff stage
+
+    Used as the initializer of the pool of processes passed as diff_executor
+    to HostWorker, the same way the controller and the cli set them up. The
+    processes are started by a forkserver, and don't inherit them.
+
+    Arguments:
+        base: the base directory of the jobs
+        change_id: the change number
+        job_id: the job id
+        log_level: the level to log at
+        pids: if passed, report the pid of the process to this queue
+
+    """
+    if pids is not None:
+        pids.put(os.getpid())
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=log_level,
+        datefmt="[ %Y-%m-%dT%H:%M:%S ]",
+    )
+    FHS.setup(change_id, job_id, base)
+    html.change_id = change_id
+    html.job_id = job_id
+    json.change_id = change_id
+    json.job_id = job_id
+
+
+def diff_and_render(
+    vardir: Path, hostname: str, realm: Optional[str], base_error: bool, change_error: bool
+) -> DiffResult:
+    """Diff the catalogs of a host and render its output, in a process of the diff stage
+
+    Arguments:
+        vardir: The puppet var directory
+        hostname: the host to work on
+        realm: the realm of the host
+        base_error: if compiling the production catalog failed
+        change_error: if compiling the change catalog failed
+
+    """
+    return HostWorker(vardir, hostname, realm=realm).diff_and_render(base_error, change_error)
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+"""Pool of ready to use workspaces, so that jobs can skip cloning the repositories
+
+A workspace is a compile directory (see FHS.prod_dir) with the src, private
+and netbox-hiera checkouts in place, along with the revisions of the
+long-lived repositories it was cloned from. The pool is kept filled by
+running this module regularly (pcc-workspace-pool), jobs claim workspaces
+by renaming them in place and give them back when cleaning up.
+
+The long-lived repositories are refreshed by the jobs, workspaces cloned
+from an older HEAD are discarded at the next fill.
+"""
+import fcntl
+import json
+import logging
+import shutil
+import subprocess
+import time
+import uuid
+from argparse import ArgumentParser, Namespace
+from pathlib import Path
+from typing import Callable, Dict, Optional
+
+from puppet_compiler import _log, directories, prepare
+from puppet_compiler.config import ControllerConfig
+
+
+class WorkspacePool:
+    """Workspaces cloned from the current HEAD of the long-lived repositories.
+
+    All the operations on a workspace are renames within the pool directory,
+    which has to be on the same filesystem as the jobs directories, so that
+    a workspace is claimed by exactly one job.
+
+    Arguments:
+        directory: the directory holding the workspaces
+        sources: the long-lived repositories, by checkout name (src, private, netbox-hiera)
+
+    """
+
+    stamp = ".workspace.json"
+
+    def __init__(self, directory: Path, sources: Dict[str, Path]) -> None:
+        self.directory = directory
+        self.sources = sources
+        self.ready_dir = directory / "ready"
+        self.building_dir = directory / "building"
+        self.trash_dir = directory / "trash"
+
+    @classmethod
+    def from_config(cls, config: ControllerConfig) -> "WorkspacePool":
+        """Return the pool of workspaces of a configuration"""
+        return cls(
+            config.base / "workspaces",
+            {"src": config.puppet_src, "private": config.puppet_private, "netbox-hiera": config.puppet_netbox},
+        )
+
+    @staticmethod
+    def _heads(repos: Dict[str, Path]) -> Optional[Dict[str, str]]:
+        heads = {}
+        for name, repo in repos.items():
+            if not Path(repo).is_dir():
+                return None
+            try:
+                heads[name] = subprocess.check_output(
+                    ["git", "rev-parse", "HEAD"], cwd=repo, text=True, stderr=subprocess.DEVNULL
+                ).strip()
+            except (subprocess.CalledProcessError, OSError) as error:
+                _log.warning("Unable to get the revision of %s: %s", repo, error)
+                return None
+        return heads
+
+    def revisions(self) -> Optional[Dict[str, str]]:
+        """Return the current HEAD of the long-lived repositories, None if they are not local"""
+        return self._heads(self.sources)
+
+    def _read_stamp(self, workspace: Path) -> Optional[Dict[str, str]]:
+        try:
+            return json.loads((workspace / self.stamp).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def _trash(self, workspace: Path) -> None:
+        self.trash_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+        try:
+            workspace.rename(self.trash_dir / uuid.uuid4().hex)
+        except FileNotFoundError:
+            # Claimed by a job meanwhile
+            pass
+        except OSError as error:
+            _log.warning("Unable to trash workspace %s: %s", workspace, error)
+
+    def claim(self, dest: Path) -> bool:
+        """Move a workspace matching the current revisions in place
+
+        Arguments:
+            dest: where to move the workspace to, must not exist
+
+        Returns:
+            bool: True if a workspace was claimed, False otherwise
+
+        """
+        revisions = self.revisions()
+        if revisions is None or not self.ready_dir.is_dir():
+            return False
+        for workspace in self.ready_dir.iterdir():
+            if self._read_stamp(workspace) != revisions:
+                continue
+            try:
+                workspace.rename(dest)
+            except FileNotFoundError:
+                # Claimed by another job meanwhile
+                continue
+            _log.info("Claimed workspace %s as %s", workspace.name, dest)
+            return True
+        _log.info("No ready workspace for the current revisions, preparing %s from scratch", dest)
+        return False
+
+    def taint(self, workspace: Path) -> None:
+        """Mark a workspace as modified, so that it doesn't get back to the pool
+
+        Arguments:
+            workspace: the workspace to mark
+
+        """
+        try:
+            (workspace / self.stamp).unlink()
+        except FileNotFoundError:
+            pass
+
+    def recycle(self, workspace: Path) -> None:
+        """Give a workspace back to the pool, or to the reaper if it was modified
+
+        Arguments:
+            workspace: the workspace to recycle
+
+        """
+        if not workspace.is_dir():
+            return
+        if self._read_stamp(workspace) is None:
+            self._trash(workspace)
+            return
+        # Drop what the job added on top of the checkouts
+        for name in ["catalogs", "conf"]:
+            shutil.rmtree(workspace / name, True)
+        self.ready_dir.mkdir(mode=0o755, parents=True, exist_ok=True)
+        try:
+            workspace.rename(self.ready_dir / uuid.uuid4().hex)
+        except OSError as error:
+            _log.warning("Unable to recycle workspace %s: %s", workspace, error)
+            return
+        _log.info("Recycled workspace %s", workspace)
+
+    def fill(self, size: int, build: Callable[[Path], None]) -> None:
+        """Discard the outdated workspaces and build new ones up to size
+
+        Arguments:
+            size: the number of ready workspaces to keep
+            build: the function preparing a workspace in the given directory
+
+        """
+        for path in [self.ready_dir, self.building_dir, self.trash_dir]:
+            path.mkdir(mode=0o755, parents=True, exist_ok=True)
+        with (self.directory / "fill.lock").open("w") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                _log.info("The pool %s is already being filled", self.directory)
+                return
+            revisions = self.revisions()
+            if revisions is None:
+                _log.error("The workspace pool only works with local repositories")
+                return
+
+            ready = 0
+            for workspace in self.ready_dir.iterdir():
+                if self._read_stamp(workspace) == revisions:
+                    ready += 1
+                else:
+                    _log.info("Discarding outdated workspace %s", workspace.name)
+                    self._trash(workspace)
+            # Leftovers of interrupted builds
+            for workspace in self.building_dir.iterdir():
+                self._trash(workspace)
+            for workspace in self.trash_dir.iterdir():
+                shutil.rmtree(workspace, True)
+
+            for _ in range(size - ready):
+                workspace = self.building_dir / uuid.uuid4().hex
+                _log.info("Building workspace %s", workspace.name)
+                workspace.mkdir(mode=0o755)
+                build(workspace)
+                # The repositories might have been refreshed meanwhile
+                built = self._heads({name: workspace / name for name in self.sources})
+                (workspace / self.stamp).write_text(json.dumps(built))
+                workspace.rename(self.ready_dir / workspace.name)
+
+
+def get_args() -> Namespace:
+    """Get Arguments"""
+    parser = ArgumentParser(description="Keep the pool of workspaces of the puppet compiler filled")
+    parser.add_argument(
+        "--config",
+        default="/etc/puppet-compiler.conf",
+        type=Path,
+        help="The config file of the puppet compiler",
+    )
+    parser.add_argument(
+        "--interval", default=0, type=int, help="Refill the pool every interval seconds, only once if 0"
+    )
+    parser.add_argument("--debug", action="store_true", default=False, help="Print debug output")
+    return parser.parse_args()
+
+
+def main() -> None:
+    """Main Entry"""
+    args = get_args()
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s: %(message)s",
+        level=logging.DEBUG if args.debug else logging.INFO,
+        datefmt="[ %Y-%m-%dT%H:%M:%S ]",
+    )
+    config = ControllerConfig.from_file(args.config, {})
+    if not config.workspace_pool_size:
+        _log.error("The workspace pool is disabled (workspace_pool_size: 0)")
+        return
+    directories.FHS.setup(0, 0, config.base)
+    managecode = prepare.ManageCode(config, 0, 0)
+    pool = WorkspacePool.from_config(config)
+    while True:
+        pool.fill(config.workspace_pool_size, managecode._prepare_dir)  # pylint: disable=protected-access
+        if not args.interval:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
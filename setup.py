@@ -57,13 +57,15 @@ setup(
     install_requires=install_requires,
     zip_safe=True,
     packages=find_packages(),
-    package_data={"puppet_compiler": get_templates()},
+    package_data={"puppet_compiler": get_templates() + ["files/*.rb"]},
     entry_points={
         "console_scripts": [
             "puppet-compiler = puppet_compiler.cli:main",
             "puppetdb-populate = puppet_compiler.populate_puppetdb:main",
+            "puppetdb-export-index = puppet_compiler.puppetdb:main",
             "pcc-debug-host = puppet_compiler.debug_host:main",
             "pcc-debug-presentation = puppet_compiler.debug_presentation:main",
+            "pcc-workspace-pool = puppet_compiler.workspace_pool:main",
         ],
     },
 )
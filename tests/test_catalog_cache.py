@@ -0,0 +1,88 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import mock
+
+from puppet_compiler.catalog_cache import CatalogCache
+
+FACTS = """--- !ruby/object:Puppet::Node::Facts
+expiration: '{date}'
+name: test.example.com
+timestamp: '{date}'
+values:
+  fqdn: test.example.com
+"""
+
+
+@mock.patch.dict(os.environ, {"PUPPET_VERSION_FULL": "7.23.0"})
+class TestCatalogCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.cache = CatalogCache(
+            self.tmpdir / "cache",
+            {"prod": ["src1", "private1", "netbox1"], "change": ["src2", "private1", "netbox1"]},
+            max_size=1000,
+            ttl=3600,
+        )
+        self.facts = self.tmpdir / "test.example.com.yaml"
+        self.facts.write_text(FACTS.format(date="2023-01-01 00:00:00"))
+        self.puppet_conf = self.tmpdir / "puppet.conf"
+        self.puppet_conf.write_text("[master]\nstoreconfigs = true\n")
+        self.catalog = self.tmpdir / "catalog.pson"
+        self.errors = self.tmpdir / "catalog.err"
+
+    def store(self, key, content):
+        self.catalog.write_text(content)
+        self.errors.write_text("")
+        self.cache.put(key, self.catalog, self.errors)
+
+    def test_key(self):
+        key = self.cache.key("prod", "production", self.facts, self.puppet_conf)
+        self.assertNotEqual(key, self.cache.key("change", "production", self.facts, self.puppet_conf))
+        self.assertNotEqual(key, self.cache.key("prod", "wmcs-eqiad1", self.facts, self.puppet_conf))
+        # Refreshing the facts dates does not change the key
+        self.facts.write_text(FACTS.format(date="2023-02-02 00:00:00"))
+        self.assertEqual(key, self.cache.key("prod", "production", self.facts, self.puppet_conf))
+        self.facts.write_text(FACTS.replace("fqdn: test", "fqdn: other").format(date="2023-02-02 00:00:00"))
+        self.assertNotEqual(key, self.cache.key("prod", "production", self.facts, self.puppet_conf))
+        with mock.patch.dict(os.environ, {"PUPPET_VERSION_FULL": "7.24.0"}):
+            self.assertNotEqual(key, self.cache.key("prod", "production", self.facts, self.puppet_conf))
+        # Neither can a catalog compiled with another puppet.conf be reused
+        key = self.cache.key("prod", "production", self.facts, self.puppet_conf)
+        self.puppet_conf.write_text("[master]\nstoreconfigs = false\n")
+        self.assertNotEqual(key, self.cache.key("prod", "production", self.facts, self.puppet_conf))
+
+    def test_get_put(self):
+        output = self.tmpdir / "output.pson"
+        output_errors = self.tmpdir / "output.err"
+        self.assertFalse(self.cache.get("abcdef", output, output_errors))
+        self.store("abcdef", "catalog")
+        self.assertTrue(self.cache.get("abcdef", output, output_errors))
+        self.assertEqual(output.read_text(), "catalog")
+        self.assertTrue(output_errors.is_file())
+        # Storing an existing entry again is harmless
+        self.store("abcdef", "other catalog")
+        self.assertTrue(self.cache.get("abcdef", output, output_errors))
+        self.assertEqual(output.read_text(), "catalog")
+        self.assertEqual(list((self.tmpdir / "cache" / "tmp").iterdir()), [])
+
+    def test_get_expired(self):
+        self.store("abcdef", "catalog")
+        entry = self.tmpdir / "cache" / "entries" / "ab" / "abcdef"
+        os.utime(entry / "catalog", (0, 0))
+        self.assertFalse(self.cache.get("abcdef", self.tmpdir / "output.pson", self.tmpdir / "output.err"))
+
+    def test_evict(self):
+        for key in ["aa1", "bb2", "cc3"]:
+            self.store(key, "x" * 400)
+        entries = self.tmpdir / "cache" / "entries"
+        os.utime(entries / "aa" / "aa1", (100, 100))
+        os.utime(entries / "bb" / "bb2", (300, 300))
+        os.utime(entries / "cc" / "cc3", (200, 200))
+        self.cache.evict()
+        self.assertEqual(sorted(path.name for path in entries.glob("*/*")), ["bb2", "cc3"])
+        self.cache.max_size = 0
+        self.cache.evict()
+        self.assertEqual(list(entries.glob("*/*")), [])
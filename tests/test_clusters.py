@@ -0,0 +1,73 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from puppet_compiler.clusters import fingerprint, representatives
+
+FACTS = """--- !ruby/object:Puppet::Node::Facts
+name: {name}
+values:
+  networking:
+    domain: {domain}
+  os:
+    distro:
+      codename: {codename}
+  uptime: {name}
+"""
+
+
+class TestClusters(unittest.TestCase):
+    def setUp(self):
+        facts_dir = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.facts_files = {}
+        for name, codename in [
+            ("mw1001.eqiad.wmnet", "bullseye"),
+            ("mw1002.eqiad.wmnet", "bullseye"),
+            ("mw1003.eqiad.wmnet", "bullseye"),
+            ("mw1004.eqiad.wmnet", "bullseye"),
+            ("mw1005.eqiad.wmnet", "buster"),
+        ]:
+            self.facts_files[name] = facts_dir / f"{name}.yaml"
+            self.facts_files[name].write_text(FACTS.format(name=name, domain="eqiad.wmnet", codename=codename))
+        self.roles = {host: "mediawiki::appserver" for host in self.facts_files}
+        self.classes = {host: {"Role::Mediawiki::Appserver", "Profile::Base"} for host in self.facts_files}
+
+    def test_fingerprint(self):
+        self.assertEqual(
+            fingerprint("grafana", ["B", "A"], {"site": "eqiad"}), fingerprint("grafana", ["A", "B"], {"site": "eqiad"})
+        )
+        self.assertNotEqual(
+            fingerprint("grafana", [], {"site": "eqiad"}), fingerprint("grafana", [], {"site": "codfw"})
+        )
+        self.assertNotEqual(fingerprint("grafana", [], {}), fingerprint(None, [], {}))
+
+    def test_representatives(self):
+        self.classes["mw1004.eqiad.wmnet"].add("Profile::Debug")
+        picked = representatives(
+            list(self.facts_files) + ["nofacts1001.eqiad.wmnet"],
+            self.facts_files,
+            ["networking.domain", "os.distro.codename"],
+            self.classes,
+            self.roles,
+            count=1,
+            max_workers=2,
+        )
+        self.assertEqual(
+            picked,
+            {
+                "mw1001.eqiad.wmnet": ["mw1002.eqiad.wmnet", "mw1003.eqiad.wmnet"],
+                # Different classes
+                "mw1004.eqiad.wmnet": [],
+                # Different facts
+                "mw1005.eqiad.wmnet": [],
+                "nofacts1001.eqiad.wmnet": [],
+            },
+        )
+
+    def test_representatives_count(self):
+        picked = representatives(
+            list(self.facts_files)[:4], self.facts_files, ["os.distro.codename"], self.classes, self.roles, count=2
+        )
+        self.assertEqual(
+            picked, {"mw1001.eqiad.wmnet": ["mw1003.eqiad.wmnet"], "mw1002.eqiad.wmnet": ["mw1004.eqiad.wmnet"]}
+        )
@@ -0,0 +1,79 @@
+import sys
+import tempfile
+from pathlib import Path
+
+from aiounittest import AsyncTestCase
+
+from puppet_compiler.compiler_pool import CompilerPool, CompilerProcessError
+
+# Mimics files/batch_compile.rb, writing the settings it was started with as the catalog
+FAKE_DRIVER = """
+import json, os, sys
+for line in sys.stdin:
+    request = json.loads(line)
+    if request["node"] == "crash.example.com":
+        sys.exit(1)
+    with open(request["catalog"], "w") as catalog:
+        catalog.write(" ".join([str(os.getpid())] + sys.argv[1:]))
+    open(request["errors"], "w").close()
+    status = 1 if request["node"].startswith("fail") else 0
+    print(json.dumps({"node": request["node"], "status": status}), flush=True)
+"""
+
+
+class TestCompilerPool(AsyncTestCase):
+    def setUp(self):
+        self.tmpdir = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.pool = CompilerPool(max_compiles=2, command=[sys.executable, "-c", FAKE_DRIVER])
+
+    def cmd(self, label, hostname):
+        return ["puppet", "catalog", "compile", "--render-as=rich_data_json", f"--confdir=/{label}", hostname]
+
+    async def compile(self, label, hostname):
+        catalog = self.tmpdir / f"{label}.{hostname}.pson"
+        status = await self.pool.compile(
+            self.cmd(label, hostname), {}, hostname, catalog, self.tmpdir / f"{label}.{hostname}.err"
+        )
+        return status, catalog.read_text().split()
+
+    def test_settings(self):
+        self.assertEqual(CompilerPool.settings(self.cmd("prod", "test.example.com")), ["--confdir=/prod"])
+
+    async def test_compile(self):
+        try:
+            status, (pid, settings) = await self.compile("prod", "test.example.com")
+            self.assertEqual(status, 0)
+            self.assertEqual(settings, "--confdir=/prod")
+            self.assertEqual(self.pool.idle_pids(), [int(pid)])
+            # The process is reused for the same settings
+            status, (second_pid, _) = await self.compile("prod", "fail.example.com")
+            self.assertEqual(status, 1)
+            self.assertEqual(second_pid, pid)
+            # ...up to max_compiles catalogs
+            _, (third_pid, _) = await self.compile("prod", "test.example.com")
+            self.assertNotEqual(third_pid, pid)
+            # Different settings get a different process
+            _, (change_pid, settings) = await self.compile("change", "test.example.com")
+            self.assertNotIn(change_pid, [pid, third_pid])
+            self.assertEqual(settings, "--confdir=/change")
+
+            with self.assertRaises(CompilerProcessError):
+                await self.compile("prod", "crash.example.com")
+            # The dead process has been discarded
+            status, _ = await self.compile("prod", "test.example.com")
+            self.assertEqual(status, 0)
+        finally:
+            await self.pool.close()
+
+    async def test_max_idle(self):
+        self.pool.max_idle = 2
+        try:
+            _, (prod_pid, _) = await self.compile("prod", "test.example.com")
+            _, (change_pid, _) = await self.compile("change", "test.example.com")
+            _, (other_pid, _) = await self.compile("other", "test.example.com")
+            # The process idle for the longest has been stopped
+            self.assertEqual(sorted(self.pool.idle_pids()), sorted([int(change_pid), int(other_pid)]))
+            _, (new_pid, _) = await self.compile("prod", "test.example.com")
+            self.assertNotEqual(new_pid, prod_pid)
+        finally:
+            await self.pool.close()
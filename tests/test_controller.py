@@ -1,7 +1,10 @@
+import asyncio
 import os
+import tempfile
 from pathlib import Path
 
 import mock
+import requests
 import requests_mock
 from aiounittest import AsyncTestCase  # type: ignore
 
@@ -90,6 +93,7 @@ class TestController(AsyncTestCase):
     async def test_run_single_host(self, run_host_mock, _html, _json):
         # TODO: Improve this tests
         c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
+        c.config.cache_dir = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
         run_host_mock.return_value = RunHostResult(
             hostname="test.eqiad.wmflabs", base_error=False, change_error=False, has_diff=False, has_core_diff=False
         )
@@ -110,9 +114,24 @@ class TestController(AsyncTestCase):
         )
         with mock.patch("time.sleep"):
             run_failed = await c.run()
-        c.managecode.refresh.assert_has_calls([mock.call("/src"), mock.call("/private")])
+        # The repositories are refreshed concurrently
+        c.managecode.refresh.assert_has_calls(
+            [mock.call("/src"), mock.call("/private"), mock.call("/netbox-hiera")], any_order=True
+        )
         self.assertFalse(run_failed)
 
+    @mock.patch("puppet_compiler.utils.refresh_yaml_date")
+    async def test_refresh_facts(self, refresh_mock):
+        c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
+        c.config.puppet_var = self.fixtures / "puppet_var"
+        refresh_mock.side_effect = [True, False]
+        await c.refresh_facts(["test.eqiad.wmnet", "test.example.com", "missing.example.com"])
+        facts_dir = self.fixtures / "puppet_var" / "yaml" / "facts"
+        self.assertCountEqual(
+            [call.args[0] for call in refresh_mock.call_args_list],
+            [facts_dir / "test.eqiad.wmnet.yaml", facts_dir / "test.example.com.yaml"],
+        )
+
     def test_pick_hosts(self):
         # Initialize a simple controller
         c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
@@ -137,6 +156,47 @@ class TestController(AsyncTestCase):
         s = c.prod_hosts
         assert s == s1 or s == s2
 
+    @mock.patch("puppet_compiler.nodegen.get_nodes_puppetdb_many")
+    @mock.patch("puppet_compiler.clusters.representatives")
+    def test_pick_representatives(self, representatives_mock, puppetdb_mock):
+        c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
+        self.assertEqual(c.represented, {})
+        c.config.puppet_var = self.fixtures / "puppet_var"
+        c.config.storeconfigs = False
+        c.config.cluster_representatives = 1
+        representatives_mock.return_value = {"test1.eqiad.wmnet": ["test2.eqiad.wmnet"]}
+        puppetdb_mock.return_value = {
+            "test1.eqiad.wmnet",
+            "test2.eqiad.wmnet",
+            "missing.eqiad.wmnet",
+            "test.eqiad.wmnet",
+        }
+        c.pick_hosts("O:test,test.eqiad.wmnet")
+        # The hosts listed explicitly are always compiled
+        self.assertEqual(c.prod_hosts, {"test1.eqiad.wmnet", "test.eqiad.wmnet"})
+        self.assertEqual(c.represented, {"test1.eqiad.wmnet": ["test2.eqiad.wmnet"]})
+        hosts, facts_files, fact_names, classes, roles, count, workers = representatives_mock.call_args[0]
+        self.assertEqual(hosts, {"test1.eqiad.wmnet", "test2.eqiad.wmnet", "missing.eqiad.wmnet"})
+        self.assertEqual(set(facts_files), {"test1.eqiad.wmnet", "test2.eqiad.wmnet"})
+        self.assertIn("os.distro.codename", fact_names)
+        self.assertEqual((classes, roles, count), ({}, {}, 1))
+
+        representatives_mock.reset_mock()
+        c.pick_hosts("test1.eqiad.wmnet,test2.eqiad.wmnet")
+        self.assertEqual(c.prod_hosts, {"test1.eqiad.wmnet", "test2.eqiad.wmnet"})
+        representatives_mock.assert_not_called()
+
+    @mock.patch("puppet_compiler.clusters.representatives")
+    def test_pick_representatives_puppetdb_error(self, representatives_mock):
+        c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
+        c.config.puppet_var = self.fixtures / "puppet_var"
+        c.config.cluster_representatives = 1
+        hosts = {"test1.eqiad.wmnet", "test2.eqiad.wmnet"}
+        with mock.patch("puppet_compiler.puppetdb.client") as client_mock:
+            client_mock.roles.side_effect = requests.HTTPError("414 Client Error: Request-URI Too Long")
+            self.assertEqual(c.pick_representatives(hosts), hosts)
+        representatives_mock.assert_not_called()
+
     @requests_mock.mock()
     def test_pick_puppetdb_hosts(self, r_mock):
         # Initialize a simple controller
@@ -276,3 +336,73 @@ class TestController(AsyncTestCase):
                 ]
             )
         )
+
+    @mock.patch("puppet_compiler.controller.Controller.generate_summary")
+    async def test_wait_for_tasks(self, generate_summary_mock):
+        c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
+        release = asyncio.Event()
+
+        async def run(hostname, error=False, wait=False):
+            if wait:
+                await release.wait()
+            if error:
+                raise ValueError(hostname)
+            return RunHostResult(
+                hostname=hostname, base_error=False, change_error=False, has_diff=None, has_core_diff=None
+            )
+
+        hosts = ["slow.eqiad.wmnet", "fast.eqiad.wmnet"]
+        tasks = [asyncio.create_task(run(hosts[0], wait=True)), asyncio.create_task(run(hosts[1]))]
+        asyncio.get_running_loop().call_later(0.01, release.set)
+        results = await c.wait_for_tasks(tasks=tasks)
+        # results are returned in the same order as the tasks
+        self.assertEqual([res.hostname for res in results], hosts)
+        self.assertEqual(c.states.getHosts("noop"), set(hosts))
+        # Both completions are rendered at once by the final flush
+        generate_summary_mock.assert_called_once_with(states_col=c.states, partial=True)
+
+        # With fail_fast the pending tasks get cancelled on the first failure
+        release.clear()
+        tasks = [asyncio.create_task(run(hosts[0], wait=True)), asyncio.create_task(run(hosts[1], error=True))]
+        results = await c.wait_for_tasks(tasks=tasks, fail_fast=True)
+        self.assertIsNone(results[0])
+        self.assertIsInstance(results[1], ValueError)
+        await asyncio.sleep(0)
+        self.assertTrue(tasks[0].cancelled())
+
+    async def test_summary_renderer(self):
+        render = mock.Mock()
+        summary = controller.SummaryRenderer(render=render, interval=0.05, batch=2)
+        summary.completed()
+        render.assert_not_called()
+        summary.completed()
+        self.assertEqual(render.call_count, 1)
+        # A lone completion gets rendered by the timer
+        summary.completed()
+        await asyncio.sleep(0.1)
+        self.assertEqual(render.call_count, 2)
+        # Nothing to render
+        summary.flush()
+        self.assertEqual(render.call_count, 2)
+
+    @mock.patch("puppet_compiler.controller.Controller.wait_for_tasks")
+    @mock.patch("puppet_compiler.worker.HostWorker")
+    async def test_run_hosts_longest_first(self, host_worker_mock, wait_for_tasks_mock):
+        c = controller.Controller(None, 19, 224570, "test.eqiad.wmnet")
+        c.managecode.update_config = mock.MagicMock()
+        wait_for_tasks_mock.return_value = []
+        await c.run_hosts(
+            {
+                "production": {"fast.eqiad.wmnet", "slow.eqiad.wmnet"},
+                "wmcs-eqiad1": {"test.tools.eqiad1.wikimedia.cloud"},
+            },
+            {"fast.eqiad.wmnet": 1, "slow.eqiad.wmnet": 100, "test.tools.eqiad1.wikimedia.cloud": 10},
+        )
+        self.assertEqual(
+            [call.args[1] for call in host_worker_mock.call_args_list],
+            ["slow.eqiad.wmnet", "test.tools.eqiad1.wikimedia.cloud", "fast.eqiad.wmnet"],
+        )
+        self.assertEqual(host_worker_mock.call_args_list[1].kwargs["realm"], "wmcs-eqiad1")
+        c.managecode.update_config.assert_has_calls([mock.call("production"), mock.call("wmcs-eqiad1")])
+        for task in wait_for_tasks_mock.call_args.kwargs["tasks"]:
+            task.cancel()
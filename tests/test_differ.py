@@ -38,6 +38,10 @@ class TestPuppetResource(unittest.TestCase):
         other.__str__.return_value = "Hhvm::monitoring[test]"
         self.assertFalse(self.r.is_same_of(other))
 
+    def test_file(self):
+        self.assertIsNone(self.r.file)
+        self.assertEqual(PuppetResource({**self.raw_resource, "file": "/src/init.pp", "line": 3}).file, "/src/init.pp")
+
     def test_equality(self):
         other = PuppetResource(self.raw_resource)
         self.assertEqual(self.r, other)
@@ -83,6 +87,17 @@ class TestPuppetCatalog(unittest.TestCase):
         self.assertEqual(self.orig.name, "test123.test")
         self.assertIsInstance(self.orig.resources, dict)
 
+    def test_source_files(self):
+        self.assertEqual(
+            self.orig.source_files,
+            {
+                "/tmp/testspc/change/src/modules/profile/manifests/base.pp",
+                "/tmp/testspc/change/src/modules/base/manifests/kernel.pp",
+                "/tmp/testspc/change/src/modules/base/manifests/debdeploy.pp",
+                "/tmp/testspc/change/src/modules/sslcert/manifests/init.pp",
+            },
+        )
+
     def test_core_resources(self):
         """Test core resources."""
         # The lists below are not exhaustive and only contain resources in the test catalogue
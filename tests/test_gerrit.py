@@ -0,0 +1,32 @@
+import unittest
+
+import requests
+import requests_mock
+
+from puppet_compiler.gerrit import GerritClient
+
+CHANGE_URL = "https://gerrit.example.org/r/changes/12345?o=CURRENT_REVISION"
+
+
+class TestGerritClient(unittest.TestCase):
+    def setUp(self):
+        self.client = GerritClient("https://gerrit.example.org/r/")
+
+    @requests_mock.mock()
+    def test_change(self, r_mock):
+        r_mock.get(CHANGE_URL, text=')]}\'\n{"project": "operations/puppet"}\n')
+        self.assertEqual(self.client.change(12345), {"project": "operations/puppet"})
+        # Responses are cached by url
+        self.assertEqual(self.client.get(CHANGE_URL), {"project": "operations/puppet"})
+        self.assertEqual(r_mock.call_count, 1)
+        self.client.clear()
+        self.client.change(12345)
+        self.assertEqual(r_mock.call_count, 2)
+
+    @requests_mock.mock()
+    def test_get(self, r_mock):
+        r_mock.get("https://gerrit.example.org/r/changes/12345/revisions/abc/files", json={"/COMMIT_MSG": {}})
+        self.assertEqual(self.client.get("/changes/12345/revisions/abc/files"), {"/COMMIT_MSG": {}})
+        r_mock.get(CHANGE_URL, status_code=404)
+        with self.assertRaises(requests.HTTPError):
+            self.client.change(12345)
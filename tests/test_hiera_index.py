@@ -0,0 +1,147 @@
+import os
+import tempfile
+import unittest
+from pathlib import Path
+
+import mock
+
+from puppet_compiler import hiera_index, utils
+from puppet_compiler.config import ControllerConfig
+from puppet_compiler.hiera_index import HieraIndex, hierarchy_paths, resolve
+
+HIERA = """
+version: 5
+defaults:
+  datadir: /etc/puppet/hieradata
+  data_hash: yaml_data
+hierarchy:
+  - name: "Netbox - hosts"
+    datadir: "/etc/puppet/netbox-hiera"
+    path: "hosts/%{trusted.certname}.yaml"
+  - name: "Private hosts"
+    datadir: "/etc/puppet/private/hieradata"
+    path: "hosts/%{::trusted.certname}.yaml"
+  - name: "Hosts"
+    path: "hosts/%{::trusted.certname}.yaml"
+  - name: "Role"
+    path: "role/%{::site}/%{::_role}.yaml"
+  - name: "Expand path"
+    lookup_key: wmflib::expand_path
+    path: "common/%{::site}"
+  - name: "Common"
+    paths:
+      - "%{facts.os.family}.yaml"
+      - "common/%{::site}.yaml"
+      - "common.yaml"
+"""
+
+FACTS = """--- !ruby/object:Puppet::Node::Facts
+name: {name}
+values:
+  site: {site}
+  os:
+    family: Debian
+"""
+
+
+class TestHieraIndex(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        hiera_dir = self.base / "src" / "modules" / "puppetmaster" / "files" / "hiera"
+        hiera_dir.mkdir(parents=True)
+        (hiera_dir / "production.yaml").write_text(HIERA)
+        self.facts_dir = self.base / "puppet" / "yaml" / "facts"
+        self.facts_dir.mkdir(parents=True)
+        self.facts_files = {}
+        for name, site in [
+            ("mw1001.eqiad.wmnet", "eqiad"),
+            ("mw1002.eqiad.wmnet", "eqiad"),
+            ("mw2001.codfw.wmnet", "codfw"),
+            ("db1001.eqiad.wmnet", "eqiad"),
+        ]:
+            self.facts_files[name] = self.facts_dir / f"{name}.yaml"
+            self.facts_files[name].write_text(FACTS.format(name=name, site=site))
+        self.roles = {
+            "mw1001.eqiad.wmnet": {"_role": "mediawiki/appserver"},
+            "mw1002.eqiad.wmnet": {"_role": "mediawiki/appserver"},
+            "mw2001.codfw.wmnet": {"_role": "mediawiki/appserver"},
+        }
+        self.index = HieraIndex.for_realm(self.base / "src", "production", self.base / "cache")
+
+    def test_hierarchy_paths(self):
+        self.assertEqual(
+            self.index.hierarchy,
+            [
+                "hieradata/hosts/%{::trusted.certname}.yaml",
+                "hieradata/role/%{::site}/%{::_role}.yaml",
+                "hieradata/common/%{::site}/*",
+                "hieradata/%{facts.os.family}.yaml",
+                "hieradata/common/%{::site}.yaml",
+                "hieradata/common.yaml",
+            ],
+        )
+        self.assertEqual(hierarchy_paths({}), [])
+
+    def test_resolve(self):
+        self.assertEqual(
+            resolve("hieradata/role/%{::site}/%{::_role}.yaml", {"site": "eqiad"}), "hieradata/role/eqiad/*.yaml"
+        )
+
+    def test_hosts_reading(self):
+        self.index.update(self.facts_files, self.roles, max_workers=2)
+        self.assertEqual(
+            self.index.hosts_reading(["hieradata/role/codfw/mediawiki/appserver.yaml"]), {"mw2001.codfw.wmnet"}
+        )
+        # Without a role, any role file might be read
+        self.assertEqual(
+            self.index.hosts_reading(["hieradata/role/eqiad/mediawiki/appserver.yaml"]),
+            {"mw1001.eqiad.wmnet", "mw1002.eqiad.wmnet", "db1001.eqiad.wmnet"},
+        )
+        self.assertEqual(self.index.hosts_reading(["hieradata/role/eqiad/other.yaml"]), {"db1001.eqiad.wmnet"})
+        self.assertEqual(self.index.hosts_reading(["hieradata/hosts/mw2001.yaml"]), set())
+        self.assertEqual(self.index.hosts_reading(["hieradata/hosts/mw2001.codfw.wmnet.yaml"]), {"mw2001.codfw.wmnet"})
+        self.assertEqual(self.index.hosts_reading(["hieradata/Debian.yaml"]), set(self.facts_files))
+        # The files read by lookup_key backends are anywhere below their path
+        self.assertEqual(
+            self.index.hosts_reading(["hieradata/common/codfw/profile/mediawiki.yaml"]), {"mw2001.codfw.wmnet"}
+        )
+        self.assertEqual(
+            self.index.representatives(self.index.hosts_reading(["hieradata/common.yaml"])),
+            {"mw1001.eqiad.wmnet", "mw2001.codfw.wmnet", "db1001.eqiad.wmnet"},
+        )
+
+    def test_update_incremental(self):
+        self.index.update(self.facts_files, self.roles, max_workers=2)
+        index = HieraIndex.for_realm(self.base / "src", "production", self.base / "cache")
+        self.assertEqual(index.hosts, self.index.hosts)
+        # The facts files not modified since the previous update aren't hashed again
+        with mock.patch("puppet_compiler.utils.facts_digest") as facts_digest:
+            index.update(self.facts_files, self.roles)
+        facts_digest.assert_not_called()
+        # Rewriting the facts files, e.g. refreshing their timestamps, keeps the hosts
+        for facts_file in self.facts_files.values():
+            facts_file.write_text(facts_file.read_text() + "timestamp: 2023-01-01 00:00:00.000000000 +00:00\n")
+        with mock.patch("puppet_compiler.hiera_index.ProcessPoolExecutor") as executor:
+            index.update(self.facts_files, self.roles)
+        executor.assert_not_called()
+        # Only the hosts whose facts changed are resolved again
+        self.facts_files["mw1001.eqiad.wmnet"].write_text(FACTS.format(name="mw1001.eqiad.wmnet", site="codfw"))
+        os.utime(self.facts_files["mw1001.eqiad.wmnet"], ns=(0, 0))
+        del self.facts_files["db1001.eqiad.wmnet"]
+        index.update(self.facts_files, self.roles, max_workers=1)
+        self.assertEqual(
+            index.hosts_reading(["hieradata/common/codfw.yaml"]), {"mw1001.eqiad.wmnet", "mw2001.codfw.wmnet"}
+        )
+        self.assertNotIn("db1001.eqiad.wmnet", index.hosts)
+
+    def test_select_hosts(self):
+        config = ControllerConfig(
+            puppet_src=self.base / "src", puppet_var=self.base / "puppet", cache_dir=self.base / "cache"
+        )
+        with mock.patch.object(utils, "_facts_indexes", {}):
+            hosts = hiera_index.select_hosts(
+                config,
+                ["hieradata/role/codfw/mediawiki/appserver.yaml"],
+                {"mw2001.codfw.wmnet": "mediawiki::appserver"},
+            )
+        self.assertEqual(hosts, {"mw2001.codfw.wmnet"})
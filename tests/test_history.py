@@ -0,0 +1,28 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from puppet_compiler.history import CompileHistory
+
+
+class TestCompileHistory(unittest.TestCase):
+    def setUp(self):
+        self.history = CompileHistory(Path(tempfile.mkdtemp(prefix="puppet-compiler")) / "history.sqlite", default=42)
+
+    def test_estimates_no_history(self):
+        self.assertEqual(self.history.estimates(["test.example.com"]), {"test.example.com": 42})
+
+    def test_record(self):
+        self.history.record({"fast.example.com": 10, "slow.example.com": 100, "other.example.com": 20})
+        self.history.record({"slow.example.com": 200})
+        estimates = self.history.estimates(["fast.example.com", "slow.example.com", "new.example.com"])
+        self.assertEqual(estimates["fast.example.com"], 10)
+        # moving average of the runs
+        self.assertEqual(estimates["slow.example.com"], 150)
+        # hosts without history get the median
+        self.assertEqual(estimates["new.example.com"], 20)
+
+    def test_unusable_database(self):
+        history = CompileHistory(Path("/dev/null/history.sqlite"), default=42)
+        history.record({"test.example.com": 10})
+        self.assertEqual(history.estimates(["test.example.com"]), {"test.example.com": 42})
@@ -1,4 +1,8 @@
+import asyncio
+import logging
+import os
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 import mock
@@ -6,7 +10,9 @@ from aiounittest import AsyncTestCase
 from aiounittest.helpers import futurized
 
 from puppet_compiler import controller, puppet, worker
+from puppet_compiler.catalog_cache import CatalogCache
 from puppet_compiler.directories import FHS
+from puppet_compiler.presentation import html, json
 from puppet_compiler.utils import FactsFileNotFound
 
 
@@ -40,8 +46,8 @@ class TestHostWorker(AsyncTestCase):
         # Verify simple calls
         err = await self.hw._compile_all()
         calls = [
-            mock.call("test.example.com", "prod", self.c.config.puppet_var, None),
-            mock.call("test.example.com", "change", self.c.config.puppet_var, None),
+            mock.call("test.example.com", "prod", self.c.config.puppet_var, None, realm=None, compiler_pool=None),
+            mock.call("test.example.com", "change", self.c.config.puppet_var, None, realm=None, compiler_pool=None),
         ]
         compile_mock.assert_has_calls(calls)
         self.assertEqual(err, (False, False))
@@ -66,13 +72,84 @@ class TestHostWorker(AsyncTestCase):
         self.assertEqual(base_error, False)
         self.assertEqual(change_error, True)
 
+    @mock.patch("puppet_compiler.puppet.compile")
+    async def test_compile_all_parallel(self, compile_mock):
+        slots = asyncio.Semaphore(2)
+        self.hw = worker.HostWorker(self.c.config.puppet_var, "test.example.com", compile_slots=slots)
+        running = []
+
+        async def compile_side_effect(hostname, env, *args, **kwargs):
+            running.append(env)
+            # both compilations are started before any of them finishes
+            await asyncio.sleep(0.01)
+            self.assertCountEqual(running, ["prod", "change"])
+            if env == "change":
+                raise puppet.CompilationFailedError(command=["dummy", "command"], return_code=30)
+
+        compile_mock.side_effect = compile_side_effect
+        self.assertEqual(await self.hw._compile_all(), (False, True))
+
+        # The compilations are bound by the available slots
+        running.clear()
+        slots = asyncio.Semaphore(1)
+        self.hw = worker.HostWorker(self.c.config.puppet_var, "test.example.com", compile_slots=slots)
+
+        async def check_slots(*args, **kwargs):
+            self.assertTrue(slots.locked())
+
+        compile_mock.side_effect = check_slots
+        self.assertEqual(await self.hw._compile_all(), (False, False))
+
+    @mock.patch("puppet_compiler.puppet.compile")
+    async def test_compile_catalog_cache(self, compile_mock):
+        cache = mock.Mock(spec=CatalogCache)
+        cache.key.side_effect = lambda env, realm, facts_file, puppet_conf: f"{env}-{realm}"
+        # Only the production catalog is in the cache
+        cache.get.side_effect = lambda key, catalog, errors: key == "prod-production"
+        self.hw = worker.HostWorker(self.c.config.puppet_var, "test.example.com", catalog_cache=cache)
+        self.assertEqual(await self.hw._compile_all(), (False, False))
+        compile_mock.assert_called_once_with(
+            "test.example.com", "change", self.c.config.puppet_var, None, realm=None, compiler_pool=None
+        )
+        # The key covers the puppet.conf each catalog is compiled with
+        cache.key.assert_any_call("prod", "production", self.hw.facts_file(), FHS.prod_dir / "src" / "puppet.conf")
+        cache.key.assert_any_call("change", "production", self.hw.facts_file(), FHS.change_dir / "src" / "puppet.conf")
+        cache.put.assert_called_once_with(
+            "change-production",
+            self.hw._files.file_for("change", "catalog"),
+            self.hw._files.file_for("change", "errors"),
+        )
+
+        # Failed compilations are not cached
+        cache.put.reset_mock()
+        compile_mock.side_effect = puppet.CompilationFailedError(command=["dummy", "command"], return_code=30)
+        self.assertEqual(await self.hw._compile_all(), (False, True))
+        cache.put.assert_not_called()
+
+        # The source files of a cached production catalog are not in this job's directories
+        self.hw.facts_file = mock.Mock(return_value=True)
+        self.hw._make_diff = mock.Mock(return_value=(True, True))
+        self.hw.sources = {"manifests/site.pp"}
+        self.hw._make_output = self.hw._build_html = self.hw._build_json = mock.Mock()
+        compile_mock.side_effect = None
+        self.assertIsNone((await self.hw.run_host()).sources)
+
     @mock.patch("puppet_compiler.worker.PuppetCatalog")
     def test_make_diff(self, puppetcatalog_mock):
         instance_mock = puppetcatalog_mock.return_value
         instance_mock.diff_if_present.return_value = None
+        instance_mock.source_files = {
+            str(FHS.prod_dir / "conf/production/modules/profile/manifests/base.pp"),
+            str(FHS.prod_dir / "src/manifests/site.pp"),
+            "/usr/share/puppet/modules/stdlib/manifests/init.pp",
+        }
         self.assertEqual(self.hw._make_diff(), (None, None))
         self.assertIsNone(self.hw.diffs)
         self.assertIsNone(self.hw.core_diffs)
+        self.assertEqual(self.hw.sources, {"modules/profile/manifests/base.pp", "manifests/site.pp"})
+        instance_mock.source_files = {"/srv/other/production/src/manifests/site.pp"}
+        self.hw._make_diff()
+        self.assertIsNone(self.hw.sources)
 
         puppetcatalog_mock.assert_has_calls(
             [
@@ -141,7 +218,8 @@ class TestHostWorker(AsyncTestCase):
                 hostname="test.example.com", base_error=False, change_error=False, has_diff=True, has_core_diff=True
             ),
         )
-        assert mocked_refresh_yaml_date.called
+        # The facts are refreshed by the controller before the run
+        mocked_refresh_yaml_date.assert_not_called()
         assert self.hw.facts_file.called
         assert self.hw._compile_all.called
         assert self.hw._make_diff.called
@@ -167,3 +245,46 @@ class TestHostWorker(AsyncTestCase):
                 hostname="test.example.com", base_error=True, change_error=False, has_diff=None, has_core_diff=None
             ),
         )
+
+    @mock.patch("puppet_compiler.worker.diff_and_render")
+    async def test_run_host_diff_executor(self, diff_and_render_mock):
+        self.hw.facts_file = mock.Mock(return_value=True)
+        self.hw._compile_all = mock.Mock(return_value=futurized((False, False)))
+        diff_and_render_mock.return_value = (True, None, {"manifests/site.pp"})
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.hw._diff_executor = executor
+            result = await self.hw.run_host()
+            diff_and_render_mock.assert_called_once_with(
+                self.c.config.puppet_var, "test.example.com", None, False, False
+            )
+            self.assertEqual(
+                result,
+                worker.RunHostResult(
+                    hostname="test.example.com",
+                    base_error=False,
+                    change_error=False,
+                    has_diff=True,
+                    has_core_diff=None,
+                    sources={"manifests/site.pp"},
+                ),
+            )
+            # A broken pool doesn't make the payload fail
+            diff_and_render_mock.side_effect = RuntimeError("Boom!")
+            result = await self.hw.run_host()
+        self.assertIsNone(result.has_diff)
+        self.assertFalse(result.base_error)
+
+    def test_setup_diff_process(self):
+        base = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        fhs = {name: getattr(FHS, name) for name in ["base_dir", "prod_dir", "change_dir", "diff_dir", "output_dir"]}
+        with mock.patch.multiple(FHS, **fhs), mock.patch.multiple(
+            html, change_id=None, job_id=None
+        ), mock.patch.multiple(json, change_id=None, job_id=None), mock.patch("logging.basicConfig") as basic_config:
+            pids = mock.Mock()
+            worker.setup_diff_process(base, 1234, 56, logging.DEBUG, pids)
+            pids.put.assert_called_once_with(os.getpid())
+            self.assertEqual(basic_config.call_args[1]["level"], logging.DEBUG)
+            self.assertEqual(FHS.prod_dir, base / "56" / "production")
+            self.assertEqual(FHS.output_dir, base / "output" / "1234" / "56")
+            self.assertEqual((html.change_id, html.job_id, json.change_id, json.job_id), (1234, 56, 1234, 56))
+        self.assertEqual(FHS.prod_dir, fhs["prod_dir"])
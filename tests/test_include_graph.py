@@ -0,0 +1,128 @@
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+import mock
+
+from puppet_compiler import include_graph
+from puppet_compiler.include_graph import IncludeGraph, node_for_path, references
+
+MANIFESTS = {
+    "modules/role/manifests/grafana.pp": "class role::grafana {\n    include ::profile::grafana\n}\n",
+    "modules/role/manifests/sretest.pp": "class role::sretest {\n    class { 'profile::sretest': }\n}\n",
+    "modules/profile/manifests/grafana.pp": (
+        "class profile::grafana {\n"
+        "    # include profile::commented\n"
+        "    include grafana, profile::base\n"
+        "    systemd::service { 'grafana':\n"
+        "        content => template('profile/grafana/unit.erb'),\n"
+        "    }\n"
+        "}\n"
+    ),
+    "modules/profile/manifests/sretest.pp": "class profile::sretest {\n    require profile::base\n}\n",
+    "modules/profile/manifests/base.pp": "class profile::base {\n    $x = wmflib::ensure_service(true)\n}\n",
+    "modules/grafana/manifests/init.pp": (
+        "class grafana {\n    file { '/etc/grafana': source => 'puppet:///modules/grafana/grafana.ini' }\n}\n"
+    ),
+    "modules/systemd/manifests/service.pp": "define systemd::service($content) {\n}\n",
+}
+
+
+def git(cwd, *args):
+    subprocess.check_call(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+class TestIncludeGraph(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.repo = self.base / "puppet"
+        self.repo.mkdir()
+        git(self.repo, "init", "-q")
+        for path, content in MANIFESTS.items():
+            self.commit(path, content)
+        self.cache_file = self.base / "cache" / "include_graph.json"
+
+    def commit(self, path, content):
+        (self.repo / path).parent.mkdir(parents=True, exist_ok=True)
+        (self.repo / path).write_text(content)
+        git(self.repo, "add", path)
+        git(self.repo, "commit", "-q", "-m", path)
+
+    def test_node_for_path(self):
+        self.assertEqual(node_for_path("modules/grafana/manifests/init.pp"), "grafana")
+        self.assertEqual(node_for_path("modules/profile/manifests/grafana/web.pp"), "profile::grafana::web")
+        self.assertEqual(
+            node_for_path("modules/profile/templates/grafana/unit.erb"), "template:profile/grafana/unit.erb"
+        )
+        self.assertEqual(node_for_path("modules/grafana/files/grafana.ini"), "file:grafana/grafana.ini")
+        self.assertEqual(
+            node_for_path("modules/wmflib/lib/puppet/functions/wmflib/ensure_service.rb"),
+            "function:wmflib::ensure_service",
+        )
+        self.assertEqual(node_for_path("modules/wmflib/functions/ensure_service.pp"), "function:wmflib::ensure_service")
+        self.assertIsNone(node_for_path("hieradata/common.yaml"))
+        self.assertIsNone(node_for_path("modules/grafana/spec/classes/grafana_spec.rb"))
+
+    def test_references(self):
+        self.assertEqual(
+            references(MANIFESTS["modules/profile/manifests/grafana.pp"]),
+            [
+                "function:template",
+                "grafana",
+                "profile::base",
+                "profile::grafana",
+                "systemd::service",
+                "template:profile/grafana/unit.erb",
+            ],
+        )
+
+    def test_roles(self):
+        graph = IncludeGraph.build(self.repo, self.cache_file)
+        self.assertEqual(
+            graph.roles(
+                [
+                    "modules/profile/manifests/base.pp",
+                    "modules/grafana/files/grafana.ini",
+                    "modules/profile/templates/grafana/unit.erb",
+                    "modules/wmflib/lib/puppet/functions/wmflib/ensure_service.rb",
+                    "modules/role/manifests/sretest.pp",
+                    "modules/profile/manifests/unused.pp",
+                    "README",
+                ]
+            ),
+            {
+                "modules/profile/manifests/base.pp": {"role::grafana", "role::sretest"},
+                "modules/grafana/files/grafana.ini": {"role::grafana"},
+                "modules/profile/templates/grafana/unit.erb": {"role::grafana"},
+                "modules/wmflib/lib/puppet/functions/wmflib/ensure_service.rb": {"role::grafana", "role::sretest"},
+                "modules/role/manifests/sretest.pp": {"role::sretest"},
+                "modules/profile/manifests/unused.pp": set(),
+            },
+        )
+        self.assertEqual(graph.reached_by("systemd::service"), {"role::grafana", "profile::grafana"})
+
+    def test_build_incremental(self):
+        IncludeGraph.build(self.repo, self.cache_file)
+        # The same tree is served from the cache
+        with mock.patch.object(IncludeGraph, "_read_blobs") as read_blobs:
+            IncludeGraph.build(self.repo, self.cache_file)
+        read_blobs.assert_not_called()
+        # Only the changed manifests are parsed again
+        self.commit("modules/role/manifests/sretest.pp", "class role::sretest {\n    include profile::grafana\n}\n")
+        with mock.patch.object(IncludeGraph, "_read_blobs", wraps=IncludeGraph._read_blobs) as read_blobs:
+            graph = IncludeGraph.build(self.repo, self.cache_file)
+        self.assertEqual(len(read_blobs.call_args[0][1]), 1)
+        self.assertEqual(
+            graph.roles(["modules/grafana/files/grafana.ini"]),
+            {"modules/grafana/files/grafana.ini": {"role::grafana", "role::sretest"}},
+        )
+
+    def test_cache_path(self):
+        config = mock.MagicMock(cache_dir=self.base)
+        self.assertEqual(include_graph.cache_path(config), self.base / "include_graph.json")
@@ -0,0 +1,80 @@
+import asyncio
+import os
+import tempfile
+from pathlib import Path
+
+from aiounittest import AsyncTestCase
+
+from puppet_compiler import limiter
+
+
+class TestAdaptiveLimiter(AsyncTestCase):
+    async def test_limit(self):
+        slots = limiter.AdaptiveLimiter(1, 1, 3)
+        order = []
+        release = asyncio.Event()
+
+        async def compile(name):
+            async with slots:
+                order.append(name)
+                await release.wait()
+
+        tasks = [asyncio.create_task(compile(name)) for name in ["first", "second", "third"]]
+        await asyncio.sleep(0)
+        self.assertEqual(order, ["first"])
+        # Raising the limit wakes up the waiters, in order
+        slots.limit = 2
+        await asyncio.sleep(0)
+        self.assertEqual(order, ["first", "second"])
+        self.assertEqual(slots.active, 2)
+        # The limit stays within bounds
+        slots.limit = 10
+        self.assertEqual(slots.limit, 3)
+        release.set()
+        await asyncio.gather(*tasks)
+        self.assertEqual(order, ["first", "second", "third"])
+        self.assertEqual(slots.active, 0)
+
+    async def test_cancel_waiter(self):
+        slots = limiter.AdaptiveLimiter(1, 1, 1)
+        async with slots:
+            waiter = asyncio.create_task(slots.__aenter__())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.sleep(0)
+        self.assertEqual(slots.active, 0)
+
+    async def test_adjust(self):
+        slots = limiter.AdaptiveLimiter(2, 1, 4)
+        slots.active = 2
+        gib = 1 << 30
+        # Lots of free resources and saturated: go up
+        self.assertEqual(slots.adjust(load=0.1, mem_available=16 * gib, rss=2 * gib), 3)
+        # Nothing to say
+        self.assertEqual(slots.adjust(load=0.8, mem_available=16 * gib, rss=2 * gib), 3)
+        # Overloaded
+        self.assertEqual(slots.adjust(load=1.5, mem_available=16 * gib, rss=2 * gib), 2)
+        # Another compilation would not fit in memory
+        self.assertEqual(slots.adjust(load=0.1, mem_available=gib // 2, rss=2 * gib), 1)
+        self.assertEqual(slots.adjust(load=2, mem_available=gib // 2, rss=2 * gib), 1)
+        # Not saturated, no need to go up
+        slots.active = 0
+        self.assertEqual(slots.adjust(load=0.1, mem_available=16 * gib, rss=0), 1)
+
+    def test_memory_available(self):
+        meminfo = Path(tempfile.mkdtemp(prefix="puppet-compiler")) / "meminfo"
+        meminfo.write_text("MemTotal:       32768000 kB\nMemAvailable:    1024 kB\n")
+        self.assertEqual(limiter.memory_available(meminfo), 1024 * 1024)
+        self.assertIsNone(limiter.memory_available(meminfo.parent / "missing"))
+
+    async def test_children_rss(self):
+        if not Path("/proc/self/task").is_dir():
+            self.skipTest("No /proc filesystem")
+        proc = await asyncio.create_subprocess_exec("sleep", "10")
+        try:
+            rss = limiter.children_rss(os.getpid())
+            self.assertGreater(rss, 0)
+            self.assertLess(limiter.children_rss(os.getpid(), exclude=[proc.pid]), rss)
+        finally:
+            proc.kill()
+            await proc.wait()
@@ -0,0 +1,61 @@
+import re
+import shutil
+import tempfile
+import unittest
+from pathlib import Path
+
+import mock
+
+from puppet_compiler.nodegen import NodeFinder, PrefixMatcher, literal_prefix
+
+
+class TestPrefixMatcher(unittest.TestCase):
+    def test_literal_prefix(self):
+        self.assertEqual(literal_prefix(r"^mw1\d{3}\.eqiad\.wmnet$"), "mw1")
+        self.assertEqual(literal_prefix(r"^db-test1\.codfw"), "db-test1.codfw")
+        self.assertEqual(literal_prefix(r"^an-worker10(7[89]|8)\."), "an-worker10")
+        # Optional characters are not part of the prefix
+        self.assertEqual(literal_prefix(r"^ab?c"), "a")
+        self.assertEqual(literal_prefix(r"mw1\d{3}"), "")
+        self.assertEqual(literal_prefix(r"^mw1|^db1"), "")
+        self.assertEqual(literal_prefix(r"^(mw|db)1"), "")
+
+    def test_search(self):
+        regexes = [re.compile(pattern) for pattern in [r"^mw1\d{3}\.", r"^mw2\d{3}\.", r"^db1", r"\.wikimedia\.cloud$"]]
+        matcher = PrefixMatcher(regexes)
+        self.assertEqual(matcher.search("mw1001.eqiad.wmnet"), regexes[0])
+        self.assertEqual(matcher.search("mw2001.codfw.wmnet"), regexes[1])
+        self.assertEqual(matcher.search("test.wikimedia.cloud"), regexes[3])
+        self.assertIsNone(matcher.search("db2001.codfw.wmnet"))
+        self.assertIsNone(matcher.search("m"))
+        matcher.discard(regexes[0])
+        self.assertIsNone(matcher.search("mw1002.eqiad.wmnet"))
+
+
+class TestNodeFinder(unittest.TestCase):
+    def setUp(self):
+        self.sitepp = Path(tempfile.mkdtemp(prefix="puppet-compiler")) / "site.pp"
+        shutil.copy(Path(__file__).parent / "fixtures" / "manifests" / "site.pp", self.sitepp)
+
+    def test_match_physical_nodes(self):
+        finder = NodeFinder(self.sitepp)
+        nodes = ["test.eqiad.wmnet", "test1.eqiad.wmnet", "test2.eqiad.wmnet", "other.eqiad.wmnet"]
+        # Each regex selects one node
+        self.assertEqual(finder.match_physical_nodes(nodes), {"test.eqiad.wmnet", "test1.eqiad.wmnet"})
+
+    def test_parse_cached(self):
+        cache_dir = self.sitepp.parent / "cache"
+        finder = NodeFinder(self.sitepp, cache_dir)
+        self.assertEqual(finder.nodes, {"test.eqiad.wmnet"})
+        self.assertEqual(len(list(cache_dir.glob("*.json"))), 1)
+        # Matching doesn't alter the cached site.pp
+        finder.match_physical_nodes(["test.eqiad.wmnet"])
+        with mock.patch.object(NodeFinder, "exact_node") as exact_node:
+            self.assertEqual(NodeFinder(self.sitepp, cache_dir).nodes, {"test.eqiad.wmnet"})
+        exact_node.search.assert_not_called()
+        # A different content is parsed again
+        self.sitepp.write_text("node 'other.eqiad.wmnet' {\n}\n")
+        finder = NodeFinder(self.sitepp, cache_dir)
+        self.assertEqual(finder.nodes, {"other.eqiad.wmnet"})
+        self.assertEqual(finder.regexes, set())
+        self.assertEqual(len(list(cache_dir.glob("*.json"))), 2)
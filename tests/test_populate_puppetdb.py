@@ -0,0 +1,88 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+import mock
+
+from puppet_compiler import populate_puppetdb
+from puppet_compiler.config import ControllerConfig
+
+FACTS = """--- !ruby/object:Puppet::Node::Facts
+name: {name}
+values:
+  site: eqiad
+timestamp: 2023-01-01 00:00:00.000000000 +00:00
+expiration: 2023-01-02 00:00:00.000000000 +00:00
+"""
+
+
+class TestPopulatePuppetdb(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.facts_dir = self.base / "puppet" / "yaml" / "facts"
+        self.facts_dir.mkdir(parents=True)
+        self.nodes = ["test1.eqiad.wmnet", "test2.eqiad.wmnet", "test3.eqiad.wmnet"]
+        for node in self.nodes:
+            (self.facts_dir / f"{node}.yaml").write_text(FACTS.format(name=node))
+        self.realms = {node: "production" for node in self.nodes}
+        self.cfg = ControllerConfig(puppet_var=self.base / "puppet")
+        self.state_file = self.base / "state.json"
+
+    @mock.patch("puppet_compiler.populate_puppetdb.populate_node")
+    def test_populate_nodes(self, populate_node):
+        populate_node.side_effect = lambda node, cfg, debug, realm: node != "test2.eqiad.wmnet"
+        self.realms["test3.eqiad.wmnet"] = "wmcs-eqiad1"
+        summary = populate_puppetdb.populate_nodes(self.realms, self.cfg, False, 2)
+        self.assertEqual(summary, {"ok": 2, "failed": 1, "skipped": 0})
+        # The nodes of both realms are populated in the same pool, each with its realm
+        self.assertEqual(
+            sorted((call[0][0], call[0][3]) for call in populate_node.call_args_list),
+            [
+                ("test1.eqiad.wmnet", "production"),
+                ("test2.eqiad.wmnet", "production"),
+                ("test3.eqiad.wmnet", "wmcs-eqiad1"),
+            ],
+        )
+
+    @mock.patch("puppet_compiler.populate_puppetdb.populate_node")
+    def test_populate_nodes_incremental(self, populate_node):
+        populate_node.side_effect = lambda node, cfg, debug, realm: node != "test2.eqiad.wmnet"
+        state = populate_puppetdb.load_state(self.state_file)
+        self.assertEqual(state, {})
+        populate_puppetdb.populate_nodes(self.realms, self.cfg, False, 2, state, "rev1", self.state_file)
+        # Only the successful nodes are recorded
+        state = populate_puppetdb.load_state(self.state_file)
+        self.assertEqual(sorted(state), ["test1.eqiad.wmnet", "test3.eqiad.wmnet"])
+
+        populate_node.reset_mock()
+        # Refreshing the timestamps doesn't change the facts
+        (self.facts_dir / "test1.eqiad.wmnet.yaml").write_text(
+            FACTS.format(name="test1.eqiad.wmnet").replace("2023-01-0", "2024-01-0")
+        )
+        summary = populate_puppetdb.populate_nodes(self.realms, self.cfg, False, 2, state, "rev1", self.state_file)
+        self.assertEqual(summary, {"ok": 0, "failed": 1, "skipped": 2})
+        populate_node.assert_called_once_with("test2.eqiad.wmnet", self.cfg, False, "production")
+
+        populate_node.reset_mock()
+        (self.facts_dir / "test1.eqiad.wmnet.yaml").write_text(
+            FACTS.format(name="test1.eqiad.wmnet").replace("site: eqiad", "site: codfw")
+        )
+        summary = populate_puppetdb.populate_nodes(
+            {"test1.eqiad.wmnet": "production"}, self.cfg, False, 2, state, "rev1"
+        )
+        self.assertEqual(summary, {"ok": 1, "failed": 0, "skipped": 0})
+        # A new code revision populates every node again
+        summary = populate_puppetdb.populate_nodes(self.realms, self.cfg, False, 2, state, "rev2")
+        self.assertEqual(summary, {"ok": 2, "failed": 1, "skipped": 0})
+
+    @mock.patch("puppet_compiler.puppet.compile_storeconfigs")
+    def test_populate_node(self, compile_storeconfigs):
+        compile_storeconfigs.return_value = (False, [b"out\n"], [b"Error: broken\n"])
+        with mock.patch("builtins.print") as mocked_print:
+            self.assertFalse(populate_puppetdb.populate_node("test1.eqiad.wmnet", self.cfg, True, "production"))
+        compile_storeconfigs.assert_called_once_with("test1.eqiad.wmnet", self.cfg.puppet_var, realm="production")
+        mocked_print.assert_called_once_with(
+            "\n".join(["=" * 80, "Compiling catalog for test1.eqiad.wmnet", "Error: broken", "out"])
+        )
+        with mock.patch("builtins.print"):
+            self.assertFalse(populate_puppetdb.populate_node("missing.eqiad.wmnet", self.cfg, False))
@@ -1,11 +1,14 @@
+import json
+import os
 import shutil
 import tempfile
 import unittest
 from pathlib import Path
 
 import mock
+import requests_mock
 
-from puppet_compiler import prepare
+from puppet_compiler import gerrit, prepare
 from puppet_compiler.config import ControllerConfig
 from puppet_compiler.directories import FHS
 
@@ -37,6 +40,7 @@ class TestManageCode(unittest.TestCase):
         FHS.setup(1, 19, cls.base)
 
     def setUp(self):
+        gerrit.client.clear()
         self.fixtures = Path(__file__).parent.resolve() / "fixtures"
         config = ControllerConfig(
             base=self.base,
@@ -84,9 +88,15 @@ class TestManageCode(unittest.TestCase):
             self.assertIn("node_terminus = exec", data)
             fn.unlink()
 
+    @requests_mock.mock()
     @mock.patch("subprocess.check_call")
-    def test_fetch_change(self, mocker):
+    def test_fetch_change(self, r_mock, mocker):
         """The change can be downloaded"""
+        for change_id, project in [(227450, "operations/puppet"), (363216, "operations/software")]:
+            r_mock.get(
+                f"https://gerrit.wikimedia.org/r/changes/{change_id}?o=CURRENT_REVISION",
+                text=")]}'\n" + json.dumps({"project": project, "revisions": {"abcdef": {"_number": 1}}}) + "\n",
+            )
         self.m._fetch_change(self.m.change_id)
         ref = "refs/changes/50/227450/1"
         calls = [
@@ -116,12 +126,73 @@ class TestManageCode(unittest.TestCase):
         exim_priv = self.m.prod_dir / "private/modules/privateexim"
         mock_symlink_to.assert_any_call(exim_priv)
 
-    @mock.patch("puppet_compiler.prepare.pushd")
-    def test_refresh(self, pushd):
+    def test_prepare_workspace_claimed(self):
+        dirname = self.base / "claimed"
+        (dirname / "src" / "modules").mkdir(parents=True)
+        # The symlinks of the workspace point to where it was built
+        (dirname / "src" / "modules" / "passwords").symlink_to("/elsewhere/private/modules/passwords")
+        self.m.workspace_pool = mock.MagicMock()
+        self.m.workspace_pool.claim.return_value = True
+        self.m._prepare_dir = mock.MagicMock()
+        self.m._prepare_workspace(dirname)
+        self.m.workspace_pool.claim.assert_called_once_with(dirname)
+        self.m._prepare_dir.assert_not_called()
+        for module in self.m.private_modules:
+            self.assertEqual(
+                os.readlink(dirname / "src" / "modules" / module), str(dirname / "private" / "modules" / module)
+            )
+
+        self.m.workspace_pool.claim.return_value = False
+        self.m._prepare_workspace(self.base / "unclaimed")
+        self.m._prepare_dir.assert_called_once_with(self.base / "unclaimed")
+
+    def test_clone_shared(self):
         self.m.git = mock.MagicMock()
-        self.m.refresh("/__test")
-        pushd.assert_called_with("/__test")
-        self.m.git.pull.assert_called_with("-q", "--rebase")
+        dest = self.m.prod_dir / "src"
+        # Shared clones are disabled by default
+        self.m._clone(self.fixtures, dest)
+        self.m.git.clone.assert_called_with("-q", str(self.fixtures), str(dest))
+        self.m.shared_clones = True
+        self.m._clone(self.fixtures, dest)
+        self.m.git.clone.assert_called_with("-q", "--shared", str(self.fixtures), str(dest))
+        # Remote repositories are always fully cloned
+        self.m._clone(self.m.puppet_src, dest)
+        self.m.git.clone.assert_called_with("-q", "https://gerrit.wikimedia.org/r/operations/puppet", str(dest))
+
+    def test_update_config(self):
+        for dirname in self.m.prod_dir, self.m.change_dir:
+            src = dirname / "src"
+            (src / "modules/puppetmaster/files/hiera").mkdir(parents=True, exist_ok=True)
+            for realm in "production", "wmcs-eqiad1":
+                shutil.copy(
+                    self.fixtures / f"modules/puppetmaster/files/hiera/{realm}.yaml",
+                    src / "modules/puppetmaster/files/hiera",
+                )
+            (src / "puppet.conf").write_text("# stale config")
+        self.m.update_config("production")
+        self.m.update_config("wmcs-eqiad1")
+        for dirname in self.m.prod_dir, self.m.change_dir:
+            for realm in "production", "wmcs-eqiad1":
+                confdir = FHS.confdir(dirname, realm)
+                self.assertIn(realm, (confdir / "hiera.yaml").read_text())
+                self.assertIn("generated by puppet-compiler", (confdir / "puppet.conf").read_text())
+                self.assertEqual((confdir / "modules").resolve(), dirname / "src" / "modules")
+        self.assertIn("node_terminus = exec", (FHS.confdir(self.m.prod_dir, "wmcs-eqiad1") / "puppet.conf").read_text())
+        self.assertIn("storeconfigs = true", (FHS.confdir(self.m.prod_dir, "production") / "puppet.conf").read_text())
+
+    @mock.patch("subprocess.check_call")
+    def test_refresh(self, mocker):
+        gitdir = self.base / "refresh"
+        (gitdir / ".git").mkdir(parents=True)
+        self.m.refresh(gitdir)
+        mocker.assert_called_once_with(["git", "pull", "-q", "--rebase"], cwd=gitdir)
+        # Refreshed recently enough
+        self.m.refresh_ttl = 60
+        self.m.refresh(gitdir)
+        mocker.assert_called_once()
+        os.utime(gitdir / ".git" / "pcc-last-refresh", (0, 0))
+        self.m.refresh(gitdir)
+        self.assertEqual(mocker.call_count, 2)
 
     @mock.patch("puppet_compiler.prepare.pushd")
     def test_prepare(self, pushd):
@@ -137,3 +208,34 @@ class TestManageCode(unittest.TestCase):
             [mock.call(self.m.change_dir)],
         )
         assert self.m._fetch_change.called
+
+    @mock.patch("subprocess.check_call")
+    def test_fetch_private_change(self, mocker):
+        self.m._change_refs[12345] = ("labs/private", "refs/changes/45/12345/2")
+        self.m._fetch_private_change(12345)
+        ref = "refs/changes/45/12345/2"
+        change_private = self.m.change_dir / "private"
+        prod_private = self.m.prod_dir / "private"
+        mocker.assert_has_calls(
+            [
+                # Downloaded from gerrit and rebased once
+                mock.call(
+                    ["git", "fetch", "-q", "https://gerrit.wikimedia.org/r/labs/private", ref], cwd=change_private
+                ),
+                mock.call(["git", "checkout", "-B", ref, "FETCH_HEAD"], cwd=change_private),
+                mock.call(["git", "log", "--oneline", "-n1"], cwd=change_private),
+                mock.call(["git", "pull", "--rebase", "origin", "master"], cwd=change_private),
+                # The production tree gets it from the change tree
+                mock.call(["git", "fetch", "-q", str(change_private), "HEAD"], cwd=prod_private),
+                mock.call(["git", "checkout", "-B", ref, "FETCH_HEAD"], cwd=prod_private),
+                mock.call(["git", "log", "--oneline", "-n1"], cwd=prod_private),
+            ]
+        )
+        self.assertEqual(mocker.call_count, 7)
+
+    def test_change_ref_cached(self):
+        with mock.patch("puppet_compiler.gerrit.client.change") as change_mock:
+            change_mock.return_value = {"project": "labs/private", "revisions": {"abc": {"_number": 3}}}
+            self.assertEqual(self.m._change_ref(12345), ("labs/private", "refs/changes/45/12345/3"))
+            self.assertEqual(self.m._change_ref(12345), ("labs/private", "refs/changes/45/12345/3"))
+        change_mock.assert_called_once_with(12345)
@@ -63,6 +63,12 @@ def test_json_render():
             )
         )
 
+        # The hosts compiled on behalf of others
+        j.represented = {"hostAaa": ["hostBbb"]}
+        j.render(states_col)
+        payload = python_json.loads(m_open().write.call_args[0][0])
+        assert payload["represented"] == {"hostAaa": ["hostBbb"]}
+
 
 class TestJsonHost(TestHost):
     def test_init(self):
@@ -0,0 +1,44 @@
+import tempfile
+import unittest
+from pathlib import Path
+
+from puppet_compiler.provenance import ProvenanceIndex, relative_source
+
+
+class TestProvenanceIndex(unittest.TestCase):
+    def setUp(self):
+        self.index = ProvenanceIndex(Path(tempfile.mkdtemp(prefix="puppet-compiler")) / "provenance.sqlite")
+
+    def test_relative_source(self):
+        roots = [Path("/base/1/production/conf/production"), Path("/base/1/production/src")]
+        self.assertEqual(
+            relative_source("/base/1/production/conf/production/modules/foo/manifests/init.pp", roots),
+            "modules/foo/manifests/init.pp",
+        )
+        self.assertEqual(relative_source("/base/1/production/src/manifests/site.pp", roots), "manifests/site.pp")
+        self.assertIsNone(relative_source("/usr/share/puppet/modules/stdlib/manifests/init.pp", roots))
+
+    def test_hosts_for(self):
+        self.index.record(
+            {
+                "grafana1001.eqiad.wmnet": ["manifests/site.pp", "modules/profile/manifests/grafana.pp"],
+                "sretest1001.eqiad.wmnet": ["manifests/site.pp", "modules/profile/manifests/sretest.pp"],
+            }
+        )
+        self.assertEqual(self.index.hosts_for(["modules/profile/manifests/grafana.pp"]), {"grafana1001.eqiad.wmnet"})
+        self.assertEqual(
+            self.index.hosts_for(["manifests/site.pp", "README"]),
+            {"grafana1001.eqiad.wmnet", "sretest1001.eqiad.wmnet"},
+        )
+        self.assertEqual(self.index.hosts_for([]), set())
+        # The sources of a host are replaced when it is compiled again
+        self.index.record({"grafana1001.eqiad.wmnet": ["manifests/site.pp"]})
+        self.assertEqual(self.index.hosts_for(["modules/profile/manifests/grafana.pp"]), set())
+        # Hosts without any source file are left alone
+        self.index.record({"sretest1001.eqiad.wmnet": []})
+        self.assertEqual(self.index.hosts_for(["modules/profile/manifests/sretest.pp"]), {"sretest1001.eqiad.wmnet"})
+
+    def test_unusable_database(self):
+        index = ProvenanceIndex(Path("/dev/null/provenance.sqlite"))
+        index.record({"test.example.com": ["manifests/site.pp"]})
+        self.assertEqual(index.hosts_for(["manifests/site.pp"]), set())
@@ -127,3 +127,32 @@ class TestPuppetCalls(AsyncTestCase):
         )
         calls = [call("wb"), call("w")]
         open_mock.assert_has_calls(calls, any_order=True)
+
+    @patch("puppet_compiler.utils.facts_file")
+    def test_compile_cmd_env_realm(self, facts_file_mock):
+        facts_file_mock.return_value = Path("/var/lib/catalog-differ/puppet/yaml/facts/test.example.com.yaml")
+        cmd, _ = puppet.compile_cmd_env("test.codfw.wmnet", "change", self.fixtures / "puppet_var")
+        self.assertIn(f"--confdir={FHS.change_dir / 'src'}", cmd)
+        cmd, _ = puppet.compile_cmd_env("test.codfw.wmnet", "change", self.fixtures / "puppet_var", realm="wmcs-eqiad1")
+        self.assertIn(f"--confdir={FHS.change_dir / 'conf' / 'wmcs-eqiad1'}", cmd)
+
+    @patch("puppet_compiler.utils.facts_file")
+    async def test_compile_pool(self, facts_file_mock):
+        facts_file_mock.return_value = Path("/var/lib/catalog-differ/puppet/yaml/facts/test.example.com.yaml")
+        subprocess.create_subprocess_shell.reset_mock()
+        pool = Mock()
+        pool.compile.return_value = futurized(0)
+        await puppet.compile("test.codfw.wmnet", "prod", self.fixtures / "puppet_var", compiler_pool=pool)
+        subprocess.create_subprocess_shell.assert_not_called()
+        cmd, env, hostname, catalog, errors = pool.compile.call_args[0]
+        self.assertEqual(cmd[-1], "test.codfw.wmnet")
+        self.assertEqual(catalog, FHS.prod_dir / "catalogs" / "test.codfw.wmnet.pson.gz")
+        self.assertEqual(errors, FHS.prod_dir / "catalogs" / "test.codfw.wmnet.err")
+
+        # Like the exit code of puppet, 2 means the catalog compiled
+        pool.compile.return_value = futurized(2)
+        await puppet.compile("test.codfw.wmnet", "prod", self.fixtures / "puppet_var", compiler_pool=pool)
+
+        pool.compile.return_value = futurized(1)
+        with self.assertRaises(puppet.CompilationFailedError):
+            await puppet.compile("test.codfw.wmnet", "prod", self.fixtures / "puppet_var", compiler_pool=pool)
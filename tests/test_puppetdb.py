@@ -0,0 +1,241 @@
+import json
+import re
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, unquote, urlparse
+
+from puppet_compiler.puppetdb import PuppetDBClient, ResourceIndex
+
+NODES = {
+    "Class/Role::Grafana": [{"certname": "grafana2001.codfw.wmnet", "tags": ["role::grafana"]}],
+    "Class/Profile::Sretest": [{"certname": "sretest1001.eqiad.wmnet", "tags": ["profile::sretest"]}],
+    "Systemd::Service/grafana": [{"certname": "grafana2001.codfw.wmnet", "tags": ["systemd"]}],
+}
+
+RESOURCES = [
+    {"certname": "grafana2001.codfw.wmnet", "type": "Class", "title": "Role::Grafana", "tags": ["role::grafana"]},
+    {"certname": "mw1001.eqiad.wmnet", "type": "Class", "title": "Role::Mediawiki::Appserver", "tags": ["role"]},
+    {"certname": "grafana2001.codfw.wmnet", "type": "Systemd::Service", "title": "grafana", "tags": ["systemd"]},
+    {"certname": "grafana2001.codfw.wmnet", "type": "Systemd::Service", "title": "other", "tags": ["systemd"]},
+    {"certname": "sretest1001.eqiad.wmnet", "type": "Systemd::Service", "title": "sretest", "tags": ["systemd"]},
+]
+
+
+def matches(resource, condition):
+    """Evaluate the subset of the query language used by the client"""
+    operator, *args = condition
+    if operator == "or":
+        return any(matches(resource, arg) for arg in args)
+    if operator == "and":
+        return all(matches(resource, arg) for arg in args)
+    if operator == "in":
+        return resource[args[0]] in args[1][1]
+    if operator == "~":
+        return re.search(args[1], resource[args[0]]) is not None
+    return resource[args[0]] == args[1]
+
+
+class FakePuppetDB(BaseHTTPRequestHandler):
+    """Serves the resources endpoint, slowly, recording the requests"""
+
+    requests: list = []
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def do_GET(self):  # noqa: N802
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(self.path)
+            cls.running += 1
+            cls.max_running = max(cls.max_running, cls.running)
+        time.sleep(0.1)
+        with cls.lock:
+            cls.running -= 1
+        url = urlparse(self.path)
+        path = unquote(url.path)
+        if path.endswith("/resources"):
+            self.respond(json.loads(parse_qs(url.query)["query"][0]))
+        else:
+            self.respond(None, NODES.get(path.split("/resources/", 1)[1], []))
+
+    def do_POST(self):  # noqa: N802
+        with type(self).lock:
+            type(self).requests.append(self.path)
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        self.respond(json.loads(body)["query"])
+
+    def respond(self, query, result=None):
+        if query is not None:
+            _, fields, condition = query
+            resources = [resource for resource in RESOURCES if matches(resource, condition)]
+            result = [{field: resource[field] for field in fields} for resource in resources]
+        body = json.dumps(result).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestPuppetDBClient(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), FakePuppetDB)
+        cls.thread = threading.Thread(target=cls.server.serve_forever, daemon=True)
+        cls.thread.start()
+        cls.url = f"http://127.0.0.1:{cls.server.server_address[1]}/pdb/query/v4"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        FakePuppetDB.requests = []
+        FakePuppetDB.max_running = 0
+        self.cache_dir = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+
+    def test_resources(self):
+        client = PuppetDBClient(self.url)
+        self.assertEqual(client.resources("Class/Role::Grafana"), NODES["Class/Role::Grafana"])
+        self.assertEqual(client.resources("Class/Role::Missing"), [])
+        self.assertEqual(len(FakePuppetDB.requests), 2)
+        self.assertIn("query=", FakePuppetDB.requests[0])
+
+    def test_resources_many(self):
+        client = PuppetDBClient(self.url)
+        titles = ["Class/Role::Grafana", "Class/Profile::Sretest", "Class/Role::Missing", "Class/Role::Grafana"]
+        self.assertEqual(
+            client.resources_many(titles),
+            {
+                "Class/Role::Grafana": NODES["Class/Role::Grafana"],
+                "Class/Profile::Sretest": NODES["Class/Profile::Sretest"],
+                "Class/Role::Missing": [],
+            },
+        )
+        # Each title is queried once, and the queries run concurrently
+        self.assertEqual(len(FakePuppetDB.requests), 3)
+        self.assertGreater(FakePuppetDB.max_running, 1)
+
+    def test_cache(self):
+        client = PuppetDBClient(self.url, cache_dir=self.cache_dir, cache_ttl=60)
+        client.resources("Class/Role::Grafana")
+        # Shared with the other jobs
+        other_client = PuppetDBClient(self.url, cache_dir=self.cache_dir, cache_ttl=60)
+        self.assertEqual(other_client.resources("Class/Role::Grafana"), NODES["Class/Role::Grafana"])
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+        # Not used once expired, nor when disabled
+        other_client.cache_ttl = 0
+        other_client.resources("Class/Role::Grafana")
+        self.assertEqual(len(FakePuppetDB.requests), 2)
+
+    def test_export_index(self):
+        index_path = self.cache_dir / "index.json"
+        PuppetDBClient(self.url).export_index(index_path)
+        self.assertIn("query=", FakePuppetDB.requests[0])
+        index = ResourceIndex.load(index_path)
+        self.assertEqual(
+            index.lookup("Class/Role::Grafana"), [{"certname": "grafana2001.codfw.wmnet", "tags": ["role::grafana"]}]
+        )
+        # One entry per node
+        self.assertEqual(
+            index.lookup("Systemd::Service"),
+            [
+                {"certname": "grafana2001.codfw.wmnet", "tags": ["systemd"]},
+                {"certname": "sretest1001.eqiad.wmnet", "tags": ["systemd"]},
+            ],
+        )
+        self.assertEqual(index.lookup("Class/Role::Missing"), [])
+
+    def test_resources_from_index(self):
+        index_path = self.cache_dir / "index.json"
+        ResourceIndex.from_resources(RESOURCES).save(index_path)
+        client = PuppetDBClient(self.url, index_path=index_path, index_max_age=60)
+        self.assertEqual(
+            client.resources("Class/Role::Grafana"),
+            [{"certname": "grafana2001.codfw.wmnet", "tags": ["role::grafana"]}],
+        )
+        self.assertEqual(client.resources("Class/Role::Missing"), [])
+        self.assertEqual(FakePuppetDB.requests, [])
+        # Core types are not indexed
+        client.resources("File")
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+        # Nor are the titles of the defined types
+        self.assertEqual(client.resources("Systemd::Service/grafana"), NODES["Systemd::Service/grafana"])
+        self.assertEqual(len(FakePuppetDB.requests), 2)
+        self.assertEqual(
+            client.resources_batch(["Systemd::Service/grafana"]),
+            [{"certname": "grafana2001.codfw.wmnet", "tags": ["systemd"]}],
+        )
+        self.assertEqual(len(FakePuppetDB.requests), 3)
+        # Stale indexes are not used
+        ResourceIndex(time.time() - 120, {}).save(index_path)
+        client = PuppetDBClient(self.url, index_path=index_path, index_max_age=60)
+        self.assertEqual(client.resources("Class/Role::Grafana"), NODES["Class/Role::Grafana"])
+        self.assertEqual(len(FakePuppetDB.requests), 4)
+
+    def test_resources_batch(self):
+        client = PuppetDBClient(self.url)
+        titles = ["Class/Role::Grafana", "Systemd::Service", "Class/Role::Missing", "Class/Role::Grafana"]
+        self.assertEqual(
+            client.resources_batch(titles),
+            [
+                {"certname": "grafana2001.codfw.wmnet", "tags": ["role::grafana"]},
+                {"certname": "grafana2001.codfw.wmnet", "tags": ["systemd"]},
+                {"certname": "grafana2001.codfw.wmnet", "tags": ["systemd"]},
+                {"certname": "sretest1001.eqiad.wmnet", "tags": ["systemd"]},
+            ],
+        )
+        # A single round trip
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+        self.assertEqual(client.resources_batch([]), [])
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+
+    def test_resources_batch_from_index(self):
+        index_path = self.cache_dir / "index.json"
+        ResourceIndex.from_resources(RESOURCES).save(index_path)
+        client = PuppetDBClient(self.url, index_path=index_path, index_max_age=60)
+        self.assertEqual(
+            client.resources_batch(["Class/Role::Grafana", "Systemd::Service"]),
+            [
+                {"certname": "grafana2001.codfw.wmnet", "tags": ["role::grafana"]},
+                {"certname": "grafana2001.codfw.wmnet", "tags": ["systemd"]},
+                {"certname": "sretest1001.eqiad.wmnet", "tags": ["systemd"]},
+            ],
+        )
+        self.assertEqual(FakePuppetDB.requests, [])
+        # Only the titles missing from the index are queried
+        self.assertEqual(client.resources_batch(["Class/Role::Grafana", "File"]), NODES["Class/Role::Grafana"])
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+
+    def test_roles(self):
+        roles = {"grafana2001.codfw.wmnet": "grafana", "mw1001.eqiad.wmnet": "mediawiki::appserver"}
+        self.assertEqual(PuppetDBClient(self.url).roles(), roles)
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+        index_path = self.cache_dir / "index.json"
+        ResourceIndex.from_resources(RESOURCES).save(index_path)
+        self.assertEqual(PuppetDBClient(self.url, index_path=index_path, index_max_age=60).roles(), roles)
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+
+    def test_classes(self):
+        certnames = ["grafana2001.codfw.wmnet", "sretest1001.eqiad.wmnet"]
+        classes = {"grafana2001.codfw.wmnet": {"Role::Grafana"}, "sretest1001.eqiad.wmnet": set()}
+        self.assertEqual(PuppetDBClient(self.url).classes(certnames), classes)
+        self.assertEqual(len(FakePuppetDB.requests), 1)
+        # The whole fleet doesn't fit in a query string
+        fleet = [f"host{number}.eqiad.wmnet" for number in range(5000)]
+        self.assertEqual(
+            PuppetDBClient(self.url).classes(certnames + fleet)["grafana2001.codfw.wmnet"], {"Role::Grafana"}
+        )
+        index_path = self.cache_dir / "index.json"
+        ResourceIndex.from_resources(RESOURCES).save(index_path)
+        self.assertEqual(PuppetDBClient(self.url, index_path=index_path, index_max_age=60).classes(certnames), classes)
+        self.assertEqual(len(FakePuppetDB.requests), 2)
@@ -55,6 +55,13 @@ class TestStatesCollection(unittest.TestCase):
         collection.add(test)
         self.assertEqual(collection.states["noop"], set(["test.example.com"]))
 
+    def test_update(self):
+        collection = state.StatesCollection()
+        collection.update(state.ChangeState("test.example.com", False, False, None, None, cancelled=True))
+        self.assertEqual(collection.states, {"cancelled": set(["test.example.com"])})
+        collection.update(state.ChangeState("test.example.com", False, False, True, False))  # diff
+        self.assertEqual(collection.states, {"diff": set(["test.example.com"])})
+
     def test_summary(self):
         collection = state.StatesCollection()
         test = state.ChangeState("test.example.com", True, False, None, None)  # noop
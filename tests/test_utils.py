@@ -0,0 +1,118 @@
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import mock
+import yaml
+
+from puppet_compiler import utils
+
+
+class TestFactsIndex(unittest.TestCase):
+    def setUp(self):
+        self.vardir = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.facts_dir = self.vardir / "yaml" / "facts"
+        self.facts_dir.mkdir(parents=True)
+        self.other_facts_dir = self.vardir / "yaml" / "other" / "facts"
+        self.other_facts_dir.mkdir(parents=True)
+        self.node_dir = self.vardir / "yaml" / "node"
+        self.node_dir.mkdir(parents=True)
+        for directory in [self.facts_dir, self.node_dir]:
+            (directory / "test.example.com.yaml").write_text("")
+        self.index = utils.FactsIndex(self.vardir / "yaml")
+
+    def test_facts_file(self):
+        self.assertEqual(self.index.facts_file("test.example.com"), self.facts_dir / "test.example.com.yaml")
+        self.assertIsNone(self.index.facts_file("missing.example.com"))
+        # Adding files is picked up
+        (self.facts_dir / "new.example.com.yaml").write_text("")
+        self.assertEqual(self.index.facts_file("new.example.com"), self.facts_dir / "new.example.com.yaml")
+        # The newest file wins
+        newest = self.other_facts_dir / "test.example.com.yaml"
+        newest.write_text("")
+        os.utime(self.facts_dir / "test.example.com.yaml", (0, 0))
+        self.assertEqual(self.index.facts_file("test.example.com"), newest)
+        # Removing files is picked up
+        newest.unlink()
+        self.assertEqual(self.index.facts_file("test.example.com"), self.facts_dir / "test.example.com.yaml")
+
+    def test_facts_file_not_rescanned(self):
+        self.index.facts_file("test.example.com")
+        self.index._facts["test.example.com"] = Path("/cached")
+        self.assertEqual(self.index.facts_file("test.example.com"), Path("/cached"))
+
+    def test_facts_file_replaced_not_rescanned(self):
+        facts_file = self.index.facts_file("test.example.com")
+        (self.facts_dir / "test.example.com.yaml").write_text(FACTS.format(expiration="2023-01-02"))
+        self.index._facts["test.example.com"] = Path("/cached")
+        with mock.patch.object(utils, "_facts_indexes", {self.vardir / "yaml": self.index}):
+            utils.refresh_yaml_date(facts_file)
+        with mock.patch.object(self.index, "_entries") as entries:
+            self.assertEqual(self.index.facts_file("test.example.com"), Path("/cached"))
+        entries.assert_not_called()
+        # Files replaced by others only get their directory listed again
+        (self.facts_dir / ".tmp").write_text("")
+        os.replace(self.facts_dir / ".tmp", facts_file)
+        self.assertEqual(self.index.facts_file("test.example.com"), Path("/cached"))
+        # Adding files still is picked up
+        (self.facts_dir / "new.example.com.yaml").write_text("")
+        self.assertEqual(self.index.facts_file("test.example.com"), facts_file)
+
+    def test_nodes(self):
+        (self.node_dir / "other.example.com.yaml").write_text("")
+        self.assertEqual(self.index.nodes(), {"test.example.com", "other.example.com"})
+
+    def test_module_facts_file(self):
+        self.assertEqual(utils.facts_file(self.vardir, "test.example.com"), self.facts_dir / "test.example.com.yaml")
+        with self.assertRaises(utils.FactsFileNotFound):
+            utils.facts_file(self.vardir, "missing.example.com")
+
+
+FACTS = """--- !ruby/object:Puppet::Node::Facts
+name: test.example.com
+values:
+  fqdn: test.example.com
+  timestamp: unrelated
+timestamp: 2023-01-01 00:00:00.000000000 +00:00
+expiration: {expiration}
+"""
+
+
+class TestRefreshYamlDate(unittest.TestCase):
+    def setUp(self):
+        self.facts = Path(tempfile.mkdtemp(prefix="puppet-compiler")) / "test.example.com.yaml"
+
+    def load(self):
+        yaml.add_multi_constructor("!ruby/object:", utils.construct_ruby_object)
+        return yaml.load(self.facts.read_text(), Loader=yaml.Loader)
+
+    def expiration(self):
+        return datetime.strptime(self.load()["expiration"][:19], "%Y-%m-%d %H:%M:%S")
+
+    def test_refresh(self):
+        self.facts.write_text(FACTS.format(expiration="2023-01-01 01:00:00.000000000 +02:00"))
+        self.assertTrue(utils.refresh_yaml_date(self.facts))
+        data = self.load()
+        self.assertEqual(data["values"], {"fqdn": "test.example.com", "timestamp": "unrelated"})
+        self.assertGreater(self.expiration(), datetime.utcnow() + timedelta(hours=23))
+        self.assertEqual(list(self.facts.parent.iterdir()), [self.facts])
+
+    def test_refresh_still_valid(self):
+        expiration = (datetime.utcnow() + timedelta(hours=2)).strftime("%Y-%m-%d %H:%M:%S")
+        content = FACTS.format(expiration=f"{expiration}.000000000 +00:00")
+        self.facts.write_text(content)
+        self.assertFalse(utils.refresh_yaml_date(self.facts, timedelta(hours=1)))
+        self.assertEqual(self.facts.read_text(), content)
+        # The offset is taken into account
+        self.facts.write_text(FACTS.format(expiration=f"{expiration}.000000000 +03:00"))
+        self.assertTrue(utils.refresh_yaml_date(self.facts, timedelta(hours=1)))
+
+    def test_refresh_yaml_fallback(self):
+        self.facts.write_text("--- !ruby/object:Puppet::Node::Facts\nname: test.example.com\nvalues: {}\n")
+        self.assertTrue(utils.refresh_yaml_date(self.facts))
+        data = self.load()
+        self.assertEqual(data["name"], "test.example.com")
+        self.assertIn("timestamp", data)
+        self.assertGreater(self.expiration(), datetime.utcnow() + timedelta(hours=23))
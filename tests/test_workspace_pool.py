@@ -0,0 +1,84 @@
+import subprocess
+import tempfile
+import unittest
+from pathlib import Path
+
+from puppet_compiler.workspace_pool import WorkspacePool
+
+
+def git(cwd, *args):
+    subprocess.check_call(
+        ["git", "-c", "user.name=test", "-c", "user.email=test@example.com", *args],
+        cwd=cwd,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+class TestWorkspacePool(unittest.TestCase):
+    def setUp(self):
+        self.base = Path(tempfile.mkdtemp(prefix="puppet-compiler"))
+        self.sources = {}
+        for name in ["src", "private", "netbox-hiera"]:
+            repo = self.base / "repos" / name
+            repo.mkdir(parents=True)
+            git(repo, "init", "-q")
+            self.commit(repo)
+            self.sources[name] = repo
+        self.pool = WorkspacePool(self.base / "workspaces", self.sources)
+        self.built = []
+
+    def commit(self, repo):
+        (repo / "README").write_text(str(len(list(repo.iterdir()))))
+        git(repo, "add", "README")
+        git(repo, "commit", "-q", "--allow-empty", "-m", "commit")
+
+    def build(self, workspace):
+        self.built.append(workspace.name)
+        for name, source in self.sources.items():
+            git(workspace, "clone", "-q", str(source), name)
+
+    def ready(self):
+        return sorted(path.name for path in self.pool.ready_dir.iterdir())
+
+    def test_fill_claim(self):
+        self.assertFalse(self.pool.claim(self.base / "job1"))
+        self.pool.fill(2, self.build)
+        self.assertEqual(self.ready(), sorted(self.built))
+        self.assertTrue(self.pool.claim(self.base / "job1"))
+        self.assertTrue((self.base / "job1" / "src" / "README").is_file())
+        self.assertEqual(len(self.ready()), 1)
+        # Only the missing workspace gets built
+        self.pool.fill(2, self.build)
+        self.assertEqual(len(self.built), 3)
+        self.assertEqual(len(self.ready()), 2)
+
+    def test_outdated(self):
+        self.pool.fill(1, self.build)
+        self.commit(self.sources["private"])
+        # Outdated workspaces are never claimed
+        self.assertFalse(self.pool.claim(self.base / "job1"))
+        self.pool.fill(1, self.build)
+        self.assertEqual(self.ready(), [self.built[1]])
+        self.assertEqual(list(self.pool.trash_dir.iterdir()), [])
+        self.assertTrue(self.pool.claim(self.base / "job1"))
+
+    def test_recycle(self):
+        self.pool.fill(2, self.build)
+        for job in ["job1", "job2"]:
+            self.assertTrue(self.pool.claim(self.base / job))
+            (self.base / job / "catalogs").mkdir()
+        self.pool.taint(self.base / "job2")
+        self.pool.recycle(self.base / "job1")
+        self.pool.recycle(self.base / "job2")
+        self.assertFalse((self.base / "job1").exists())
+        self.assertFalse((self.base / "job2").exists())
+        # Only the untainted workspace is ready again, without the job files
+        self.assertEqual(len(self.ready()), 1)
+        self.assertFalse((self.pool.ready_dir / self.ready()[0] / "catalogs").exists())
+        self.assertEqual(len(list(self.pool.trash_dir.iterdir())), 1)
+
+    def test_remote_sources(self):
+        pool = WorkspacePool(self.base / "workspaces", {"src": "https://gerrit.wikimedia.org/r/operations/puppet"})
+        self.assertIsNone(pool.revisions())
+        self.assertFalse(pool.claim(self.base / "job1"))